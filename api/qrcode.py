@@ -1,16 +1,15 @@
 from fastapi import APIRouter, Request, Depends, HTTPException
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import StreamingResponse, RedirectResponse
-from core.qr_generator import generate_qr
+from fastapi.responses import RedirectResponse
+from core.qr_generator import generate_qr_async
 from database_op.database import get_db
+from database_op.download_counters import download_counters
 import mysql.connector
 import os
-from azure.storage.blob import BlobServiceClient, BlobClient
 from dotenv import load_dotenv
-import io
 import logging
 from datetime import datetime, timezone
-from helpers.blob_op import refresh_sas_token_if_needed
+from helpers.blob_streaming import stream_blob_response
 
 # Load environment variables
 load_dotenv()
@@ -20,12 +19,6 @@ AZURE_STORAGE_ACCOUNT_NAME = os.getenv("AZURE_STORAGE_ACCOUNT_NAME")
 AZURE_STORAGE_ACCOUNT_KEY = os.getenv("AZURE_STORAGE_ACCOUNT_KEY")
 AZURE_BLOB_CONTAINER_NAME = os.getenv("AZURE_BLOB_CONTAINER_NAME")
 
-# Initialize the Azure Blob Storage client
-blob_service_client = BlobServiceClient(
-    account_url=f"https://{AZURE_STORAGE_ACCOUNT_NAME}.blob.core.windows.net",
-    credential=AZURE_STORAGE_ACCOUNT_KEY
-)
-
 qrcode = APIRouter()
 
 # Initialize templates
@@ -47,6 +40,7 @@ async def download_qr(
 ):
     """
     Serves QR code images with proper Content-Disposition headers to force download.
+    Browsers that already have the image get a 304.
     
     This endpoint fetches the QR code from Azure Blob Storage and serves it with
     headers that force the browser to download it rather than display it.
@@ -70,10 +64,10 @@ async def download_qr(
             raise HTTPException(status_code=404, detail="User alias not found")
         user_alias = user_data['alias']
         
-        # Get the QR code URL and SAS token based on the type
+        # Get the QR code URL based on the type
         if type == 'pdf':
             cursor.execute(
-                "SELECT pdf_qrcode_url, pdf_qrcode_sas_token, original_filename FROM pdf WHERE pdf_id = %s AND user_id = %s",
+                "SELECT pdf_qrcode_url, original_filename FROM pdf WHERE pdf_id = %s AND user_id = %s",
                 (id, user_id)
             )
             qr_data = cursor.fetchone()
@@ -81,13 +75,12 @@ async def download_qr(
                 raise HTTPException(status_code=404, detail="PDF QR code not found")
             
             qr_url = qr_data['pdf_qrcode_url']
-            qr_sas_token = qr_data['pdf_qrcode_sas_token']
             filename = qr_data['original_filename'].replace('.pptx', '').replace('.pdf', '')
             download_filename = f"{filename}_qr.png"
             
         elif type == 'set':
             cursor.execute(
-                "SELECT qrcode_url, qrcode_sas_token, name FROM `set` WHERE set_id = %s AND user_id = %s",
+                "SELECT qrcode_url, name FROM `set` WHERE set_id = %s AND user_id = %s",
                 (id, user_id)
             )
             qr_data = cursor.fetchone()
@@ -95,17 +88,21 @@ async def download_qr(
                 raise HTTPException(status_code=404, detail="Set QR code not found")
             
             qr_url = qr_data['qrcode_url']
-            qr_sas_token = qr_data['qrcode_sas_token']
             download_filename = f"{qr_data['name']}_qr.png"
             
         else:
             raise HTTPException(status_code=400, detail="Invalid QR code type")
         
-        # Fetch the QR code from Azure Blob Storage
-        full_qr_url = f"{qr_url}?{qr_sas_token}"
+        # QR codes only hold the secure link, which never changes, so browsers can keep
+        # them for a day and revalidate with a tiny 304 after that
+        qr_headers = {
+            "Content-Disposition": f'attachment; filename="{download_filename}"',
+            "Cache-Control": "private, max-age=86400"
+        }
+
+        # Serve the QR code from storage
         try:
-            blob_client = BlobClient.from_blob_url(full_qr_url)
-            qr_code_bytes = blob_client.download_blob().readall()
+            return await stream_blob_response(request, qr_url, "image/png", qr_headers, immutable=True)
         except Exception as e:
             logging.error(f"Error downloading QR code from Azure: {e}")
             
@@ -113,22 +110,22 @@ async def download_qr(
             if type == 'pdf':
                 logging.info(f"QR code not found for PDF {id}, regenerating...")
                 
-                # Get the PDF URL and SAS token
+                # Get the PDF's secure link code
                 cursor.execute(
-                    "SELECT url, sas_token, original_filename FROM pdf WHERE pdf_id = %s",
+                    "SELECT unique_code, original_filename FROM pdf WHERE pdf_id = %s",
                     (id,)
                 )
                 pdf_data = cursor.fetchone()
                 if not pdf_data:
                     raise HTTPException(status_code=404, detail="PDF not found")
                 
-                # Generate a new QR code
-                full_pdf_url = f"{pdf_data['url']}?{pdf_data['sas_token']}"
-                qr_code_url, qr_code_sas_token, qr_code_sas_token_expiry = generate_qr(
-                    link_with_sas=full_pdf_url,
+                # Generate a new QR code. It holds the secure link, never a signed URL,
+                # which would stop working once it expired
+                qr_code_url, qr_code_sas_token, qr_code_sas_token_expiry = await generate_qr_async(
                     user_alias=user_alias,
                     pdf_id=id,
-                    set_name="full_pdf"
+                    set_name="full_pdf",
+                    pdf_unique_code=pdf_data['unique_code']
                 )
                 
                 # Update the database with the new QR code information
@@ -142,17 +139,15 @@ async def download_qr(
                 )
                 db.commit()
                 
-                # Try to fetch the newly generated QR code
+                # Try to serve the newly generated QR code
                 try:
-                    full_qr_url = f"{qr_code_url}?{qr_code_sas_token}"
-                    blob_client = BlobClient.from_blob_url(full_qr_url)
-                    qr_code_bytes = blob_client.download_blob().readall()
-                    
                     # Update the filename for the download
                     filename = pdf_data['original_filename'].replace('.pptx', '').replace('.pdf', '')
-                    download_filename = f"{filename}_qr.png"
+                    qr_headers["Content-Disposition"] = f'attachment; filename="{filename}_qr.png"'
                     
+                    response = await stream_blob_response(request, qr_code_url, "image/png", qr_headers, immutable=True)
                     logging.info(f"Successfully regenerated QR code for PDF {id}")
+                    return response
                 except Exception as fetch_err:
                     logging.error(f"Error fetching regenerated QR code: {fetch_err}")
                     raise HTTPException(status_code=500, detail="Error generating QR code")
@@ -160,16 +155,6 @@ async def download_qr(
                 # For sets, we can't easily regenerate the QR code without knowing the slides
                 raise HTTPException(status_code=404, detail="QR code not found")
         
-        # Return the QR code with headers that force download
-        response = StreamingResponse(io.BytesIO(qr_code_bytes), media_type="image/png")
-        response.headers["Content-Disposition"] = f'attachment; filename="{download_filename}"'
-        response.headers["Content-Type"] = "image/png"
-        response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-        response.headers["Pragma"] = "no-cache"
-        response.headers["Expires"] = "0"
-        
-        return response
-        
     except Exception as e:
         logging.error(f"Error in download_qr: {e}")
         raise HTTPException(status_code=500, detail=f"Error downloading QR code: {str(e)}")
@@ -183,53 +168,35 @@ async def download_qr(
 @qrcode.post("/increment-pdf-download/{pdf_id}")
 async def increment_pdf_download(
     pdf_id: int,
-    request: Request,
-    db: mysql.connector.connection.MySQLConnection = Depends(get_db)
+    request: Request
 ):
     """
     Increments the download count for a PDF presentation.
     This endpoint can be called via AJAX when a user downloads a PDF.
+    The count is written to the database with the next batch (download_counters).
     """
-    cursor = None
     try:
         # Increment the download count
-        cursor = db.cursor()
-        cursor.execute(
-            "UPDATE pdf SET download_count = download_count + 1 WHERE pdf_id = %s",
-            (pdf_id,)
-        )
-        db.commit()
+        download_counters.add('pdf', pdf_id)
         return {"success": True, "message": "Download count incremented"}
     except Exception as e:
         print(f"Error incrementing PDF download count: {e}")
         raise HTTPException(status_code=500, detail="Error tracking download")
-    finally:
-        if cursor:
-            cursor.close()
 
 @qrcode.post("/increment-set-download/{set_id}")
 async def increment_set_download(
     set_id: int,
-    request: Request,
-    db: mysql.connector.connection.MySQLConnection = Depends(get_db)
+    request: Request
 ):
     """
     Increments the download count for a set.
     This endpoint can be called via AJAX when a user downloads a set.
+    The count is written to the database with the next batch (download_counters).
     """
-    cursor = None
     try:
         # Increment the download count
-        cursor = db.cursor()
-        cursor.execute(
-            "UPDATE `set` SET download_count = download_count + 1 WHERE set_id = %s",
-            (set_id,)
-        )
-        db.commit()
+        download_counters.add('set', set_id)
         return {"success": True, "message": "Download count incremented"}
     except Exception as e:
         print(f"Error incrementing set download count: {e}")
         raise HTTPException(status_code=500, detail="Error tracking download")
-    finally:
-        if cursor:
-            cursor.close()
@@ -1,13 +1,12 @@
-from fastapi import APIRouter, Request, Depends, HTTPException
-from fastapi.responses import RedirectResponse, StreamingResponse
-from database_op.database import get_db
-import mysql.connector
+from fastapi import APIRouter, Request, HTTPException
+from fastapi.responses import RedirectResponse
+from database_op.async_database import async_db, DictCursor
+from database_op.download_counters import download_counters
 import logging
-import os
-import io
-from azure.storage.blob import BlobClient
-from datetime import datetime, timezone
-from helpers.blob_op import refresh_sas_token_if_needed
+from core.link_cache import link_cache
+from helpers.blob_streaming import stream_blob_response, is_download_start
+from helpers.single_flight import SingleFlight
+from helpers.signed_urls import signed_url
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -16,194 +15,164 @@ load_dotenv()
 # Initialize router
 secure_links = APIRouter()
 
+# A class scanning the same QR code sends dozens of requests for one link within a
+# second or two. Resolved links are kept in link_cache, so usually none of them touch
+# the database; when one must, the others wait for its lookup rather than repeating
+# it (and stream_blob_response shares one fetch of the PDF between them). Their
+# downloads are counted in memory and written in batches by download_counters.
+_link_lookups = SingleFlight("secure_link_lookup")
+
+# How each kind of link is looked up, by unique code. Links are signed on the fly
+# when one is needed (helpers/signed_urls.py), so resolving is a pure read.
+_LINK_QUERIES = {
+    'pdf': """
+        SELECT p.pdf_id, p.url, p.original_filename, u.alias
+        FROM pdf p
+        JOIN user u ON p.user_id = u.user_id
+        WHERE p.unique_code = %s
+        """,
+    'set': """
+        SELECT s.set_id, s.pdf_id, s.url, s.name, u.alias
+        FROM `set` s
+        JOIN user u ON s.user_id = u.user_id
+        WHERE s.unique_code = %s
+        """
+}
+
+
+async def _lookup_link(link_type, unique_code):
+    """Looks up a PDF or set by its unique code, on the async pool."""
+    async with async_db.acquire() as conn:
+        async with conn.cursor(DictCursor) as cursor:
+            await cursor.execute(_LINK_QUERIES[link_type], (unique_code,))
+            resource = await cursor.fetchone()
+    if resource and resource.get('url'):
+        link_cache.put(link_type, unique_code, resource)
+    return resource
+
+
+async def resolve_link(link_type, unique_code):
+    """
+    Returns the pdf or set row a secure link points at (None if there is none),
+    from link_cache when possible.
+    """
+    resource = link_cache.get(link_type, unique_code)
+    if resource is None:
+        resource = await _link_lookups.do((link_type, unique_code), _lookup_link, link_type, unique_code)
+    return resource
+
+
+@secure_links.get("/s/set/{unique_code}")
+async def secure_set_download(unique_code: str, request: Request):
+    """
+    Serves a set's PDF by its unique code (the link in the set's QR code).
+
+    Requests for the same set that arrive together share the lookup and the PDF
+    download, so a classroom of scans costs about as much as one.
+    """
+    try:
+        set_data = await resolve_link('set', unique_code)
+        if not set_data:
+            raise HTTPException(status_code=404, detail="Slide set not found")
+
+        # Check if we have a URL for the set's PDF file
+        if not set_data.get('url'):
+            # If the URL is not available, return an error message
+            # This should not happen with new sets after the code changes
+            raise HTTPException(
+                status_code=404, 
+                detail="This set does not have a downloadable PDF. Please recreate the set."
+            )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error in secure_set_download: {e}")
+        raise HTTPException(status_code=500, detail=f"Error serving content: {str(e)}")
+
+    # Instead of redirecting to the storage URL (which would expose the SAS token),
+    # stream the file through with download headers
+    try:
+        # Create a filename for the download
+        filename = f"{set_data['name']}.pdf"
+        
+        # Pass the PDF through a chunk at a time, or just the range asked for.
+        # Set PDFs never change, so a browser that has it gets a 304 straight
+        # away. It still has to ask each time so deleted sets stop working.
+        response = await stream_blob_response(request, set_data['url'], "application/pdf", {
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "Cache-Control": "private, no-cache"
+        }, immutable=True)
+
+        # Track this view/download, once per download rather than per range request or revalidation
+        if is_download_start(response):
+            download_counters.add('set', set_data['set_id'])
+        return response
+        
+    except Exception as e:
+        logging.error(f"Error downloading set PDF: {e}")
+        # If there's an error, return an error message instead of redirecting to the viewer
+        raise HTTPException(
+            status_code=500, 
+            detail="Error downloading the set PDF. Please try again later."
+        )
+
 @secure_links.get("/s/{link_type}/{unique_code}")
 async def secure_redirect(
     link_type: str,
     unique_code: str,
-    request: Request,
-    db: mysql.connector.connection.MySQLConnection = Depends(get_db)
+    request: Request
 ):
     """
-    Securely serves resources like PDFs and slide sets using unique codes.
+    Securely serves resources like PDFs using unique codes. Sets have their own
+    route above, secure_set_download.
     
     This endpoint acts as a secure intermediary between public QR codes and private Azure storage.
-    It validates the request using the unique code, refreshes SAS tokens if needed, and redirects to the content.
+    It validates the request using the unique code and streams the content.
     
     Args:
-        link_type: Either 'pdf' or 'set' to indicate which type of resource
-        unique_code: The unique code associated with the PDF or set
+        link_type: 'pdf' (any other type is rejected)
+        unique_code: The unique code associated with the PDF
     """
-    cursor = None
+    if link_type != 'pdf':
+        raise HTTPException(status_code=400, detail="Invalid link type")
+
     try:
-        cursor = db.cursor(dictionary=True)
-        
-        # Get resource information based on the link type and unique code
-        if link_type == 'pdf':
-            cursor.execute(
-                """
-                SELECT p.*, u.alias 
-                FROM pdf p
-                JOIN user u ON p.user_id = u.user_id
-                WHERE p.unique_code = %s
-                """,
-                (unique_code,)
-            )
-            resource = cursor.fetchone()
-            if not resource:
-                raise HTTPException(status_code=404, detail="PDF not found")
-                
-            # Track this view/download
-            cursor.execute(
-                "UPDATE pdf SET download_count = download_count + 1 WHERE pdf_id = %s",
-                (resource['pdf_id'],)
-            )
-            db.commit()
-                
-            # Check if SAS token is still valid, refresh if needed
-            url = resource['url']
-            
-            # Make sas_token_expiry timezone-aware if it's not
-            sas_expiry_aware = resource['sas_token_expiry']
-            if sas_expiry_aware and sas_expiry_aware.tzinfo is None:
-                 sas_expiry_aware = sas_expiry_aware.replace(tzinfo=timezone.utc)
-
-            sas_token, sas_expiry = refresh_sas_token_if_needed(
-                alias=resource['alias'],
-                file_path=url.split('/')[-1],  # Extract blob name from URL
-                current_sas_token=resource['sas_token'],
-                sas_token_expiry=sas_expiry_aware
-            )
-            
-            # Update token in database if it was refreshed
-            if sas_token != resource['sas_token']:
-                cursor.execute(
-                    "UPDATE pdf SET sas_token = %s, sas_token_expiry = %s WHERE pdf_id = %s",
-                    (sas_token, sas_expiry, resource['pdf_id'])
-                )
-                db.commit()
-            
-            # Instead of redirecting to the Azure URL (which would expose the SAS token),
-            # download the file and serve it as a streaming response with download headers
-            full_url = f"{url}?{sas_token}"
-            
-            try:
-                # Download the PDF from Azure
-                blob_client = BlobClient.from_blob_url(full_url)
-                pdf_data = blob_client.download_blob().readall()
-                
-                # Create a filename for the download
-                filename = resource.get('original_filename', 'presentation.pdf')
-                if not filename.lower().endswith('.pdf'):
-                    filename = f"{filename}.pdf"
-                
-                # Return the PDF with headers that force download
-                response = StreamingResponse(io.BytesIO(pdf_data), media_type="application/pdf")
-                response.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
-                response.headers["Content-Type"] = "application/pdf"
-                response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-                response.headers["Pragma"] = "no-cache"
-                response.headers["Expires"] = "0"
-                
-                return response
-                
-            except Exception as e:
-                logging.error(f"Error downloading PDF: {e}")
-                # If there's an error, fall back to direct redirect
-                full_url = f"{url}?{sas_token}"
-                return RedirectResponse(url=full_url)
-            
-        elif link_type == 'set':
-            # For sets, find the associated set using the unique code
-            cursor.execute(
-                """
-                SELECT s.set_id, s.pdf_id, s.url, s.sas_token, s.sas_token_expiry, s.name, u.alias
-                FROM `set` s
-                JOIN user u ON s.user_id = u.user_id
-                WHERE s.unique_code = %s
-                """,
-                (unique_code,)
-            )
-            set_data = cursor.fetchone()
-            
-            if not set_data:
-                raise HTTPException(status_code=404, detail="Slide set not found")
-                
-            # Track this view/download
-            cursor.execute(
-                "UPDATE `set` SET download_count = download_count + 1 WHERE set_id = %s",
-                (set_data['set_id'],)
-            )
-            db.commit()
-            
-            # Check if we have a URL for the set's PDF file
-            if not set_data.get('url'):
-                # If the URL is not available, return an error message
-                # This should not happen with new sets after the code changes
-                raise HTTPException(
-                    status_code=404, 
-                    detail="This set does not have a downloadable PDF. Please recreate the set."
-                )
-            
-            # Make sas_token_expiry timezone-aware if it's not
-            sas_expiry_aware = set_data['sas_token_expiry']
-            if sas_expiry_aware and sas_expiry_aware.tzinfo is None:
-                 sas_expiry_aware = sas_expiry_aware.replace(tzinfo=timezone.utc)
-            
-            # Check if SAS token is still valid, refresh if needed
-            sas_token, sas_expiry = refresh_sas_token_if_needed(
-                alias=set_data['alias'],
-                file_path=set_data['url'].split('/')[-1],  # Extract blob name from URL
-                current_sas_token=set_data['sas_token'],
-                sas_token_expiry=sas_expiry_aware
-            )
-            
-            # Update token in database if it was refreshed
-            if sas_token != set_data['sas_token']:
-                cursor.execute(
-                    "UPDATE `set` SET sas_token = %s, sas_token_expiry = %s WHERE set_id = %s",
-                    (sas_token, sas_expiry, set_data['set_id'])
-                )
-                db.commit()
-            
-            # Instead of redirecting to the Azure URL (which would expose the SAS token),
-            # download the file and serve it as a streaming response with download headers
-            full_url = f"{set_data['url']}?{sas_token}"
-            
-            try:
-                # Download the PDF from Azure
-                blob_client = BlobClient.from_blob_url(full_url)
-                pdf_data = blob_client.download_blob().readall()
-                
-                # Create a filename for the download
-                filename = f"{set_data['name']}.pdf"
-                
-                # Return the PDF with headers that force download
-                response = StreamingResponse(io.BytesIO(pdf_data), media_type="application/pdf")
-                response.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
-                response.headers["Content-Type"] = "application/pdf"
-                response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-                response.headers["Pragma"] = "no-cache"
-                response.headers["Expires"] = "0"
-                
-                return response
-                
-            except Exception as e:
-                logging.error(f"Error downloading set PDF: {e}")
-                # If there's an error, return an error message instead of redirecting to the viewer
-                raise HTTPException(
-                    status_code=500, 
-                    detail="Error downloading the set PDF. Please try again later."
-                )
-            
-        else:
-            raise HTTPException(status_code=400, detail="Invalid link type")
-            
+        resource = await resolve_link('pdf', unique_code)
+        if not resource:
+            raise HTTPException(status_code=404, detail="PDF not found")
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error in secure_redirect: {e}")
         raise HTTPException(status_code=500, detail=f"Error serving content: {str(e)}")
-    finally:
-        if cursor:
-            cursor.close()
+
+    # Instead of redirecting to the storage URL (which would expose the SAS token),
+    # stream the file through with download headers
+    url = resource['url']
+    try:
+        # Create a filename for the download
+        filename = resource.get('original_filename') or 'presentation.pdf'
+        if not filename.lower().endswith('.pdf'):
+            filename = f"{filename}.pdf"
+        
+        # Pass the PDF through a chunk at a time, or just the range asked for.
+        # The presentation can be reprocessed in place, so browsers revalidate
+        # against the stored file's ETag every time (a 304 if it hasn't changed).
+        response = await stream_blob_response(request, url, "application/pdf", {
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "Cache-Control": "private, no-cache"
+        })
+        
+    except Exception as e:
+        logging.error(f"Error downloading PDF: {e}")
+        # If there's an error, fall back to direct redirect
+        download_counters.add('pdf', resource['pdf_id'])
+        return RedirectResponse(url=signed_url(url))
+
+    # Track this view/download, once per download rather than per range request or revalidation
+    if is_download_start(response):
+        download_counters.add('pdf', resource['pdf_id'])
+    return response
 
 
 # The viewer endpoint has been removed as it's no longer needed
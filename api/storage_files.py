@@ -0,0 +1,37 @@
+from fastapi import APIRouter, Request, HTTPException
+from fastapi.responses import FileResponse
+import mimetypes
+import logging
+import os
+from helpers.storage_backend import storage_backend, LocalStorageBackend, LOCAL_STORAGE_ROUTE
+
+# Initialize router
+storage_files = APIRouter()
+
+@storage_files.get(LOCAL_STORAGE_ROUTE + "/{blob_name:path}")
+async def serve_stored_file(blob_name: str, request: Request):
+    """
+    Serves a file from the local storage backend to anyone holding a valid signed URL.
+
+    This stands in for Azure serving a SAS URL when STORAGE_BACKEND=local, so links
+    in the dashboard, QR codes and downloads keep working with everything offline.
+    Returns 404 when the app is using Azure.
+    """
+    if not isinstance(storage_backend, LocalStorageBackend):
+        raise HTTPException(status_code=404, detail="Not found")
+
+    content_disposition = storage_backend.verify(blob_name, request.url.query)
+    if content_disposition is None:
+        raise HTTPException(status_code=403, detail="Invalid or expired link")
+
+    try:
+        file_path = storage_backend.path_for(blob_name)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Not found")
+    if not os.path.isfile(file_path):
+        raise HTTPException(status_code=404, detail="Not found")
+
+    logging.info(f"Serving stored file {blob_name}")
+    headers = {'Content-Disposition': content_disposition} if content_disposition else None
+    media_type = mimetypes.guess_type(blob_name)[0] or "application/octet-stream"
+    return FileResponse(file_path, media_type=media_type, headers=headers)
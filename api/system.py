@@ -1,9 +1,21 @@
 from fastapi import APIRouter, Request, Depends, HTTPException, Path, Body
 from helpers.system_monitor import get_system_stats
+from core.office_pool import office_pool, kill_soffice_processes
+from core.worker_status import get_office_pool_statuses, get_worker_cache_counters, request_kill_libreoffice
+from core.conversion_cache import get_cache_stats
+from core.set_cache import get_set_cache_stats
+from helpers.storage_clients import storage_clients
+from helpers.storage_backend import storage_backend
+from helpers.blob_cache import blob_cache
+from helpers.single_flight import get_single_flight_stats
 from database_op.database import get_db
+from database_op.download_counters import download_counters
+from core.link_cache import link_cache
+from helpers.signed_urls import get_signed_url_stats
+from helpers.loop_monitor import loop_monitor
+from database_op.async_database import async_db
 import mysql.connector
 import logging
-import subprocess
 import os
 import sys
 from typing import Dict, Any
@@ -134,26 +146,192 @@ async def update_bug_report_status(
         logger.error(f"Error updating bug report status: {e}")
         raise HTTPException(status_code=500, detail=f"Error updating bug report status: {str(e)}")
 
+@system.get("/libreoffice-pool")
+async def get_libreoffice_pool_status(request: Request, db: mysql.connector.connection.MySQLConnection = Depends(get_db)):
+    """
+    Get the status of the warm LibreOffice worker pools.
+    
+    Shows, for each running conversion worker process, each LibreOffice worker's
+    process, how many jobs it has run since its last restart, and how often it has
+    been restarted after crashes, hangs or recycling. The web process only has a
+    pool of its own when it runs embedded conversion workers.
+    """
+    try:
+        # Check admin access
+        check_admin_access(request)
+        
+        return {
+            'web': office_pool.status(),
+            'conversion_workers': get_office_pool_statuses(db)
+        }
+    except HTTPException:
+        # Re-raise HTTP exceptions (like 403 Forbidden)
+        raise
+    except Exception as e:
+        logger.error(f"Error getting LibreOffice pool status: {e}")
+        raise HTTPException(status_code=500, detail=f"Error getting LibreOffice pool status: {str(e)}")
+
+@system.get("/conversion-cache")
+async def get_conversion_cache_stats(request: Request, db: mysql.connector.connection.MySQLConnection = Depends(get_db)):
+    """
+    Get conversion cache statistics.
+    
+    Shows the hit/miss counters of the running conversion workers (since each of
+    them started), plus how many entries the cache holds and how much storage they use.
+    """
+    try:
+        # Check admin access
+        check_admin_access(request)
+        
+        return get_cache_stats(db, get_worker_cache_counters(db))
+    except HTTPException:
+        # Re-raise HTTP exceptions (like 403 Forbidden)
+        raise
+    except Exception as e:
+        logger.error(f"Error getting conversion cache stats: {e}")
+        raise HTTPException(status_code=500, detail=f"Error getting conversion cache stats: {str(e)}")
+
+@system.get("/set-cache")
+async def get_set_cache_status(request: Request, db: mysql.connector.connection.MySQLConnection = Depends(get_db)):
+    """
+    Get set PDF cache statistics.
+    
+    Shows hit/miss counters since the server started, plus how many shared set
+    PDFs are stored and how much storage they use.
+    """
+    try:
+        # Check admin access
+        check_admin_access(request)
+        
+        return get_set_cache_stats(db)
+    except HTTPException:
+        # Re-raise HTTP exceptions (like 403 Forbidden)
+        raise
+    except Exception as e:
+        logger.error(f"Error getting set cache stats: {e}")
+        raise HTTPException(status_code=500, detail=f"Error getting set cache stats: {str(e)}")
+
+@system.get("/blob-cache")
+async def get_blob_cache_status(request: Request):
+    """
+    Get read cache statistics.
+    
+    Shows the hit ratio and how many bytes of downloads were served from the cache
+    rather than storage since the server started, plus how full the memory and disk
+    tiers are.
+    """
+    try:
+        # Check admin access
+        check_admin_access(request)
+        
+        return blob_cache.stats()
+    except HTTPException:
+        # Re-raise HTTP exceptions (like 403 Forbidden)
+        raise
+    except Exception as e:
+        logger.error(f"Error getting blob cache stats: {e}")
+        raise HTTPException(status_code=500, detail=f"Error getting blob cache stats: {str(e)}")
+
+@system.get("/single-flight")
+async def get_single_flight_status(request: Request):
+    """
+    Get request coalescing statistics.
+    
+    For each kind of shared work (set lookups, download count updates, file fetches),
+    shows how many calls were made and how many requests shared a call instead.
+    """
+    try:
+        # Check admin access
+        check_admin_access(request)
+        
+        return get_single_flight_stats()
+    except HTTPException:
+        # Re-raise HTTP exceptions (like 403 Forbidden)
+        raise
+    except Exception as e:
+        logger.error(f"Error getting single flight stats: {e}")
+        raise HTTPException(status_code=500, detail=f"Error getting single flight stats: {str(e)}")
+
+@system.get("/download-counts")
+async def get_download_count_status(request: Request):
+    """
+    Get download counter statistics.
+    
+    Shows how many downloads were counted, how many are waiting to be written
+    and how many batched writes have been made (or have failed) since the server
+    started.
+    """
+    try:
+        # Check admin access
+        check_admin_access(request)
+        
+        return download_counters.stats()
+    except HTTPException:
+        # Re-raise HTTP exceptions (like 403 Forbidden)
+        raise
+    except Exception as e:
+        logger.error(f"Error getting download counter stats: {e}")
+        raise HTTPException(status_code=500, detail=f"Error getting download counter stats: {str(e)}")
+
+@system.get("/link-cache")
+async def get_link_cache_status(request: Request):
+    """
+    Get secure link resolution cache statistics.
+    
+    Shows how many QR code scans were resolved from memory rather than the
+    database since the server started.
+    """
+    try:
+        # Check admin access
+        check_admin_access(request)
+        
+        return link_cache.stats()
+    except HTTPException:
+        # Re-raise HTTP exceptions (like 403 Forbidden)
+        raise
+    except Exception as e:
+        logger.error(f"Error getting link cache stats: {e}")
+        raise HTTPException(status_code=500, detail=f"Error getting link cache stats: {str(e)}")
+
+@system.get("/storage-pool")
+async def get_storage_pool_status(request: Request):
+    """
+    Get the status of the shared Azure storage connection pools.
+    
+    Shows which storage backend is in use, how many pooled connections are in use
+    and how many have been opened, plus request counts, failures and average time
+    per kind of storage operation.
+    """
+    try:
+        # Check admin access
+        check_admin_access(request)
+        
+        return {'backend': storage_backend.name, **storage_clients.status()}
+    except HTTPException:
+        # Re-raise HTTP exceptions (like 403 Forbidden)
+        raise
+    except Exception as e:
+        logger.error(f"Error getting storage pool status: {e}")
+        raise HTTPException(status_code=500, detail=f"Error getting storage pool status: {str(e)}")
+
 @system.post("/kill-libreoffice")
-async def kill_libreoffice(request: Request):
+async def kill_libreoffice(request: Request, db: mysql.connector.connection.MySQLConnection = Depends(get_db)):
     """
     Kill all LibreOffice processes.
     
     This endpoint is useful when LibreOffice processes are hanging or consuming too many resources.
+    Those on this machine are killed right away, conversion workers kill theirs when
+    they next report their status (see core/worker_status.py).
+    Warm workers from the office pool are killed too; the pool's health check restarts them.
     """
     try:
         # Check admin access
         check_admin_access(request)
         
-        # Kill LibreOffice processes based on the operating system
-        if os.name == 'posix':  # Linux/Unix
-            subprocess.run(['pkill', 'soffice'], stderr=subprocess.DEVNULL)
-            subprocess.run(['pkill', 'libreoffice'], stderr=subprocess.DEVNULL)
-        elif os.name == 'nt':  # Windows
-            subprocess.run(['taskkill', '/F', '/IM', 'soffice.exe'], stderr=subprocess.DEVNULL)
-            subprocess.run(['taskkill', '/F', '/IM', 'soffice.bin'], stderr=subprocess.DEVNULL)
+        kill_soffice_processes()
+        workers = request_kill_libreoffice(db)
         
-        return {"message": "LibreOffice processes terminated successfully"}
+        return {"message": f"LibreOffice processes terminated successfully, and requested on {workers} conversion worker(s)"}
     except HTTPException:
         # Re-raise HTTP exceptions (like 403 Forbidden)
         raise
@@ -189,3 +367,66 @@ async def restart_app(request: Request):
     except Exception as e:
         logger.error(f"Error restarting application: {e}")
         raise HTTPException(status_code=500, detail=f"Error restarting application: {str(e)}")
+
+@system.get("/signed-urls")
+async def get_signed_url_status(request: Request):
+    """
+    Get signed URL statistics.
+    
+    Shows how many links to stored files were signed, and how many were reused
+    from memory, since the server started.
+    """
+    try:
+        # Check admin access
+        check_admin_access(request)
+        
+        return get_signed_url_stats()
+    except HTTPException:
+        # Re-raise HTTP exceptions (like 403 Forbidden)
+        raise
+    except Exception as e:
+        logger.error(f"Error getting signed URL stats: {e}")
+        raise HTTPException(status_code=500, detail=f"Error getting signed URL stats: {str(e)}")
+
+@system.get("/event-loop")
+async def get_event_loop_status(request: Request, reset: bool = False):
+    """
+    Get event loop lag statistics.
+    
+    Shows how late the event loop has been running tasks (mean, p95 and worst
+    over the last samples). Anything that blocks the loop delays every request.
+    Pass reset=true to start measuring afresh, e.g. before a load test.
+    """
+    try:
+        # Check admin access
+        check_admin_access(request)
+        
+        if reset:
+            loop_monitor.reset()
+        return loop_monitor.stats()
+    except HTTPException:
+        # Re-raise HTTP exceptions (like 403 Forbidden)
+        raise
+    except Exception as e:
+        logger.error(f"Error getting event loop stats: {e}")
+        raise HTTPException(status_code=500, detail=f"Error getting event loop stats: {str(e)}")
+
+@system.get("/async-db")
+async def get_async_db_status(request: Request):
+    """
+    Get async database pool statistics.
+    
+    Shows the size of the asyncio MySQL pool and how many of its connections
+    are open and idle right now.
+    """
+    try:
+        # Check admin access
+        check_admin_access(request)
+        
+        return async_db.stats()
+    except HTTPException:
+        # Re-raise HTTP exceptions (like 403 Forbidden)
+        raise
+    except Exception as e:
+        logger.error(f"Error getting async database stats: {e}")
+        raise HTTPException(status_code=500, detail=f"Error getting async database stats: {str(e)}")
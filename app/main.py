@@ -9,16 +9,28 @@ from starlette.middleware.sessions import SessionMiddleware
 from dotenv import load_dotenv
 import mysql.connector
 from database_op.database import get_db
+from database_op.async_database import async_db, get_async_db, DictCursor
+from database_op.download_counters import download_counters
+from database_op.dashboard_data import load_presentation_page, load_presentation_sets, DASHBOARD_PAGE_SIZE
+from database_op.user_usage import get_usage
 import asyncio
 import json
-from datetime import datetime, timezone
-from helpers.blob_op import refresh_sas_token_if_needed
+import socket
+from datetime import datetime
+from helpers.signed_urls import signed_url
+from helpers.loop_monitor import loop_monitor
 
 load_dotenv()
 
 import os
-from api import converter, users, qrcode, system, feedback, secure_links
+from api import converter, users, qrcode, system, feedback, secure_links, storage_files
 from core.main_converter import conversion_progress as pdf_conversion_progress
+from core.office_pool import office_pool
+from core.qr_generator import BASE_URL
+from helpers.storage_backend import storage_backend
+from helpers.blob_cache import blob_cache
+from core.conversion_jobs import worker_slot, get_pending_jobs
+from core.worker_status import report_worker_status
 
 # Configure logging
 logging.basicConfig(level=logging.INFO,
@@ -34,6 +46,49 @@ app = FastAPI(docs_url=None, redoc_url=None)
 # Add reCAPTCHA site key to app state for use in templates
 app.state.RECAPTCHA_SITE_KEY = os.getenv('RECAPTCHA_SITE_KEY')
 
+# Conversions normally run in separate worker processes (python -m app.worker).
+# For small single-machine deployments the web app can run some worker slots itself.
+EMBEDDED_CONVERSION_WORKERS = int(os.getenv("EMBEDDED_CONVERSION_WORKERS", "0"))
+
+@app.on_event("startup")
+async def start_background_services():
+    """
+    Starts, in this order:
+    - the storage backend (shared Azure clients, or the local folder) and its read cache
+    - the async database pool and the event loop lag monitor
+    - the download count writer
+    - the embedded conversion worker slots, if any, after warming up their
+      LibreOffice pool (in the thread pool, since that blocks)
+    """
+    await storage_backend.start()
+    blob_cache.start()
+    await async_db.start()
+    loop_monitor.start()
+    download_counters.start()
+    if EMBEDDED_CONVERSION_WORKERS > 0:
+        await run_in_threadpool(office_pool.start)
+        worker_id = f"{socket.gethostname()}:{os.getpid()}:web"
+        app.state.conversion_workers = [
+            asyncio.create_task(worker_slot(worker_id, slot)) for slot in range(EMBEDDED_CONVERSION_WORKERS)
+        ] + [asyncio.create_task(report_worker_status(worker_id))]
+
+@app.on_event("shutdown")
+async def stop_background_services():
+    """
+    Stops what start_background_services started:
+    - the embedded conversion workers and their warm LibreOffice workers
+    - the download count writer, after writing what is still pending
+    - the storage backend, read cache, lag monitor and async database pool
+    """
+    for task in getattr(app.state, "conversion_workers", []):
+        task.cancel()
+    await run_in_threadpool(office_pool.shutdown)
+    await download_counters.stop()
+    await storage_backend.close()
+    blob_cache.close()
+    loop_monitor.stop()
+    await async_db.close()
+
 # Custom exception handlers
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request, exc):
@@ -82,6 +137,7 @@ app.include_router(qrcode.qrcode) # Include the QR code router
 app.include_router(system.system, prefix="/api/system")
 app.include_router(feedback.feedback) # Include the feedback router
 app.include_router(secure_links.secure_links) # Include the secure links router
+app.include_router(storage_files.storage_files) # Serves files when using local storage
 
 # Initialize templates
 templates = Jinja2Templates(directory="templates")
@@ -158,37 +214,18 @@ async def account_page(request: Request, db: mysql.connector.connection.MySQLCon
     user_data = cursor.fetchone()
     login_method = user_data['login_method'] if user_data else "slide_pull"
 
-    cursor = db.cursor(dictionary=True)
-
-    # Fetch presentations
-    cursor.execute("""
-        SELECT pdf_id FROM pdf WHERE user_id = %s
-    """, (user_id,))
-    presentations = cursor.fetchall()
-
-    # Count sets
-    cursor.execute("""
-        SELECT COUNT(*) as count FROM `set` WHERE user_id = %s
-    """, (user_id,))
-    sets_result = cursor.fetchone()
-    sets_count = sets_result['count'] if sets_result else 0
-
-    # Calculate total downloads (PDF presentations + sets)
-    cursor.execute("""
-        SELECT COALESCE(SUM(download_count), 0) as pdf_downloads 
-        FROM pdf 
-        WHERE user_id = %s
-    """, (user_id,))
-    pdf_downloads_result = cursor.fetchone()
-    pdf_downloads = pdf_downloads_result['pdf_downloads'] if pdf_downloads_result else 0
-
-    cursor.execute("""
-        SELECT COALESCE(SUM(download_count), 0) as set_downloads 
-        FROM `set` 
-        WHERE user_id = %s
-    """, (user_id,))
-    set_downloads_result = cursor.fetchone()
-    set_downloads = set_downloads_result['set_downloads'] if set_downloads_result else 0
+    # Presentation, set and download counts, from the user's usage summary. Downloads
+    # reach it in batches (database_op/download_counters.py), so this process's
+    # unwritten ones are added on top, like the dashboard does
+    usage = get_usage(cursor, user_id)
+    presentation_count = usage['presentation_count']
+    sets_count = usage['set_count']
+    cursor.execute("SELECT pdf_id FROM pdf WHERE user_id = %s", (user_id,))
+    pdf_ids = {row['pdf_id'] for row in cursor.fetchall()}
+    cursor.execute("SELECT set_id FROM `set` WHERE user_id = %s", (user_id,))
+    set_ids = {row['set_id'] for row in cursor.fetchall()}
+    pdf_downloads = usage['pdf_download_count'] + sum(download_counters.pending_downloads('pdf', pdf_ids).values())
+    set_downloads = usage['set_download_count'] + sum(download_counters.pending_downloads('set', set_ids).values())
 
     total_downloads = pdf_downloads + set_downloads
     
@@ -226,7 +263,7 @@ async def account_page(request: Request, db: mysql.connector.connection.MySQLCon
         "premium_status": premium_status,
         "member_since": formatted_member_since, # Use formatted date
         "login_method": login_method,
-        "presentations": presentations,
+        "presentation_count": presentation_count,
         "sets_count": sets_count,
         "total_downloads": total_downloads,
         "pdf_downloads": pdf_downloads,
@@ -482,7 +519,7 @@ async def logs_page(request: Request):
 
 
 @app.get("/dashboard", response_class=HTMLResponse)
-async def dashboard(request: Request, db: mysql.connector.connection.MySQLConnection = Depends(get_db)):
+async def dashboard(request: Request, page: int = 1, db=Depends(get_async_db)):
     # Ensure the user is logged in
     if 'email' not in request.session:
         return RedirectResponse(url="/login")
@@ -508,11 +545,10 @@ async def dashboard(request: Request, db: mysql.connector.connection.MySQLConnec
     # Check if there's a flash message to display
     flash_message = get_flash_message(request)
 
-    cursor = db.cursor(dictionary=True)
-    
-    # Get the user's alias (needed for token refresh)
-    cursor.execute("SELECT alias FROM user WHERE user_id = %s", (user_id,))
-    user_data = cursor.fetchone()
+    # Make sure the user's account is still there
+    async with db.cursor(DictCursor) as cursor:
+        await cursor.execute("SELECT alias FROM user WHERE user_id = %s", (user_id,))
+        user_data = await cursor.fetchone()
     if not user_data or 'alias' not in user_data:
         logging.error(f"Couldn't find alias for user {user_id}")
         return templates.TemplateResponse("dashboard.html", {
@@ -524,143 +560,25 @@ async def dashboard(request: Request, db: mysql.connector.connection.MySQLConnec
             "premium_status": premium_status,
             "member_since": formatted_member_since, # Use formatted date
             "presentations": [],
+            "total_presentations": 0,
+            "page": 1,
+            "page_offset": 0,
+            "has_next_page": False,
             "is_admin": email in ADMIN_EMAILS
         })
-    
-    user_alias = user_data['alias']
-
-    # Fetch presentations and associated sets using LEFT JOIN, including PDF QR code info
-    cursor.execute("""
-        SELECT pdf.pdf_id, pdf.original_filename, pdf.url, pdf.sas_token, pdf.sas_token_expiry AS uploaded_on,
-               pdf.num_slides, pdf.file_size_kb, pdf.download_count,
-               pdf.pdf_qrcode_url, pdf.pdf_qrcode_sas_token, pdf.pdf_qrcode_sas_token_expiry,
-               `set`.set_id, `set`.name AS set_name, `set`.qrcode_url, `set`.qrcode_sas_token,
-               `set`.download_count AS set_download_count, `set`.slide_count
-        FROM pdf
-        LEFT JOIN `set` ON pdf.pdf_id = `set`.pdf_id
-        WHERE pdf.user_id = %s
-        ORDER BY pdf.pdf_id
-    """, (user_id,))
-
-    rows = cursor.fetchall()
-
-    # Organize data into presentations with their sets
-    presentations = []
-    presentation_dict = {}
-    update_cursor = None
-    
-    try:
-        update_cursor = db.cursor()
-        
-        for row in rows:
-            pdf_id = row['pdf_id']
-            if pdf_id not in presentation_dict:
-                # New presentation
-                # Check if the SAS token is expired and refresh if needed
-                current_sas_token = row['sas_token']
-                sas_token_expiry = row['uploaded_on']  # This is actually the sas_token_expiry
-                original_filename = row['original_filename']
-                
-                # Extract the file path from the URL
-                url_parts = row['url'].split('/')
-                file_path = '/'.join(url_parts[4:])  # Skip the protocol and domain parts
-                
-                # Check if token is expired and refresh if needed
-                # Ensure both datetimes are timezone-aware before comparison
-                current_time = datetime.now(timezone.utc)
-                
-                # If sas_token_expiry is naive (has no timezone), assume it's in UTC
-                if sas_token_expiry is not None and sas_token_expiry.tzinfo is None:
-                    sas_token_expiry = sas_token_expiry.replace(tzinfo=timezone.utc)
-                
-                if sas_token_expiry is None or current_time >= sas_token_expiry:
-                    logging.info(f"Refreshing expired SAS token for PDF {pdf_id}")
-                    new_token, new_expiry = refresh_sas_token_if_needed(
-                        alias=user_alias,
-                        file_path=file_path,
-                        current_sas_token=current_sas_token,
-                        sas_token_expiry=sas_token_expiry
-                    )
-                    
-                    # Update the database with the new token
-                    update_cursor.execute(
-                        "UPDATE pdf SET sas_token = %s, sas_token_expiry = %s WHERE pdf_id = %s",
-                        (new_token, new_expiry, pdf_id)
-                    )
-                    db.commit()
-                    
-                    # Use the new token
-                    pdf_url_with_sas = f"{row['url']}?{new_token}"
-                    current_sas_token = new_token
-                else:
-                    # Token is still valid, use the existing one
-                    pdf_url_with_sas = f"{row['url']}?{current_sas_token}"
-                
-                presentation = {
-                    'pdf_id': pdf_id,
-                    'original_filename': original_filename,
-                    'url': row['url'],
-                    'url_with_sas': pdf_url_with_sas,
-                    'sas_token': current_sas_token,
-                    'uploaded_on': sas_token_expiry,
-                    'num_slides': row['num_slides'],
-                    'file_size_kb': row['file_size_kb'],
-                    'download_count': row['download_count'] or 0,
-                    'sets': []
-                }
-                presentation_dict[pdf_id] = presentation
-                presentations.append(presentation)
-            else:
-                presentation = presentation_dict[pdf_id]
-
-            # Add set if it exists
-            if row['set_id'] is not None:
-                set_id = row['set_id']
-                set_name = row['set_name']
-                qrcode_url = row['qrcode_url']
-                qrcode_sas_token = row['qrcode_sas_token']
-                
-                # Check if the QR code SAS token needs to be refreshed
-                # We would need to query the set table to get the expiry date
-                # For now, we'll assume it might be expired and refresh it
-                
-                # Extract the file path from the URL
-                if qrcode_url:
-                    url_parts = qrcode_url.split('/')
-                    qr_file_path = '/'.join(url_parts[4:])  # Skip the protocol and domain parts
-                    
-                    # Refresh the QR code SAS token
-                    new_qr_token, new_qr_expiry = refresh_sas_token_if_needed(
-                        alias=user_alias,
-                        file_path=qr_file_path,
-                        current_sas_token=qrcode_sas_token
-                    )
-                    
-                    # Update the database with the new token if it changed
-                    if new_qr_token != qrcode_sas_token:
-                        logging.info(f"Refreshing expired SAS token for QR code of set {set_id}")
-                        update_cursor.execute(
-                            "UPDATE `set` SET qrcode_sas_token = %s, qrcode_sas_token_expiry = %s WHERE set_id = %s",
-                            (new_qr_token, new_qr_expiry, set_id)
-                        )
-                        db.commit()
-                        qrcode_sas_token = new_qr_token
-                    
-                    # Construct the full QR code URL with SAS token
-                    qrcode_url_with_sas = f"{qrcode_url}?{qrcode_sas_token}"
-                    
-                    presentation['sets'].append({
-                        'set_id': set_id,
-                        'name': set_name,
-                        'qrcode_url_with_sas': qrcode_url_with_sas,
-                        'download_count': row['set_download_count'] or 0,
-                        'slide_count': row['slide_count'] or 0
-                    })
-    finally:
-        if update_cursor:
-            update_cursor.close()
 
-    cursor.close()
+    # One page of presentations with a summary of their sets. The sets themselves are
+    # loaded when the user opens them (presentation_sets below)
+    async with db.cursor(DictCursor) as cursor:
+        presentations, total_presentations, page = await load_presentation_page(cursor, user_id, page)
+
+    # Downloads counted but not written to the database yet are added on top
+    pending_pdf_downloads = download_counters.pending_downloads('pdf', {p['pdf_id'] for p in presentations})
+    for presentation in presentations:
+        presentation['download_count'] = (presentation['download_count'] or 0) + pending_pdf_downloads.get(presentation['pdf_id'], 0)
+
+    # Uploads that are still being converted by the workers
+    pending_jobs = await get_pending_jobs(db, user_id)
 
     # Check if the user is an admin and add admin link if they are
     is_admin = email in ADMIN_EMAILS
@@ -675,9 +593,36 @@ async def dashboard(request: Request, db: mysql.connector.connection.MySQLConnec
         "premium_status": premium_status,
         "member_since": formatted_member_since, # Use formatted date
         "presentations": presentations,  # Pass the list of presentations to the template
+        "total_presentations": total_presentations,
+        "page": page,
+        "page_offset": (page - 1) * DASHBOARD_PAGE_SIZE,
+        "has_next_page": page * DASHBOARD_PAGE_SIZE < total_presentations,
+        "pending_jobs": pending_jobs,  # Uploads still being converted
         "is_admin": is_admin  # Pass admin status to show/hide admin link
     })
 
+@app.get("/dashboard/presentations/{pdf_id}/sets")
+async def presentation_sets(pdf_id: int, request: Request, db=Depends(get_async_db)):
+    """
+    The sets of one of the user's presentations as JSON, for the dashboard to show
+    when the user opens them: name, slide numbers, download count, secure link and
+    where to download the QR code.
+    """
+    if 'user_id' not in request.session:
+        raise HTTPException(status_code=401, detail="User not authenticated")
+    user_id = request.session['user_id']
+
+    async with db.cursor(DictCursor) as cursor:
+        sets = await load_presentation_sets(cursor, user_id, pdf_id)
+
+    # Downloads counted but not written to the database yet are added on top
+    pending_set_downloads = download_counters.pending_downloads('set', {set_data['set_id'] for set_data in sets})
+    for set_data in sets:
+        set_data['download_count'] += pending_set_downloads.get(set_data['set_id'], 0)
+        set_data['link'] = f"{BASE_URL}/s/set/{set_data.pop('unique_code')}"
+        set_data['qrcode_download_url'] = f"/download-qr/set/{set_data['set_id']}"
+    return JSONResponse({"pdf_id": pdf_id, "sets": sets})
+
 @app.get("/download-pdf/{pdf_id}")
 async def download_pdf(pdf_id: int, request: Request, db: mysql.connector.connection.MySQLConnection = Depends(get_db)):
     """
@@ -685,7 +630,7 @@ async def download_pdf(pdf_id: int, request: Request, db: mysql.connector.connec
     This adds the Content-Disposition header to force the browser to download the file
     with the original filename.
     
-    This endpoint also checks if the SAS token is expired and refreshes it if needed.
+    The link is signed on the fly, so nothing is written to the database.
     """
     # Ensure the user is logged in
     if 'user_id' not in request.session:
@@ -697,74 +642,26 @@ async def download_pdf(pdf_id: int, request: Request, db: mysql.connector.connec
         # Get the PDF information from the database
         cursor = db.cursor(dictionary=True)
         cursor.execute("""
-            SELECT original_filename, url, sas_token, sas_token_expiry
+            SELECT original_filename, url
             FROM pdf
             WHERE pdf_id = %s AND user_id = %s
         """, (pdf_id, user_id))
         
         pdf_info = cursor.fetchone()
+        cursor.close()
         
         if not pdf_info:
-            cursor.close()
             return {"error": "PDF not found or you don't have permission to access it"}
         
-        # Get the user's alias (needed for token refresh)
-        cursor.execute("SELECT alias FROM user WHERE user_id = %s", (user_id,))
-        user_data = cursor.fetchone()
-        cursor.close()
-        
-        if not user_data or 'alias' not in user_data:
-            logging.error(f"Couldn't find alias for user {user_id}")
-            return {"error": "User data not found. Please contact support."}
-        
-        user_alias = user_data['alias']
-        
-        # Check if the SAS token is expired and refresh if needed
-        current_sas_token = pdf_info['sas_token']
-        sas_token_expiry = pdf_info['sas_token_expiry']
-        
-        # Extract the file path from the URL
-        url_parts = pdf_info['url'].split('/')
-        file_path = '/'.join(url_parts[4:])  # Skip the protocol and domain parts
-        
-        # Check if token is expired and refresh if needed
-        # Ensure both datetimes are timezone-aware before comparison
-        current_time = datetime.now(timezone.utc)
-        
-        # If sas_token_expiry is naive (has no timezone), assume it's in UTC
-        if sas_token_expiry is not None and sas_token_expiry.tzinfo is None:
-            sas_token_expiry = sas_token_expiry.replace(tzinfo=timezone.utc)
-        
-        if sas_token_expiry is None or current_time >= sas_token_expiry:
-            logging.info(f"Refreshing expired SAS token for PDF {pdf_id} during download")
-            new_token, new_expiry = refresh_sas_token_if_needed(
-                alias=user_alias,
-                file_path=file_path,
-                current_sas_token=current_sas_token,
-                sas_token_expiry=sas_token_expiry
-            )
-            
-            # Update the database with the new token
-            update_cursor = db.cursor()
-            update_cursor.execute(
-                "UPDATE pdf SET sas_token = %s, sas_token_expiry = %s WHERE pdf_id = %s",
-                (new_token, new_expiry, pdf_id)
-            )
-            db.commit()
-            update_cursor.close()
-            
-            # Use the new token
-            pdf_url_with_sas = f"{pdf_info['url']}?{new_token}"
-        else:
-            # Token is still valid, use the existing one
-            pdf_url_with_sas = f"{pdf_info['url']}?{current_sas_token}"
+        # Set the Content-Disposition to force download with the original filename,
+        # both on the signed link (storage sends it with the file) and on the redirect
+        filename = pdf_info['original_filename']
+        content_disposition = f'attachment; filename="{filename}"'
+        pdf_url_with_sas = signed_url(pdf_info['url'], content_disposition)
         
         # Create a redirect response with the Content-Disposition header
         response = RedirectResponse(url=pdf_url_with_sas)
-        
-        # Set the Content-Disposition header to force download with the original filename
-        filename = pdf_info['original_filename']
-        response.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+        response.headers["Content-Disposition"] = content_disposition
         
         return response
         
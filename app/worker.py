@@ -0,0 +1,63 @@
+"""
+Conversion worker entry point.
+
+Runs the PPTX -> PDF -> slides/thumbnails pipeline for jobs queued by /upload-pptx.
+Start as many of these as you like, on this machine or others pointed at the same
+database and storage:
+
+    python -m app.worker
+
+CONVERSION_WORKER_CONCURRENCY sets how many jobs one worker process runs at a time,
+and CONVERSION_WORKER_POLL_SECONDS (see core/conversion_jobs.py) how long an idle
+worker waits before checking the queue again.
+"""
+import os
+import socket
+import asyncio
+import logging
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from core.office_pool import office_pool
+from helpers.storage_backend import storage_backend
+from core.conversion_jobs import worker_slot, reap_abandoned_jobs
+from core.worker_status import report_worker_status
+
+# Configure logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    handlers=[
+                        logging.FileHandler("worker.log"),
+                        logging.StreamHandler()
+                    ])
+logger = logging.getLogger("conversion_worker")
+
+CONVERSION_WORKER_CONCURRENCY = int(os.getenv("CONVERSION_WORKER_CONCURRENCY", "2"))
+
+
+async def main():
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    logger.info(f"Starting conversion worker {worker_id} with {CONVERSION_WORKER_CONCURRENCY} slot(s)")
+
+    # Warm up LibreOffice and open the storage connections before taking any jobs
+    await storage_backend.start()
+    await asyncio.get_event_loop().run_in_executor(None, office_pool.start)
+
+    try:
+        await asyncio.gather(
+            reap_abandoned_jobs(),
+            report_worker_status(worker_id),
+            *(worker_slot(worker_id, slot) for slot in range(CONVERSION_WORKER_CONCURRENCY))
+        )
+    finally:
+        office_pool.shutdown()
+        await storage_backend.close()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logger.info("Conversion worker stopped")
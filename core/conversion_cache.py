@@ -0,0 +1,312 @@
+import os
+import hashlib
+import logging
+import threading
+from datetime import datetime, timedelta
+
+import mysql.connector
+from database_op.database import get_connection
+from database_op.bulk_writes import insert_slides
+from helpers.blob_op import copy_blob, reserve_blob, list_blob_sizes, delete_blobs_with_prefix
+
+logger = logging.getLogger(__name__)
+
+# Conversion cache
+#
+# Teachers re-upload the same deck all the time. Rather than paying for LibreOffice
+# and page splitting again, we remember what an upload converted to, keyed by the
+# SHA-256 of the uploaded .pptx bytes.
+#
+# The cache owns its own copy of the files, so deleting a presentation never breaks it:
+# - conversion_cache/<hash>/master.pdf - The converted PDF
+# - conversion_cache/<hash>/slide_<n>.pdf - The 1-page slide PDFs (those that were made)
+# - conversion_cache/<hash>/thumb_<n>.png - The thumbnails
+#
+# On a hit these are copied server-side into the user's own folders.
+CACHE_ALIAS = "conversion_cache"
+
+# Bump this whenever the conversion output changes (thumbnail size, PDF settings...)
+# so stale entries stop matching.
+CONVERSION_CACHE_VERSION = 1
+
+CONVERSION_CACHE_ENABLED = os.getenv("CONVERSION_CACHE_ENABLED", "true").lower() == "true"
+CONVERSION_CACHE_MAX_MB = int(os.getenv("CONVERSION_CACHE_MAX_MB", "2048"))
+CONVERSION_CACHE_MAX_AGE_DAYS = int(os.getenv("CONVERSION_CACHE_MAX_AGE_DAYS", "30"))
+
+# Counters since this process started, shown on the admin page
+cache_stats = {
+    'hits': 0,
+    'misses': 0,
+    'stores': 0,
+    'evictions': 0,
+    'errors': 0
+}
+_stats_lock = threading.Lock()
+
+
+def _count(name):
+    with _stats_lock:
+        cache_stats[name] += 1
+
+
+def get_counters():
+    """Returns a copy of this process's hit/miss counters."""
+    with _stats_lock:
+        return dict(cache_stats)
+
+
+def hash_pptx_bytes(pptx_bytes):
+    """Returns the cache key for an uploaded presentation."""
+    digest = hashlib.sha256(f"v{CONVERSION_CACHE_VERSION}:".encode())
+    digest.update(pptx_bytes)
+    return digest.hexdigest()
+
+
+def hash_pptx_file(pptx_path):
+    """Same as hash_pptx_bytes, for a presentation on disk. Reads it 1 MB at a time."""
+    digest = hashlib.sha256(f"v{CONVERSION_CACHE_VERSION}:".encode())
+    with open(pptx_path, "rb") as pptx_file:
+        for chunk in iter(lambda: pptx_file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _blob_prefix(content_hash):
+    return f"{CACHE_ALIAS}/{content_hash}"
+
+
+def lookup(db, content_hash):
+    """
+    Looks up a converted presentation by content hash.
+
+    Returns the cache row (content_hash, blob_prefix, num_slides) or None, and keeps
+    the hit/miss counters up to date.
+    """
+    if not CONVERSION_CACHE_ENABLED:
+        return None
+
+    cursor = db.cursor(dictionary=True, buffered=True)
+    try:
+        cursor.execute(
+            "SELECT content_hash, blob_prefix, num_slides, created_at FROM conversion_cache WHERE content_hash = %s",
+            (content_hash,)
+        )
+        entry = cursor.fetchone()
+
+        if entry and entry['created_at'] < datetime.now() - timedelta(days=CONVERSION_CACHE_MAX_AGE_DAYS):
+            # Too old - treat it as a miss, the next store will replace it
+            entry = None
+
+        if not entry:
+            _count('misses')
+            return None
+
+        cursor.execute(
+            "UPDATE conversion_cache SET hit_count = hit_count + 1, last_used_at = %s WHERE content_hash = %s",
+            (datetime.now(), content_hash)
+        )
+        db.commit()
+        _count('hits')
+        return entry
+    except mysql.connector.Error as e:
+        logger.error(f"Error looking up conversion cache entry {content_hash}: {e}")
+        _count('errors')
+        return None
+    finally:
+        cursor.close()
+
+
+def restore_master_pdf(entry, user_alias, pdf_blob_name):
+    """Copies the cached master PDF to pdf_blob_name. Returns (url, sas_token, expiry)."""
+    return copy_blob(f"{entry['blob_prefix']}/master.pdf", CACHE_ALIAS, pdf_blob_name, user_alias)
+
+
+def restore_slides(entry, user_alias, pdf_id, db, progress=None):
+    """
+    Copies the cached slide PDFs and thumbnails into the user's folders for pdf_id
+    and records them in the slide_file and thumbnail tables, exactly as
+    convert_pdf_to_slides_and_thumbnails would have.
+
+    Returns the number of slides restored.
+    """
+    num_slides = entry['num_slides'] or 0
+    prefix = entry['blob_prefix']
+    cursor = db.cursor()
+    try:
+        if progress is not None:
+            progress["total"] = num_slides
+            progress["status"] = "restoring_cached_slides"
+
+        # Lazily made slide PDFs (LAZY_SLIDE_PDFS) may not be in the cache, those
+        # get their row now and are made from the master PDF when first needed
+        cached_files = list_blob_sizes(f"{prefix}/")
+
+        slide_rows = []
+        for slide_number in range(1, num_slides + 1):
+            slide_blob_name = f"{user_alias}/slide_pdfs/{pdf_id}/slide_{slide_number}.pdf"
+            if f"{prefix}/slide_{slide_number}.pdf" in cached_files:
+                slide_url, slide_sas_token, slide_sas_token_expiry = copy_blob(
+                    f"{prefix}/slide_{slide_number}.pdf", CACHE_ALIAS, slide_blob_name, user_alias
+                )
+            else:
+                slide_url, slide_sas_token, slide_sas_token_expiry = reserve_blob(slide_blob_name, user_alias)
+            thumbnail_url, thumbnail_sas_token, thumbnail_sas_token_expiry = copy_blob(
+                f"{prefix}/thumb_{slide_number}.png", CACHE_ALIAS,
+                f"{user_alias}/thumbnails/{pdf_id}/thumb_{slide_number}.png", user_alias
+            )
+            slide_rows.append({
+                'slide_number': slide_number,
+                'slide_url': slide_url,
+                'slide_sas_token': slide_sas_token,
+                'slide_sas_token_expiry': slide_sas_token_expiry,
+                'thumbnail_url': thumbnail_url,
+                'thumbnail_sas_token': thumbnail_sas_token,
+                'thumbnail_sas_token_expiry': thumbnail_sas_token_expiry
+            })
+
+            if progress is not None:
+                progress["current"] = slide_number
+
+        insert_slides(cursor, pdf_id, slide_rows)
+        db.commit()
+        return num_slides
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def invalidate(db, content_hash):
+    """Drops a cache entry and its files, e.g. when restoring from it failed."""
+    cursor = db.cursor()
+    try:
+        delete_blobs_with_prefix(f"{_blob_prefix(content_hash)}/")
+        cursor.execute("DELETE FROM conversion_cache WHERE content_hash = %s", (content_hash,))
+        db.commit()
+    except Exception as e:
+        logger.error(f"Error invalidating conversion cache entry {content_hash}: {e}")
+    finally:
+        cursor.close()
+
+
+def store(content_hash, user_alias, pdf_blob_name, pdf_id, num_slides):
+    """
+    Saves a freshly converted presentation into the cache.
+
+    Meant to run as a background task after the upload response has been sent: it
+    copies the master PDF, slide PDFs and thumbnails into the cache folder, records
+    the entry, then evicts old entries. Uses its own database connection.
+    """
+    if not CONVERSION_CACHE_ENABLED:
+        return
+
+    db = None
+    cursor = None
+    prefix = _blob_prefix(content_hash)
+    try:
+        copy_blob(pdf_blob_name, user_alias, f"{prefix}/master.pdf", CACHE_ALIAS)
+
+        # Slides are optional - if any of them fail we still cache the master PDF,
+        # which on its own saves the LibreOffice step
+        cached_slides = num_slides
+        try:
+            # Only the slide PDFs that exist - with LAZY_SLIDE_PDFS there may be none
+            slide_pdfs = list_blob_sizes(f"{user_alias}/slide_pdfs/{pdf_id}/")
+            for slide_number in range(1, num_slides + 1):
+                slide_blob_name = f"{user_alias}/slide_pdfs/{pdf_id}/slide_{slide_number}.pdf"
+                if slide_blob_name in slide_pdfs:
+                    copy_blob(slide_blob_name, user_alias, f"{prefix}/slide_{slide_number}.pdf", CACHE_ALIAS)
+                copy_blob(f"{user_alias}/thumbnails/{pdf_id}/thumb_{slide_number}.png", user_alias,
+                          f"{prefix}/thumb_{slide_number}.png", CACHE_ALIAS)
+        except Exception as slide_err:
+            logger.warning(f"Caching only the master PDF for {content_hash}: {slide_err}")
+            cached_slides = 0
+
+        size_kb = round(sum(list_blob_sizes(f"{prefix}/").values()) / 1024)
+
+        db = get_connection()
+        cursor = db.cursor()
+        cursor.execute(
+            """
+            INSERT INTO conversion_cache (content_hash, blob_prefix, num_slides, size_kb, created_at, last_used_at)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE blob_prefix = VALUES(blob_prefix), num_slides = VALUES(num_slides),
+                size_kb = VALUES(size_kb), created_at = VALUES(created_at), last_used_at = VALUES(last_used_at)
+            """,
+            (content_hash, prefix, cached_slides, size_kb, datetime.now(), datetime.now())
+        )
+        db.commit()
+        _count('stores')
+        logger.info(f"Stored conversion cache entry {content_hash} ({cached_slides} slides, {size_kb} KB)")
+
+        evict(db)
+    except Exception as e:
+        logger.error(f"Error storing conversion cache entry {content_hash}: {e}")
+        _count('errors')
+    finally:
+        if cursor:
+            cursor.close()
+        if db:
+            db.close()
+
+
+def evict(db):
+    """
+    Removes entries older than CONVERSION_CACHE_MAX_AGE_DAYS, then removes the least
+    recently used entries until the cache fits in CONVERSION_CACHE_MAX_MB.
+    """
+    cursor = db.cursor(dictionary=True, buffered=True)
+    try:
+        cursor.execute(
+            "SELECT content_hash FROM conversion_cache WHERE created_at < %s",
+            (datetime.now() - timedelta(days=CONVERSION_CACHE_MAX_AGE_DAYS),)
+        )
+        to_evict = [row['content_hash'] for row in cursor.fetchall()]
+
+        cursor.execute("SELECT content_hash, size_kb FROM conversion_cache ORDER BY last_used_at DESC")
+        total_kb = 0
+        for row in cursor.fetchall():
+            if row['content_hash'] in to_evict:
+                continue
+            total_kb += row['size_kb'] or 0
+            if total_kb > CONVERSION_CACHE_MAX_MB * 1024:
+                to_evict.append(row['content_hash'])
+
+        for content_hash in to_evict:
+            delete_blobs_with_prefix(f"{_blob_prefix(content_hash)}/")
+            cursor.execute("DELETE FROM conversion_cache WHERE content_hash = %s", (content_hash,))
+            db.commit()
+            _count('evictions')
+            logger.info(f"Evicted conversion cache entry {content_hash}")
+    finally:
+        cursor.close()
+
+
+def get_cache_stats(db, counters=None):
+    """
+    Returns the hit/miss counters plus the current size of the cache, for admins.
+    counters defaults to this process's, see core/worker_status.py for the workers'.
+    """
+    cursor = db.cursor(dictionary=True)
+    try:
+        cursor.execute(
+            "SELECT COUNT(*) AS entries, COALESCE(SUM(size_kb), 0) AS size_kb, COALESCE(SUM(hit_count), 0) AS lifetime_hits FROM conversion_cache"
+        )
+        totals = cursor.fetchone()
+    finally:
+        cursor.close()
+
+    stats = counters if counters is not None else get_counters()
+    lookups = stats['hits'] + stats['misses']
+
+    return {
+        'enabled': CONVERSION_CACHE_ENABLED,
+        'max_mb': CONVERSION_CACHE_MAX_MB,
+        'max_age_days': CONVERSION_CACHE_MAX_AGE_DAYS,
+        'entries': totals['entries'],
+        'size_mb': round(float(totals['size_kb']) / 1024, 2),
+        'lifetime_hits': int(totals['lifetime_hits']),
+        'hit_ratio': round(stats['hits'] / lookups, 3) if lookups else 0,
+        **stats
+    }
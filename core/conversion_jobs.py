@@ -0,0 +1,561 @@
+import os
+import time
+import uuid
+import shutil
+import asyncio
+import logging
+import tempfile
+from datetime import datetime, timedelta
+
+import psutil
+import mysql.connector
+
+from core import conversion_cache
+from core.main_converter import (
+    convert_pptx_file_to_pdf, convert_pdf_to_slides_and_thumbnails, conversion_progress, CONVERSION_WORKSPACE_DIR
+)
+from core.qr_generator import generate_qr_async
+from helpers import async_blob_op
+from database_op.database import get_connection
+from database_op.async_database import DictCursor
+from database_op.user_usage import add_presentation, remove_presentation
+
+logger = logging.getLogger(__name__)
+
+# Conversion jobs
+#
+# Uploads don't convert anything themselves any more. The web tier stages the .pptx
+# in blob storage (user_alias/uploads/<uuid>.pptx) and inserts a row into the
+# conversion_job table. Worker processes (app/worker.py) claim queued jobs with
+# SELECT ... FOR UPDATE SKIP LOCKED, so any number of workers on any number of
+# machines can share the queue without ever picking up the same job twice.
+#
+# Job status goes queued -> running -> complete / error. While running, the stage
+# column mirrors the conversion_progress status. A running job also refreshes its
+# heartbeat every CONVERSION_JOB_HEARTBEAT_SECONDS, however long a stage takes.
+# Every update a worker makes to its job is guarded by the worker_id and attempt
+# it claimed it with, so a worker whose job was handed to someone else can't
+# overwrite the new owner's progress or finish the job itself.
+
+# A running job whose heartbeat is older than this is assumed to belong to a crashed
+# worker and is handed to another worker
+CONVERSION_JOB_TIMEOUT_SECONDS = int(os.getenv("CONVERSION_JOB_TIMEOUT_SECONDS", "1800"))
+# How often a running job refreshes its heartbeat, well inside the timeout
+CONVERSION_JOB_HEARTBEAT_SECONDS = CONVERSION_JOB_TIMEOUT_SECONDS / 6
+# How many times a job may be claimed before we give up on it
+CONVERSION_JOB_MAX_ATTEMPTS = int(os.getenv("CONVERSION_JOB_MAX_ATTEMPTS", "3"))
+# How long an idle worker waits before checking the queue again
+CONVERSION_WORKER_POLL_SECONDS = float(os.getenv("CONVERSION_WORKER_POLL_SECONDS", "2"))
+# How often a running job samples the worker's memory use for the job log
+RSS_SAMPLE_SECONDS = 0.5
+
+# Jobs this worker process is running right now. The memory figures in the job log
+# are for the whole process, so they say how many jobs were sharing it.
+_running_jobs = 0
+
+
+async def enqueue_conversion_job(db, user_id, upload_blob_name, original_filename, file_size_kb):
+    """
+    Queues a staged upload for conversion and returns the new job id. db is a
+    connection from the async pool, which commits the insert by itself.
+    """
+    async with db.cursor() as cursor:
+        await cursor.execute(
+            """
+            INSERT INTO conversion_job (user_id, status, stage, upload_blob_name, original_filename, file_size_kb, created_at)
+            VALUES (%s, 'queued', 'queued', %s, %s, %s, %s)
+            """,
+            (user_id, upload_blob_name, original_filename, file_size_kb, datetime.now())
+        )
+        return cursor.lastrowid
+
+
+async def count_pending_jobs(db, user_id):
+    """
+    Counts the user's uploads that are still waiting for or going through
+    conversion. db is a connection from the async pool.
+    """
+    async with db.cursor(DictCursor) as cursor:
+        await cursor.execute(
+            "SELECT COUNT(*) as count FROM conversion_job WHERE user_id = %s AND status IN ('queued', 'running')",
+            (user_id,)
+        )
+        result = await cursor.fetchone()
+        return result['count'] if result else 0
+
+
+async def get_pending_jobs(db, user_id):
+    """
+    Returns the user's queued and running jobs, oldest first, for the dashboard.
+    db is a connection from the async pool (database_op/async_database.py).
+    """
+    async with db.cursor(DictCursor) as cursor:
+        await cursor.execute(
+            """
+            SELECT job_id, status, stage, original_filename, created_at
+            FROM conversion_job
+            WHERE user_id = %s AND status IN ('queued', 'running')
+            ORDER BY created_at
+            """,
+            (user_id,)
+        )
+        return await cursor.fetchall()
+
+
+def get_job(db, job_id, user_id):
+    """Returns a job if it belongs to the user, otherwise None."""
+    cursor = db.cursor(dictionary=True, buffered=True)
+    try:
+        cursor.execute(
+            """
+            SELECT job_id, status, stage, original_filename, pdf_id, error_message, created_at, finished_at
+            FROM conversion_job
+            WHERE job_id = %s AND user_id = %s
+            """,
+            (job_id, user_id)
+        )
+        return cursor.fetchone()
+    finally:
+        cursor.close()
+
+
+def claim_next_job(db, worker_id):
+    """
+    Claims the oldest queued job (or a job abandoned by a crashed worker).
+
+    SKIP LOCKED makes concurrent workers step over rows another worker is in the
+    middle of claiming, instead of blocking on them. Returns the job or None. The
+    job's worker_id and attempt identify this claim for the later updates.
+    """
+    cursor = db.cursor(dictionary=True, buffered=True)
+    try:
+        stale_before = datetime.now() - timedelta(seconds=CONVERSION_JOB_TIMEOUT_SECONDS)
+        cursor.execute(
+            """
+            SELECT job_id, user_id, upload_blob_name, original_filename, file_size_kb, attempts
+            FROM conversion_job
+            WHERE status = 'queued'
+               OR (status = 'running' AND heartbeat_at < %s AND attempts < %s)
+            ORDER BY created_at
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+            """,
+            (stale_before, CONVERSION_JOB_MAX_ATTEMPTS)
+        )
+        job = cursor.fetchone()
+        if not job:
+            db.commit()
+            return None
+
+        now = datetime.now()
+        cursor.execute(
+            """
+            UPDATE conversion_job
+            SET status = 'running', stage = 'claimed', worker_id = %s, attempts = attempts + 1,
+                claimed_at = %s, heartbeat_at = %s
+            WHERE job_id = %s
+            """,
+            (worker_id, now, now, job['job_id'])
+        )
+        db.commit()
+        job['worker_id'] = worker_id
+        job['attempt'] = job['attempts'] + 1
+        return job
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def fail_abandoned_jobs(db):
+    """Marks running jobs that have used up all their attempts as failed."""
+    cursor = db.cursor()
+    try:
+        stale_before = datetime.now() - timedelta(seconds=CONVERSION_JOB_TIMEOUT_SECONDS)
+        cursor.execute(
+            """
+            UPDATE conversion_job
+            SET status = 'error', stage = 'error', error_message = 'The conversion worker stopped responding.', finished_at = %s
+            WHERE status = 'running' AND heartbeat_at < %s AND attempts >= %s
+            """,
+            (datetime.now(), stale_before, CONVERSION_JOB_MAX_ATTEMPTS)
+        )
+        db.commit()
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+
+def _owns_job(cursor, job):
+    # MySQL only counts rows an UPDATE actually changed, so a heartbeat in the same
+    # second as the previous one reports 0 rows while the job is still ours
+    cursor.execute(
+        "SELECT 1 FROM conversion_job WHERE job_id = %s AND worker_id = %s AND attempts = %s AND status = 'running'",
+        (job['job_id'], job['worker_id'], job['attempt'])
+    )
+    return cursor.fetchone() is not None
+
+
+def update_job_stage(db, job, stage):
+    """
+    Records the job's current stage. Also refreshes its heartbeat.
+
+    Returns False if the job has been handed to another worker in the meantime.
+    """
+    cursor = db.cursor()
+    try:
+        cursor.execute(
+            """
+            UPDATE conversion_job SET stage = %s, heartbeat_at = %s
+            WHERE job_id = %s AND worker_id = %s AND attempts = %s AND status = 'running'
+            """,
+            (stage, datetime.now(), job['job_id'], job['worker_id'], job['attempt'])
+        )
+        owned = cursor.rowcount > 0 or _owns_job(cursor, job)
+        db.commit()
+        return owned
+    except mysql.connector.Error as e:
+        # A database hiccup doesn't mean the job was lost, the next update will tell
+        logger.error(f"Error updating stage of conversion job {job['job_id']}: {e}")
+        return True
+    finally:
+        cursor.close()
+
+
+def heartbeat_job(job):
+    """
+    Refreshes a running job's heartbeat on a connection of its own, so it can run
+    while the job is busy with its own connection. Returns False if the job has
+    been handed to another worker.
+    """
+    db = get_connection()
+    try:
+        cursor = db.cursor()
+        try:
+            cursor.execute(
+                """
+                UPDATE conversion_job SET heartbeat_at = %s
+                WHERE job_id = %s AND worker_id = %s AND attempts = %s AND status = 'running'
+                """,
+                (datetime.now(), job['job_id'], job['worker_id'], job['attempt'])
+            )
+            owned = cursor.rowcount > 0 or _owns_job(cursor, job)
+            db.commit()
+            return owned
+        finally:
+            cursor.close()
+    finally:
+        db.close()
+
+
+def finish_job(db, job, status, pdf_id=None, error_message=None):
+    """
+    Marks a job as complete or failed. Returns False, and leaves the job alone, if
+    it has been handed to another worker in the meantime.
+    """
+    cursor = db.cursor()
+    try:
+        cursor.execute(
+            """
+            UPDATE conversion_job
+            SET status = %s, stage = %s, pdf_id = %s, error_message = %s, finished_at = %s
+            WHERE job_id = %s AND worker_id = %s AND attempts = %s AND status = 'running'
+            """,
+            (status, status, pdf_id, error_message, datetime.now(), job['job_id'], job['worker_id'], job['attempt'])
+        )
+        db.commit()
+        return cursor.rowcount > 0
+    finally:
+        cursor.close()
+
+
+async def _keep_job_alive(job):
+    # Refreshes the job's heartbeat for as long as it runs. Stages like the PPTX to
+    # PDF conversion can take longer than the timeout on their own.
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(CONVERSION_JOB_HEARTBEAT_SECONDS)
+        try:
+            if not await loop.run_in_executor(None, heartbeat_job, job):
+                # The next stage update notices too, and stops the job there
+                logger.warning(f"Conversion job {job['job_id']} was handed to another worker while {job['worker_id']} was running it")
+                return
+        except Exception as e:
+            logger.error(f"Error refreshing heartbeat of conversion job {job['job_id']}: {e}")
+
+
+async def _watch_peak_rss(rss_usage):
+    # Samples the worker process's resident memory while a job runs, along with how
+    # many jobs were running in it at the time. This is a process-wide figure, not
+    # the job's own use, since every slot shares the process. Jobs never hold the
+    # whole upload or PDF in memory, so it should stay roughly flat whatever the
+    # size of the decks. Rendering happens in separate processes and isn't counted.
+    process = psutil.Process()
+    while True:
+        rss_usage["peak"] = max(rss_usage["peak"], process.memory_info().rss)
+        rss_usage["jobs"] = max(rss_usage["jobs"], _running_jobs)
+        await asyncio.sleep(RSS_SAMPLE_SECONDS)
+
+
+async def run_conversion_job(job, db):
+    """
+    Runs the whole conversion pipeline for a claimed job:
+    1. Downloads the staged .pptx into the job's workspace folder.
+    2. Converts PPTX to PDF (or restores it from the conversion cache).
+    3. Uploads the PDF to Azure.
+    4. Converts PDF pages to individual 1-page PDFs and thumbnails.
+    5. Generates the presentation's QR code and records conversion stats.
+
+    Returns the new pdf_id. On failure the half-created presentation is removed and
+    the exception is re-raised for the worker to record.
+    """
+    global _running_jobs
+    job_id = job['job_id']
+    progress_key = f"job_{job_id}"
+    conversion_progress[progress_key] = {"total": 0, "current": 0, "status": "initializing"}
+
+    loop = asyncio.get_event_loop()
+
+    async def set_stage(stage):
+        conversion_progress[progress_key]["status"] = stage
+        if not await loop.run_in_executor(None, update_job_stage, db, job, stage):
+            raise Exception("The conversion job was handed to another worker")
+
+    pdf_id = None
+    cursor = None
+    workspace_dir = None
+    start_time_conversion = time.time()  # Start timing for conversion stats
+    _running_jobs += 1
+    rss_usage = {"peak": 0, "jobs": 0}
+    rss_watcher = asyncio.create_task(_watch_peak_rss(rss_usage))
+    heartbeat = asyncio.create_task(_keep_job_alive(job))
+    try:
+        cursor = db.cursor(dictionary=True, buffered=True)
+        cursor.execute("SELECT user_id, email, alias FROM user WHERE user_id = %s", (job['user_id'],))
+        user_data = cursor.fetchone()
+        cursor.close(); cursor = None
+        if not user_data:
+            raise Exception("The user who uploaded this presentation no longer exists")
+        user_id = user_data['user_id']
+        user_alias = user_data['alias']
+
+        original_filename = job['original_filename']
+        sanitized_filename = original_filename.replace(" ", "_").replace(".pptx", ".pdf")
+        file_size_kb = job['file_size_kb']
+
+        # Everything this job puts on disk lives in its own workspace folder
+        workspace_dir = tempfile.mkdtemp(prefix=f"job_{job_id}_", dir=CONVERSION_WORKSPACE_DIR)
+        pptx_path = os.path.join(workspace_dir, "upload.pptx")
+
+        await set_stage("downloading_upload")
+        await async_blob_op.download_blob_to_file(job['upload_blob_name'], user_alias, pptx_path)
+
+        pdf_blob_name = f"{user_alias}/pdf/{sanitized_filename}"
+
+        # Check whether this exact file has been converted before
+        content_hash = await loop.run_in_executor(None, conversion_cache.hash_pptx_file, pptx_path)
+        cache_entry = await loop.run_in_executor(None, conversion_cache.lookup, db, content_hash)
+        if cache_entry:
+            logger.info(f"Conversion cache hit for {original_filename} ({content_hash})")
+            await set_stage("restoring_cached_pdf")
+            try:
+                pdf_blob_url, sas_token_pdf, sas_token_expiry = await loop.run_in_executor(
+                    None, conversion_cache.restore_master_pdf, cache_entry, user_alias, pdf_blob_name
+                )
+            except Exception as cache_err:
+                logger.warning(f"Couldn't restore cached PDF {content_hash}, converting instead: {cache_err}")
+                await loop.run_in_executor(None, conversion_cache.invalidate, db, content_hash)
+                cache_entry = None
+
+        pdf_path = None
+        if not cache_entry:
+            await set_stage("converting_to_pdf")
+            pdf_path = await convert_pptx_file_to_pdf(pptx_path)
+
+            await set_stage("uploading_pdf")
+            # Streamed from disk, in parallel blocks for big decks
+            with open(pdf_path, "rb") as pdf_file:
+                pdf_blob_url, sas_token_pdf, sas_token_expiry = await async_blob_op.upload_to_blob(
+                    pdf_blob_name, pdf_file, "application/pdf", user_alias
+                )
+
+        cursor = db.cursor(dictionary=True, buffered=True)
+        pdf_unique_code = str(uuid.uuid4())
+        cursor.execute(
+            "INSERT INTO pdf (user_id, original_filename, url, sas_token, sas_token_expiry, file_size_kb, unique_code, content_hash) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
+            (user_id, original_filename, pdf_blob_url, sas_token_pdf, sas_token_expiry, file_size_kb, pdf_unique_code, content_hash)
+        )
+        pdf_id = cursor.lastrowid
+        add_presentation(cursor, user_id, file_size_kb)
+        db.commit()
+        cursor.close(); cursor = None
+
+        # From here on the slide splitter tracks progress under the pdf_id
+        conversion_progress[str(pdf_id)] = conversion_progress.pop(progress_key)
+        progress_key = str(pdf_id)
+        await set_stage("processing_slides")
+
+        num_slides = 0
+        if cache_entry and cache_entry['num_slides']:
+            try:
+                num_slides = await loop.run_in_executor(
+                    None, conversion_cache.restore_slides, cache_entry, user_alias, pdf_id, db, conversion_progress[progress_key]
+                )
+            except Exception as cache_err:
+                logger.warning(f"Couldn't restore cached slides {content_hash}, splitting the PDF instead: {cache_err}")
+                num_slides = 0
+
+        store_in_cache = False
+        if not num_slides:
+            # Freshly converted PDFs are still on disk, so there's no need to fetch them back
+            num_slides = await convert_pdf_to_slides_and_thumbnails(pdf_blob_name, user_alias, pdf_id, sas_token_pdf, db, pdf_path=pdf_path)
+            store_in_cache = True
+
+        cursor = db.cursor()
+        cursor.execute("UPDATE pdf SET num_slides = %s WHERE pdf_id = %s", (num_slides, pdf_id))
+        db.commit()
+        cursor.close(); cursor = None
+
+        await set_stage("generating_pdf_qr")
+        try:
+            pdf_qr_code_url, pdf_qr_code_sas_token, pdf_qr_code_sas_token_expiry = await generate_qr_async(
+                user_alias=user_alias, pdf_id=pdf_id, set_name="full_pdf", pdf_unique_code=pdf_unique_code
+            )
+            cursor = db.cursor()
+            cursor.execute(
+                "UPDATE pdf SET pdf_qrcode_url = %s, pdf_qrcode_sas_token = %s, pdf_qrcode_sas_token_expiry = %s WHERE pdf_id = %s",
+                (pdf_qr_code_url, pdf_qr_code_sas_token, pdf_qr_code_sas_token_expiry, pdf_id)
+            )
+            db.commit()
+            cursor.close(); cursor = None
+            logger.info(f"PDF QR code generated for PDF ID: {pdf_id}")
+        except Exception as qr_err:
+            logger.error(f"Error generating PDF QR code for PDF ID {pdf_id}: {qr_err}")
+
+        conversion_progress[progress_key]["status"] = "complete"
+
+        # Record conversion stats
+        conversion_duration_seconds = time.time() - start_time_conversion
+        identifier_for_stats = user_data.get('email') or user_data.get('alias', 'unknown_user')
+        stat_cursor = None
+        try:
+            stat_cursor = db.cursor()
+            stat_cursor.execute(
+                """
+                INSERT INTO conversion_stats (user_email, original_filename, upload_size_kb, num_slides, conversion_duration_seconds)
+                VALUES (%s, %s, %s, %s, %s)
+                """,
+                (identifier_for_stats, original_filename, file_size_kb, num_slides, conversion_duration_seconds)
+            )
+            db.commit()
+            logger.info(f"Conversion stats saved for {original_filename} by {identifier_for_stats}. Duration: {conversion_duration_seconds:.2f}s")
+        except Exception as stat_err:
+            # Do not fail the whole job if stats saving fails, just log it.
+            logger.error(f"Error saving conversion_stats for {original_filename} by {identifier_for_stats}: {stat_err}")
+        finally:
+            if stat_cursor:
+                stat_cursor.close()
+
+        # Remember this conversion for next time
+        if store_in_cache:
+            await loop.run_in_executor(
+                None, conversion_cache.store, content_hash, user_alias, pdf_blob_name, pdf_id, num_slides
+            )
+
+        # The staged upload isn't needed any more
+        try:
+            await async_blob_op.delete_blob(job['upload_blob_name'], user_alias)
+        except Exception as cleanup_err:
+            logger.warning(f"Couldn't delete staged upload {job['upload_blob_name']}: {cleanup_err}")
+
+        return pdf_id
+    except Exception:
+        if progress_key in conversion_progress:
+            conversion_progress[progress_key]["status"] = "error"
+        try:
+            db.rollback()
+            if pdf_id:
+                # Don't leave a half-converted presentation behind
+                cleanup_cursor = db.cursor(dictionary=True)
+                remove_presentation(cleanup_cursor, pdf_id)
+                cleanup_cursor.execute("DELETE FROM pdf WHERE pdf_id = %s", (pdf_id,))
+                db.commit()
+                cleanup_cursor.close()
+        except Exception as rollback_err:
+            logger.error(f"Error cleaning up after failed conversion job {job_id}: {rollback_err}")
+        raise
+    finally:
+        _running_jobs -= 1
+        rss_watcher.cancel()
+        heartbeat.cancel()
+        logger.info(
+            f"Worker process memory during conversion job {job_id}: peak RSS {rss_usage['peak'] / (1024 * 1024):.1f} MB "
+            f"with up to {rss_usage['jobs']} job(s) running in the process"
+        )
+        if workspace_dir:
+            shutil.rmtree(workspace_dir, ignore_errors=True)
+        if cursor:
+            try:
+                cursor.close()
+            except Exception as cursor_err:
+                logger.error(f"Error closing cursor: {cursor_err}")
+
+
+async def process_next_job(worker_id):
+    """
+    Claims and runs one job. Returns False if the queue was empty.
+
+    Each job gets its own database connection for its whole run, and gives it back
+    to the pool afterwards.
+    """
+    loop = asyncio.get_event_loop()
+    db = await loop.run_in_executor(None, get_connection)
+    try:
+        job = await loop.run_in_executor(None, claim_next_job, db, worker_id)
+        if not job:
+            return False
+
+        logger.info(f"Worker {worker_id} claimed conversion job {job['job_id']} ({job['original_filename']}, attempt {job['attempt']})")
+        try:
+            pdf_id = await run_conversion_job(job, db)
+            finished = await loop.run_in_executor(None, finish_job, db, job, 'complete', pdf_id)
+            logger.info(f"Conversion job {job['job_id']} complete, PDF ID {pdf_id}")
+        except Exception as e:
+            logger.error(f"Conversion job {job['job_id']} failed: {e}", exc_info=True)
+            finished = await loop.run_in_executor(None, finish_job, db, job, 'error', None, str(e)[:1000])
+        if not finished:
+            logger.warning(f"Conversion job {job['job_id']} was handed to another worker, leaving it to them")
+        return True
+    finally:
+        db.close()
+
+
+async def worker_slot(worker_id, slot):
+    """Keeps claiming jobs one after another until the worker is stopped."""
+    while True:
+        try:
+            found_job = await process_next_job(f"{worker_id}/{slot}")
+        except Exception as e:
+            logger.error(f"Worker slot {slot} hit an error: {e}", exc_info=True)
+            found_job = False
+
+        if not found_job:
+            await asyncio.sleep(CONVERSION_WORKER_POLL_SECONDS)
+
+
+async def reap_abandoned_jobs():
+    """Periodically gives up on jobs whose workers keep dying on them."""
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            db = await loop.run_in_executor(None, get_connection)
+            try:
+                failed = fail_abandoned_jobs(db)
+                if failed:
+                    logger.warning(f"Marked {failed} abandoned conversion job(s) as failed")
+            finally:
+                db.close()
+        except Exception as e:
+            logger.error(f"Error reaping abandoned conversion jobs: {e}")
+        await asyncio.sleep(60)
@@ -0,0 +1,103 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Secure link resolution cache
+#
+# Every scan of a QR code has to turn its /s/<link_type>/<unique_code> into the file
+# to serve: a JOIN of pdf or set with user. The answer hardly ever changes, so it is
+# kept in memory for SECURE_LINK_CACHE_TTL_SECONDS and hot codes resolve without
+# touching MySQL:
+# - ('pdf', unique_code) -> the pdf row (pdf_id, url, original_filename, alias)
+# - ('set', unique_code) -> the set row (set_id, pdf_id, url, name, alias)
+#
+# Only the stored URL is cached, never a signed link - those are made when needed
+# (helpers/signed_urls.py).
+#
+# Deleting a presentation (and its sets) or editing a set drops the entries
+# involved straight away in this process. Other web processes notice at the latest
+# when their entry expires, so the TTL is also the longest a deleted link can keep
+# working elsewhere. Codes that don't resolve aren't cached.
+SECURE_LINK_CACHE_TTL_SECONDS = float(os.getenv("SECURE_LINK_CACHE_TTL_SECONDS", "60"))
+SECURE_LINK_CACHE_MAX_ENTRIES = int(os.getenv("SECURE_LINK_CACHE_MAX_ENTRIES", "10000"))
+
+
+class LinkCache:
+    """TTL'd LRU of resolved secure links, with invalidation by presentation and set."""
+
+    def __init__(self, ttl_seconds=SECURE_LINK_CACHE_TTL_SECONDS, max_entries=SECURE_LINK_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'expired': 0, 'invalidations': 0}
+
+    def get(self, link_type, unique_code):
+        """Returns the cached resolution of a link, or None."""
+        if self.ttl_seconds <= 0:
+            return None
+        key = (link_type, unique_code)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            expires_at, resource = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self._stats['expired'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return dict(resource)
+
+    def put(self, link_type, unique_code, resource):
+        """
+        Caches a resolved link: the row from the secure link lookup, with the file's
+        stored URL. resource must have pdf_id (and set_id for sets), which is what
+        invalidation goes by.
+        """
+        if self.ttl_seconds <= 0:
+            return
+        with self._lock:
+            self._entries[(link_type, unique_code)] = (time.monotonic() + self.ttl_seconds, dict(resource))
+            self._entries.move_to_end((link_type, unique_code))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _invalidate_where(self, matches):
+        with self._lock:
+            keys = [key for key, (_, resource) in self._entries.items() if matches(key[0], resource)]
+            for key in keys:
+                del self._entries[key]
+            self._stats['invalidations'] += len(keys)
+        return len(keys)
+
+    def invalidate_pdf(self, pdf_id):
+        """Drops a presentation's link and the links of all its sets, e.g. when it is deleted."""
+        dropped = self._invalidate_where(lambda link_type, resource: resource.get('pdf_id') == pdf_id)
+        if dropped:
+            logger.info(f"Dropped {dropped} cached secure links of PDF {pdf_id}")
+
+    def invalidate_set(self, set_id):
+        """Drops a set's link, e.g. when the set is changed or deleted."""
+        self._invalidate_where(lambda link_type, resource: link_type == 'set' and resource.get('set_id') == set_id)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            entries = len(self._entries)
+        lookups = stats['hits'] + stats['misses'] + stats['expired']
+        return {
+            'entries': entries,
+            'ttl_seconds': self.ttl_seconds,
+            'hit_ratio': round(stats['hits'] / lookups, 3) if lookups else 0,
+            **stats
+        }
+
+
+link_cache = LinkCache()
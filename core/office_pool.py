@@ -0,0 +1,355 @@
+import os
+import time
+import queue
+import socket
+import shutil
+import logging
+import tempfile
+import threading
+import subprocess
+
+# The UNO bridge ships with LibreOffice (python3-uno on Linux, or LibreOffice's own
+# bundled Python on Windows). If it isn't importable we simply run without the warm
+# pool and every conversion falls back to a cold-started soffice process.
+try:
+    import uno
+    from com.sun.star.beans import PropertyValue
+except ImportError:
+    uno = None
+    PropertyValue = None
+
+logger = logging.getLogger(__name__)
+
+# Find LibreOffice on this system
+SOFFICE_PATH = os.getenv("SOFFICE_PATH", r'C:\Program Files\LibreOffice\program\soffice.exe')
+
+# Pool configuration
+# OFFICE_POOL_SIZE - how many warm soffice listeners we keep running (0 disables the pool)
+# OFFICE_POOL_BASE_PORT - first local port used, worker N listens on base + N
+# OFFICE_RECYCLE_AFTER_JOBS - restart a worker after this many conversions to keep memory in check
+# OFFICE_STARTUP_TIMEOUT - seconds to wait for a fresh listener to accept connections
+# OFFICE_HEALTH_CHECK_INTERVAL - seconds between health checks of idle workers
+OFFICE_POOL_SIZE = int(os.getenv("OFFICE_POOL_SIZE", "2"))
+OFFICE_POOL_BASE_PORT = int(os.getenv("OFFICE_POOL_BASE_PORT", "2002"))
+OFFICE_RECYCLE_AFTER_JOBS = int(os.getenv("OFFICE_RECYCLE_AFTER_JOBS", "50"))
+OFFICE_STARTUP_TIMEOUT = int(os.getenv("OFFICE_STARTUP_TIMEOUT", "60"))
+OFFICE_HEALTH_CHECK_INTERVAL = int(os.getenv("OFFICE_HEALTH_CHECK_INTERVAL", "30"))
+
+
+def _to_file_url(path):
+    """Turns a local path into a file:// URL that LibreOffice understands."""
+    if uno is not None:
+        return uno.systemPathToFileUrl(os.path.abspath(path))
+    normalized = os.path.abspath(path).replace('\\', '/')
+    return 'file:///' + normalized.lstrip('/')
+
+
+class OfficeWorker:
+    """
+    A single long-lived headless LibreOffice process listening for UNO connections
+    on a local socket.
+
+    Each worker keeps its own user profile for its whole life, so the expensive
+    first-start profile creation only happens when the worker is (re)started.
+    """
+
+    def __init__(self, index, port):
+        self.index = index
+        self.port = port
+        self.process = None
+        self.profile_dir = os.path.join(tempfile.gettempdir(), f"slidepull_office_{port}")
+        self.jobs_done = 0
+        self.restarts = 0
+        self.busy = False
+        self.started_at = None
+        self.last_error = None
+        self._hung = False
+
+    def start(self):
+        """Starts the soffice listener and waits until it accepts connections."""
+        os.makedirs(self.profile_dir, exist_ok=True)
+        profile_url = _to_file_url(self.profile_dir)
+
+        cmd = [
+            SOFFICE_PATH,
+            '--headless',
+            '--invisible',
+            '--nologo',
+            '--nodefault',
+            '--norestore',
+            '--nolockcheck',
+            f'--accept=socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext',
+            f'-env:UserInstallation={profile_url}'
+        ]
+
+        logger.info(f"Starting warm LibreOffice worker {self.index} on port {self.port}")
+        self.process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.jobs_done = 0
+        self._hung = False
+
+        deadline = time.time() + OFFICE_STARTUP_TIMEOUT
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise Exception(f"LibreOffice worker {self.index} exited during startup with code {self.process.returncode}")
+            if self._port_open():
+                self.started_at = time.time()
+                logger.info(f"Warm LibreOffice worker {self.index} is ready (pid {self.process.pid})")
+                return
+            time.sleep(0.25)
+
+        self.stop()
+        raise Exception(f"LibreOffice worker {self.index} did not start listening within {OFFICE_STARTUP_TIMEOUT} seconds")
+
+    def stop(self):
+        """Stops the soffice process, killing it if it doesn't exit politely."""
+        if not self.process:
+            return
+        try:
+            if self.process.poll() is None:
+                self.process.terminate()
+                try:
+                    self.process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    self.process.kill()
+                    self.process.wait(timeout=10)
+        except Exception as e:
+            logger.warning(f"Error stopping LibreOffice worker {self.index}: {e}")
+        finally:
+            self.process = None
+
+    def restart(self):
+        """Throws away the current process (and its profile) and starts a fresh one."""
+        logger.info(f"Restarting LibreOffice worker {self.index} after {self.jobs_done} jobs")
+        self.stop()
+        shutil.rmtree(self.profile_dir, ignore_errors=True)
+        self.restarts += 1
+        self.start()
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def is_healthy(self):
+        """A worker is healthy when its process is running and its socket accepts connections."""
+        return self.is_alive() and self._port_open()
+
+    def _port_open(self):
+        try:
+            with socket.create_connection(("127.0.0.1", self.port), timeout=2):
+                return True
+        except OSError:
+            return False
+
+    def _kill_hung(self):
+        # Called by the watchdog timer when a conversion runs past its timeout.
+        # Killing the process makes the blocked UNO call fail straight away.
+        self._hung = True
+        logger.error(f"LibreOffice worker {self.index} hung, killing pid {self.process.pid if self.process else '?'}")
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+
+    def convert(self, input_path, output_path, timeout):
+        """
+        Converts a presentation to PDF using this worker's running LibreOffice instance.
+
+        A watchdog kills the worker if the conversion runs past the timeout, so a
+        single bad deck can never wedge the worker forever.
+        """
+        watchdog = threading.Timer(timeout, self._kill_hung)
+        watchdog.start()
+        document = None
+        try:
+            local_context = uno.getComponentContext()
+            resolver = local_context.ServiceManager.createInstanceWithContext(
+                "com.sun.star.bridge.UnoUrlResolver", local_context
+            )
+            context = resolver.resolve(
+                f"uno:socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext"
+            )
+            desktop = context.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", context)
+
+            document = desktop.loadComponentFromURL(
+                _to_file_url(input_path), "_blank", 0, (PropertyValue(Name="Hidden", Value=True),)
+            )
+            if document is None:
+                raise Exception("LibreOffice could not open the presentation")
+
+            document.storeToURL(
+                _to_file_url(output_path), (PropertyValue(Name="FilterName", Value="impress_pdf_Export"),)
+            )
+            self.jobs_done += 1
+        except Exception:
+            if self._hung:
+                raise Exception("The presentation took too long to convert. This may be due to its size or complexity.")
+            raise
+        finally:
+            watchdog.cancel()
+            if document is not None:
+                try:
+                    document.close(True)
+                except Exception:
+                    pass
+
+    def status(self):
+        return {
+            'index': self.index,
+            'port': self.port,
+            'pid': self.process.pid if self.process else None,
+            'alive': self.is_alive(),
+            'busy': self.busy,
+            'jobs_done': self.jobs_done,
+            'restarts': self.restarts,
+            'uptime_seconds': int(time.time() - self.started_at) if self.started_at and self.is_alive() else 0,
+            'last_error': self.last_error
+        }
+
+
+class OfficePool:
+    """
+    A fixed set of warm LibreOffice workers.
+
+    Conversions borrow an idle worker, run on it, and hand it back. Crashed or hung
+    workers are restarted on the spot, workers are recycled after a configurable
+    number of jobs, and a background thread health-checks idle workers.
+    """
+
+    def __init__(self, size=OFFICE_POOL_SIZE, base_port=OFFICE_POOL_BASE_PORT, recycle_after=OFFICE_RECYCLE_AFTER_JOBS):
+        self.size = size
+        self.base_port = base_port
+        self.recycle_after = recycle_after
+        self.workers = []
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+        self._stopping = threading.Event()
+        self._health_thread = None
+
+    @property
+    def enabled(self):
+        return uno is not None and self.size > 0
+
+    def start(self):
+        """Starts all workers and the health check thread. Safe to call more than once."""
+        if not self.enabled:
+            if self.size > 0:
+                logger.info("UNO bridge not available - LibreOffice conversions will cold-start soffice")
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._stopping.clear()
+            for index in range(self.size):
+                worker = OfficeWorker(index, self.base_port + index)
+                try:
+                    worker.start()
+                except Exception as e:
+                    # Keep the worker in the pool anyway, the health check will keep trying
+                    worker.last_error = str(e)
+                    logger.error(f"Could not start LibreOffice worker {index}: {e}")
+                self.workers.append(worker)
+                self._idle.put(worker)
+
+            self._health_thread = threading.Thread(target=self._health_loop, name="office-pool-health", daemon=True)
+            self._health_thread.start()
+            self._started = True
+
+    def shutdown(self):
+        """Stops the health check thread and every worker."""
+        with self._lock:
+            if not self._started:
+                return
+            self._stopping.set()
+            for worker in self.workers:
+                worker.stop()
+            self.workers = []
+            self._idle = queue.Queue()
+            self._started = False
+
+    def convert(self, input_path, output_path, timeout):
+        """
+        Converts input_path to a PDF at output_path on the next free warm worker.
+
+        This blocks, so call it from the libreoffice_pool executor.
+        """
+        if not self._started:
+            self.start()
+
+        try:
+            worker = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise Exception("No LibreOffice worker became available in time")
+
+        worker.busy = True
+        try:
+            if not worker.is_healthy():
+                worker.restart()
+            worker.convert(input_path, output_path, timeout)
+            worker.last_error = None
+        except Exception as e:
+            worker.last_error = str(e)
+            logger.error(f"LibreOffice worker {worker.index} failed: {e}")
+            try:
+                worker.restart()
+            except Exception as restart_error:
+                logger.error(f"Could not restart LibreOffice worker {worker.index}: {restart_error}")
+            raise
+        else:
+            # The PDF is done either way. A worker that didn't come back is restarted
+            # by the health check
+            if self.recycle_after and worker.jobs_done >= self.recycle_after:
+                try:
+                    worker.restart()
+                except Exception as restart_error:
+                    worker.last_error = str(restart_error)
+                    logger.error(f"Could not recycle LibreOffice worker {worker.index}: {restart_error}")
+        finally:
+            worker.busy = False
+            self._idle.put(worker)
+
+    def _health_loop(self):
+        while not self._stopping.wait(OFFICE_HEALTH_CHECK_INTERVAL):
+            # Only idle workers are checked. Taking them off the queue while we look at
+            # them means a conversion can never grab a worker that is mid-restart.
+            idle_workers = []
+            while True:
+                try:
+                    idle_workers.append(self._idle.get_nowait())
+                except queue.Empty:
+                    break
+
+            for worker in idle_workers:
+                if not self._stopping.is_set() and not worker.is_healthy():
+                    logger.warning(f"LibreOffice worker {worker.index} failed its health check")
+                    try:
+                        worker.restart()
+                        worker.last_error = None
+                    except Exception as e:
+                        worker.last_error = str(e)
+                        logger.error(f"Could not restart LibreOffice worker {worker.index}: {e}")
+                self._idle.put(worker)
+
+    def status(self):
+        return {
+            'enabled': self.enabled,
+            'started': self._started,
+            'size': self.size,
+            'recycle_after_jobs': self.recycle_after,
+            'idle_workers': self._idle.qsize(),
+            'workers': [worker.status() for worker in self.workers]
+        }
+
+
+# One pool per process, shared by every conversion
+office_pool = OfficePool()
+
+
+def kill_soffice_processes():
+    """
+    Kills every LibreOffice process on this machine, warm workers included (the
+    pool's health check restarts those).
+    """
+    if os.name == 'posix':  # Linux/Unix
+        subprocess.run(['pkill', 'soffice'], stderr=subprocess.DEVNULL)
+        subprocess.run(['pkill', 'libreoffice'], stderr=subprocess.DEVNULL)
+    elif os.name == 'nt':  # Windows
+        subprocess.run(['taskkill', '/F', '/IM', 'soffice.exe'], stderr=subprocess.DEVNULL)
+        subprocess.run(['taskkill', '/F', '/IM', 'soffice.bin'], stderr=subprocess.DEVNULL)
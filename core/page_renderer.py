@@ -0,0 +1,134 @@
+import os
+import asyncio
+import logging
+import collections
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import fitz  # PyMuPDF
+
+# Page rendering runs in separate processes, so this module is deliberately light:
+# worker processes import it (and only it), which keeps them from setting up
+# database pools or Azure clients of their own.
+
+logger = logging.getLogger(__name__)
+
+# RENDER_WORKERS - number of rendering processes (defaults to the number of CPU cores)
+# RENDER_PAGES_PER_TASK - pages each task handles; every task opens the master PDF once
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(os.cpu_count() or 2)))
+RENDER_PAGES_PER_TASK = int(os.getenv("RENDER_PAGES_PER_TASK", "8"))
+
+# Thumbnail generation settings
+THUMBNAIL_ZOOM = 0.75  # Used when a page has no usable width
+THUMBNAIL_WIDTH_TARGET = 300  # Target width for thumbnail images
+
+_render_pool = None
+
+
+def get_render_pool():
+    """Returns the shared rendering process pool, creating it on first use."""
+    global _render_pool
+    if _render_pool is None:
+        _render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS)
+    return _render_pool
+
+
+def _reset_render_pool():
+    # A crashed rendering process breaks the whole pool, so start a fresh one next time
+    global _render_pool
+    if _render_pool is not None:
+        _render_pool.shutdown(wait=False, cancel_futures=True)
+    _render_pool = None
+
+
+def count_pages(pdf_path):
+    """Returns the number of pages in a PDF on disk."""
+    with fitz.open(pdf_path) as pdf_document:
+        return len(pdf_document)
+
+
+def render_page_range(pdf_path, first_page, last_page, slide_pdfs=True):
+    """
+    Renders pages first_page..last_page (0-based, inclusive) of the PDF at pdf_path.
+
+    For each page this produces a PNG thumbnail and, if slide_pdfs is set, a 1-page
+    PDF. Runs inside a rendering process and returns
+    [(page_number, slide_pdf_bytes or None, thumbnail_bytes), ...] in page order.
+    """
+    results = []
+    pdf_document = fitz.open(pdf_path)
+    try:
+        for page_number in range(first_page, last_page + 1):
+            page = pdf_document.load_page(page_number)
+
+            # 1-page PDF for the slide
+            slide_pdf_bytes = None
+            if slide_pdfs:
+                slide_pdf_doc = fitz.open()  # New empty PDF
+                slide_pdf_doc.insert_pdf(pdf_document, from_page=page_number, to_page=page_number)
+                slide_pdf_bytes = slide_pdf_doc.tobytes(garbage=4, deflate=True, clean=True)  # Use maximum garbage collection
+                slide_pdf_doc.close()
+
+            # Thumbnail scaled to the target width
+            if page.rect.width > 0:
+                scale = THUMBNAIL_WIDTH_TARGET / page.rect.width
+                thumbnail_matrix = fitz.Matrix(scale, scale)
+            else:
+                thumbnail_matrix = fitz.Matrix(THUMBNAIL_ZOOM, THUMBNAIL_ZOOM)
+            thumbnail_bytes = page.get_pixmap(matrix=thumbnail_matrix).tobytes("png")
+
+            results.append((page_number, slide_pdf_bytes, thumbnail_bytes))
+    finally:
+        pdf_document.close()
+    return results
+
+
+async def render_pages(pdf_path, total_pages, slide_pdfs=True):
+    """
+    Renders every page of a PDF in the rendering process pool and yields
+    (page_number, slide_pdf_bytes, thumbnail_bytes) in page order. slide_pdf_bytes
+    is None when slide_pdfs is off.
+
+    Pages are split into ranges of RENDER_PAGES_PER_TASK. Only a couple of ranges
+    per process are in flight at once, so a slow consumer (uploads) never lets
+    rendered pages pile up in memory.
+    """
+    loop = asyncio.get_event_loop()
+    pool = get_render_pool()
+    page_ranges = [
+        (first_page, min(first_page + RENDER_PAGES_PER_TASK, total_pages) - 1)
+        for first_page in range(0, total_pages, RENDER_PAGES_PER_TASK)
+    ]
+    max_in_flight = RENDER_WORKERS * 2
+
+    pending = collections.deque()
+    next_range = 0
+    try:
+        while next_range < len(page_ranges) or pending:
+            while next_range < len(page_ranges) and len(pending) < max_in_flight:
+                first_page, last_page = page_ranges[next_range]
+                pending.append(loop.run_in_executor(pool, render_page_range, pdf_path, first_page, last_page, slide_pdfs))
+                next_range += 1
+
+            # Waiting on the oldest range first keeps the output in page order
+            for rendered_page in await pending.popleft():
+                yield rendered_page
+    except BrokenProcessPool:
+        logger.error("A page rendering process crashed, restarting the rendering pool")
+        _reset_render_pool()
+        raise
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def select_pages(pdf_path, page_numbers):
+    """
+    Builds a new PDF from the given pages (0-based) of the PDF at pdf_path, in the
+    order given, and returns its bytes. Pages may repeat.
+
+    Used to assemble sets straight from the master PDF in one pass.
+    """
+    with fitz.open(pdf_path) as pdf_document:
+        pdf_document.select(page_numbers)
+        return pdf_document.tobytes(garbage=4, deflate=True, clean=True)  # Use maximum garbage collection
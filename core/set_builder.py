@@ -0,0 +1,164 @@
+import os
+import uuid
+import asyncio
+import logging
+import tempfile
+from contextlib import asynccontextmanager
+
+from core.page_renderer import get_render_pool, select_pages
+from helpers import async_blob_op
+from helpers.storage_backend import storage_backend, BlobNotFound
+
+logger = logging.getLogger(__name__)
+
+# Set assembly
+#
+# A set is just some pages of the presentation in a chosen order, so rather than
+# fetching every slide's 1-page PDF we take the pages straight out of the master
+# PDF. Master PDFs are kept in a local folder after the first download, so building
+# several sets from the same deck only downloads it once:
+# - <MASTER_PDF_CACHE_DIR>/<pdf_id>.pdf
+#
+# The folder is trimmed to MASTER_PDF_CACHE_MAX_MB, least recently used first,
+# skipping master PDFs that are being downloaded or read at the time.
+MASTER_PDF_CACHE_DIR = os.getenv("MASTER_PDF_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "slidepull_master_pdfs")
+MASTER_PDF_CACHE_MAX_MB = int(os.getenv("MASTER_PDF_CACHE_MAX_MB", "1024"))
+
+# One download per master PDF at a time, however many sets are being built from it
+_download_locks = {}
+
+# How many callers are downloading or reading each master PDF right now. The
+# entry, and the download lock, go away when the last of them is done.
+_master_pdf_users = {}
+
+# One extraction per lazy slide PDF at a time
+_slide_locks = {}
+
+
+def _master_pdf_path(pdf_id):
+    return os.path.join(MASTER_PDF_CACHE_DIR, f"{pdf_id}.pdf")
+
+
+def _in_use_names():
+    # Runs in the trim's thread, so copy the keys rather than iterate the live dict
+    return {str(pdf_id) for pdf_id in list(_master_pdf_users)}
+
+
+def _trim_master_pdf_cache():
+    try:
+        entries = []
+        for name in os.listdir(MASTER_PDF_CACHE_DIR):
+            if not name.endswith('.pdf'):
+                continue
+            path = os.path.join(MASTER_PDF_CACHE_DIR, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= MASTER_PDF_CACHE_MAX_MB * 1024 * 1024:
+                break
+            if os.path.basename(path)[:-len('.pdf')] in _in_use_names():
+                # A set is being built from it, it still counts towards the total
+                continue
+            os.remove(path)
+            total_size -= size
+            logger.info(f"Removed cached master PDF {path}")
+    except OSError as e:
+        logger.warning(f"Error trimming the master PDF cache: {e}")
+
+
+@asynccontextmanager
+async def _using_master_pdf(pdf_id, pdf_url, user_alias):
+    # Yields the master PDF's local path. The cache trim leaves it alone until the
+    # block is done with it.
+    _master_pdf_users[pdf_id] = _master_pdf_users.get(pdf_id, 0) + 1
+    try:
+        yield await _get_master_pdf(pdf_id, pdf_url, user_alias)
+    finally:
+        _master_pdf_users[pdf_id] -= 1
+        if not _master_pdf_users[pdf_id]:
+            del _master_pdf_users[pdf_id]
+            _download_locks.pop(pdf_id, None)
+
+
+async def _get_master_pdf(pdf_id, pdf_url, user_alias):
+    # Returns the local path of a presentation's master PDF, downloading it into the
+    # cache folder first if it isn't there yet. Only called through _using_master_pdf.
+    path = _master_pdf_path(pdf_id)
+    lock = _download_locks.setdefault(pdf_id, asyncio.Lock())
+    async with lock:
+        if os.path.exists(path):
+            os.utime(path)  # Mark as recently used
+            return path
+
+        os.makedirs(MASTER_PDF_CACHE_DIR, exist_ok=True)
+        partial_path = f"{path}.{uuid.uuid4().hex}.part"
+        try:
+            await async_blob_op.download_blob_to_file(storage_backend.name_from_url(pdf_url), user_alias, partial_path)
+            os.replace(partial_path, path)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+        logger.info(f"Cached master PDF for PDF {pdf_id}")
+
+        await asyncio.get_event_loop().run_in_executor(None, _trim_master_pdf_cache)
+        return path
+
+
+def forget_master_pdf(pdf_id):
+    """Drops the cached master PDF of a presentation, e.g. when it is deleted."""
+    try:
+        os.remove(_master_pdf_path(pdf_id))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"Couldn't remove cached master PDF for PDF {pdf_id}: {e}")
+
+
+async def build_set_from_master(pdf_id, pdf_url, user_alias, slide_numbers):
+    """
+    Builds a set PDF from the presentation's master PDF.
+
+    slide_numbers are 1-based, in display order. The page selection runs in the
+    rendering process pool. Returns the set PDF's bytes.
+    """
+    page_numbers = [slide_number - 1 for slide_number in slide_numbers]
+    async with _using_master_pdf(pdf_id, pdf_url, user_alias) as master_pdf_path:
+        return await asyncio.get_event_loop().run_in_executor(get_render_pool(), select_pages, master_pdf_path, page_numbers)
+
+
+async def get_slide_pdf(pdf_id, pdf_url, user_alias, slide_url, slide_number):
+    """
+    Returns the 1-page PDF of a slide (slide_number is 1-based).
+
+    With LAZY_SLIDE_PDFS the slide PDFs aren't made at upload time, only their
+    slide_file rows are. The first time one is needed it is cut out of the master
+    PDF and saved at slide_url, so later requests just download it.
+    """
+    try:
+        return await async_blob_op.download_blob_url(slide_url)
+    except BlobNotFound:
+        pass
+
+    if not pdf_url:
+        raise BlobNotFound(slide_url)
+
+    lock = _slide_locks.setdefault(slide_url, asyncio.Lock())
+    try:
+        async with lock:
+            # Someone else may have made it while we waited
+            try:
+                return await async_blob_op.download_blob_url(slide_url)
+            except BlobNotFound:
+                pass
+
+            async with _using_master_pdf(pdf_id, pdf_url, user_alias) as master_pdf_path:
+                slide_pdf_bytes = await asyncio.get_event_loop().run_in_executor(
+                    get_render_pool(), select_pages, master_pdf_path, [slide_number - 1]
+                )
+            await storage_backend.put(storage_backend.name_from_url(slide_url), slide_pdf_bytes, "application/pdf")
+            logger.info(f"Extracted slide {slide_number} of PDF {pdf_id} from the master PDF")
+            return slide_pdf_bytes
+    finally:
+        _slide_locks.pop(slide_url, None)
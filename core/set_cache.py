@@ -0,0 +1,192 @@
+import os
+import hashlib
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from database_op.database import get_connection
+from database_op.async_database import DictCursor, Error as AsyncDBError
+from helpers import async_blob_op
+from helpers.blob_op import reserve_blob, delete_blob
+
+logger = logging.getLogger(__name__)
+
+# Set PDF cache
+#
+# The same set gets made over and over: a teacher recreates a set they deleted,
+# colleagues pick the same slides from a shared deck. A set PDF only depends on the
+# presentation's content, the slides picked (in order) and how we write PDFs, so
+# each distinct combination is built and uploaded once and shared by every set
+# that asks for it:
+# - set_cache/<key>.pdf - The set PDF
+#
+# Presentations are identified by pdf.content_hash, the conversion cache key of the
+# uploaded .pptx, so identical decks uploaded by different users share set PDFs too.
+# Presentations from before content hashes were recorded only share with themselves.
+#
+# Cached PDFs that no set points at any more are removed after SET_CACHE_GRACE_HOURS.
+SET_CACHE_ALIAS = "set_cache"
+
+# Bump this whenever set PDFs are written differently (save options, page handling...)
+# so stale entries stop matching.
+SET_PDF_PROFILE = "v1:garbage4-deflate-clean"
+
+SET_CACHE_ENABLED = os.getenv("SET_CACHE_ENABLED", "true").lower() == "true"
+SET_CACHE_GRACE_HOURS = int(os.getenv("SET_CACHE_GRACE_HOURS", "24"))
+
+# Counters since this process started, shown on the admin page
+set_cache_stats = {
+    'hits': 0,
+    'misses': 0,
+    'stores': 0,
+    'evictions': 0,
+    'errors': 0
+}
+_stats_lock = threading.Lock()
+
+
+def _count(name):
+    with _stats_lock:
+        set_cache_stats[name] += 1
+
+
+def set_cache_key(pdf_id, content_hash, slide_numbers):
+    """The cache key of a set: presentation content, ordered slides and output profile."""
+    source = content_hash or f"pdf:{pdf_id}"
+    key = f"{source}|{','.join(str(slide_number) for slide_number in slide_numbers)}|{SET_PDF_PROFILE}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _blob_name(cache_key):
+    return f"{SET_CACHE_ALIAS}/{cache_key}.pdf"
+
+
+async def lookup(db, cache_key):
+    """
+    Looks up a set PDF by cache key. db is a connection from the async pool
+    (database_op/async_database.py).
+
+    Returns (url, sas_token, expiry, size_kb) ready for a new set row, or None.
+    Keeps the hit/miss counters up to date.
+    """
+    if not SET_CACHE_ENABLED:
+        return None
+
+    try:
+        async with db.cursor(DictCursor) as cursor:
+            await cursor.execute("SELECT blob_name, size_kb FROM set_pdf_cache WHERE cache_key = %s", (cache_key,))
+            entry = await cursor.fetchone()
+            if not entry:
+                _count('misses')
+                return None
+
+            await cursor.execute(
+                "UPDATE set_pdf_cache SET hit_count = hit_count + 1, last_used_at = %s WHERE cache_key = %s",
+                (datetime.now(), cache_key)
+            )
+        _count('hits')
+        url, sas_token, sas_token_expiry = reserve_blob(entry['blob_name'], SET_CACHE_ALIAS)
+        return url, sas_token, sas_token_expiry, entry['size_kb']
+    except AsyncDBError as e:
+        logger.error(f"Error looking up set cache entry {cache_key}: {e}")
+        _count('errors')
+        return None
+
+
+async def store(db, cache_key, pdf_content):
+    """
+    Uploads a freshly built set PDF into the cache and records it. db is a
+    connection from the async pool.
+
+    Returns (url, sas_token, expiry) for the set row. If the cache is disabled the
+    caller uploads the set PDF itself, as before.
+    """
+    blob_name = _blob_name(cache_key)
+    url, sas_token, sas_token_expiry = await async_blob_op.upload_to_blob(
+        blob_name=blob_name, file_content=pdf_content, content_type="application/pdf", user_alias=SET_CACHE_ALIAS
+    )
+
+    try:
+        now = datetime.now()
+        async with db.cursor() as cursor:
+            await cursor.execute(
+                """
+                INSERT INTO set_pdf_cache (cache_key, blob_name, size_kb, created_at, last_used_at)
+                VALUES (%s, %s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE size_kb = VALUES(size_kb), last_used_at = VALUES(last_used_at)
+                """,
+                (cache_key, blob_name, round(len(pdf_content) / 1024), now, now)
+            )
+        _count('stores')
+    except AsyncDBError as e:
+        # The set still works, the next identical set just won't find it
+        logger.error(f"Error recording set cache entry {cache_key}: {e}")
+        _count('errors')
+    return url, sas_token, sas_token_expiry
+
+
+def evict():
+    """
+    Removes cached set PDFs that no set uses any more, once they have been unused
+    for SET_CACHE_GRACE_HOURS (so a set being created right now keeps its PDF).
+
+    Meant to run in a thread after a store. Uses its own database connection.
+    Returns how many were removed.
+    """
+    db = None
+    cursor = None
+    evicted = 0
+    try:
+        db = get_connection()
+        cursor = db.cursor(dictionary=True, buffered=True)
+        cursor.execute(
+            """
+            SELECT c.cache_key, c.blob_name
+            FROM set_pdf_cache c
+            WHERE c.last_used_at < %s
+              AND NOT EXISTS (SELECT 1 FROM `set` s WHERE s.pdf_cache_key = c.cache_key)
+            """,
+            (datetime.now() - timedelta(hours=SET_CACHE_GRACE_HOURS),)
+        )
+        for entry in cursor.fetchall():
+            delete_blob(entry['blob_name'], SET_CACHE_ALIAS)
+            cursor.execute("DELETE FROM set_pdf_cache WHERE cache_key = %s", (entry['cache_key'],))
+            db.commit()
+            evicted += 1
+            _count('evictions')
+            logger.info(f"Evicted set cache entry {entry['cache_key']}")
+    except Exception as e:
+        logger.error(f"Error evicting set cache entries: {e}")
+        _count('errors')
+    finally:
+        if cursor:
+            cursor.close()
+        if db:
+            db.close()
+    return evicted
+
+
+def get_set_cache_stats(db):
+    """Returns the hit/miss counters plus the current size of the cache, for admins."""
+    cursor = db.cursor(dictionary=True)
+    try:
+        cursor.execute(
+            "SELECT COUNT(*) AS entries, COALESCE(SUM(size_kb), 0) AS size_kb, COALESCE(SUM(hit_count), 0) AS lifetime_hits FROM set_pdf_cache"
+        )
+        totals = cursor.fetchone()
+    finally:
+        cursor.close()
+
+    with _stats_lock:
+        stats = dict(set_cache_stats)
+    lookups = stats['hits'] + stats['misses']
+
+    return {
+        'enabled': SET_CACHE_ENABLED,
+        'grace_hours': SET_CACHE_GRACE_HOURS,
+        'entries': totals['entries'],
+        'size_mb': round(float(totals['size_kb']) / 1024, 2),
+        'lifetime_hits': int(totals['lifetime_hits']),
+        'hit_ratio': round(stats['hits'] / lookups, 3) if lookups else 0,
+        **stats
+    }
@@ -0,0 +1,132 @@
+import os
+import json
+import asyncio
+import logging
+
+from database_op.database import get_connection
+from core.office_pool import office_pool, kill_soffice_processes
+from core.conversion_cache import get_counters
+
+logger = logging.getLogger(__name__)
+
+# Conversion worker status
+#
+# Conversions run in app/worker.py processes (and in the web process only if it has
+# EMBEDDED_CONVERSION_WORKERS), so the web process can't see their LibreOffice pools
+# or conversion cache counters, nor kill their soffice processes. Each process that
+# runs conversions writes its status to the conversion_worker table every
+# WORKER_STATUS_INTERVAL_SECONDS instead:
+# - office_pool_status - office_pool.status(), as JSON
+# - cache_* - the conversion cache counters since the process started
+#
+# The admin endpoints read it from there. Killing LibreOffice sets a flag on every
+# live worker, which each one acts on at its next report. A worker that hasn't
+# reported for WORKER_STATUS_STALE_SECONDS is assumed to be gone.
+WORKER_STATUS_INTERVAL_SECONDS = int(os.getenv("WORKER_STATUS_INTERVAL_SECONDS", "15"))
+WORKER_STATUS_STALE_SECONDS = WORKER_STATUS_INTERVAL_SECONDS * 3
+
+
+def report_status(db, worker_id):
+    """Writes this process's status, and kills LibreOffice if an admin asked for it."""
+    counters = get_counters()
+    cursor = db.cursor()
+    try:
+        cursor.execute(
+            """
+            INSERT INTO conversion_worker (worker_id, office_pool_status, cache_hits, cache_misses, cache_stores,
+                                           cache_evictions, cache_errors, started_at, heartbeat_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, NOW(), NOW())
+            ON DUPLICATE KEY UPDATE office_pool_status = VALUES(office_pool_status),
+                cache_hits = VALUES(cache_hits), cache_misses = VALUES(cache_misses),
+                cache_stores = VALUES(cache_stores), cache_evictions = VALUES(cache_evictions),
+                cache_errors = VALUES(cache_errors), heartbeat_at = NOW()
+            """,
+            (worker_id, json.dumps(office_pool.status()), counters['hits'], counters['misses'],
+             counters['stores'], counters['evictions'], counters['errors'])
+        )
+        cursor.execute(
+            "UPDATE conversion_worker SET kill_libreoffice_requested = FALSE WHERE worker_id = %s AND kill_libreoffice_requested",
+            (worker_id,)
+        )
+        kill_requested = cursor.rowcount > 0
+        # Workers that stopped a long time ago
+        cursor.execute("DELETE FROM conversion_worker WHERE heartbeat_at < NOW() - INTERVAL 1 DAY")
+        db.commit()
+    finally:
+        cursor.close()
+
+    if kill_requested:
+        logger.warning(f"Killing LibreOffice processes on worker {worker_id}, as requested by an admin")
+        kill_soffice_processes()
+
+
+async def report_worker_status(worker_id):
+    """Keeps reporting this process's status until the worker is stopped."""
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            db = await loop.run_in_executor(None, get_connection)
+            try:
+                await loop.run_in_executor(None, report_status, db, worker_id)
+            finally:
+                db.close()
+        except Exception as e:
+            logger.error(f"Error reporting conversion worker status: {e}")
+        await asyncio.sleep(WORKER_STATUS_INTERVAL_SECONDS)
+
+
+def _live_workers(cursor):
+    cursor.execute(
+        """
+        SELECT worker_id, office_pool_status, cache_hits, cache_misses, cache_stores, cache_evictions,
+               cache_errors, started_at, heartbeat_at
+        FROM conversion_worker
+        WHERE heartbeat_at >= NOW() - INTERVAL %s SECOND
+        ORDER BY worker_id
+        """,
+        (WORKER_STATUS_STALE_SECONDS,)
+    )
+    return cursor.fetchall()
+
+
+def get_office_pool_statuses(db):
+    """Returns {worker_id: office pool status} for every live conversion worker."""
+    cursor = db.cursor(dictionary=True)
+    try:
+        workers = _live_workers(cursor)
+    finally:
+        cursor.close()
+    return {
+        worker['worker_id']: {
+            'heartbeat_at': worker['heartbeat_at'],
+            **json.loads(worker['office_pool_status'] or '{}')
+        }
+        for worker in workers
+    }
+
+
+def get_worker_cache_counters(db):
+    """Adds up the conversion cache counters of every live conversion worker."""
+    cursor = db.cursor(dictionary=True)
+    try:
+        workers = _live_workers(cursor)
+    finally:
+        cursor.close()
+    counters = {name: sum(worker[f'cache_{name}'] for worker in workers)
+                for name in ('hits', 'misses', 'stores', 'evictions', 'errors')}
+    counters['workers'] = len(workers)
+    return counters
+
+
+def request_kill_libreoffice(db):
+    """Asks every live conversion worker to kill its LibreOffice processes. Returns how many."""
+    cursor = db.cursor()
+    try:
+        cursor.execute(
+            "UPDATE conversion_worker SET kill_libreoffice_requested = TRUE WHERE heartbeat_at >= NOW() - INTERVAL %s SECOND",
+            (WORKER_STATUS_STALE_SECONDS,)
+        )
+        db.commit()
+        return cursor.rowcount
+    finally:
+        cursor.close()
@@ -0,0 +1,101 @@
+import os
+import logging
+from typing import AsyncGenerator
+
+import aiomysql
+
+from database_op.database import config
+
+logger = logging.getLogger(__name__)
+
+# Async database access
+#
+# Handlers that take a connection from get_db run mysql.connector queries right on
+# the event loop, so every query stalls every other request for as long as MySQL
+# takes to answer. The busiest handlers (secure links, the dashboard, uploads and
+# set creation) use this pool of aiomysql connections instead, through get_async_db
+# or async_db.acquire(), and await their queries.
+#
+# It has its own ASYNC_DB_POOL_SIZE connections on top of the mysql.connector pool,
+# which the rest of the app, the background jobs and the conversion workers keep
+# using. Queries use the same %s placeholders, cursors are aiomysql.DictCursor.
+#
+# Connections are in autocommit mode, so a plain read never holds a transaction
+# (or an old snapshot) open while it sits in the pool. Writes that belong together
+# go between await conn.begin() and await conn.commit().
+ASYNC_DB_POOL_SIZE = int(os.getenv("ASYNC_DB_POOL_SIZE", "10"))
+# Connections idle for longer than this are reopened rather than reused, so MySQL's
+# wait_timeout never closes one under us
+ASYNC_DB_POOL_RECYCLE_SECONDS = int(os.getenv("ASYNC_DB_POOL_RECYCLE_SECONDS", "500"))
+
+DictCursor = aiomysql.DictCursor
+Error = aiomysql.Error
+
+
+class AsyncDatabase:
+    """Pool of aiomysql connections, opened on app startup."""
+
+    def __init__(self, pool_size=ASYNC_DB_POOL_SIZE):
+        self.pool_size = pool_size
+        self._pool = None
+
+    async def start(self):
+        self._pool = await aiomysql.create_pool(
+            host=config['host'],
+            user=config['user'],
+            password=config['password'],
+            db=config['database'],
+            minsize=1,
+            maxsize=self.pool_size,
+            autocommit=True,
+            connect_timeout=config['connect_timeout'],
+            pool_recycle=ASYNC_DB_POOL_RECYCLE_SECONDS
+        )
+        logger.info(f"Async database pool ready ({self.pool_size} connections)")
+
+    async def close(self):
+        if self._pool:
+            self._pool.close()
+            await self._pool.wait_closed()
+            self._pool = None
+
+    def acquire(self):
+        """
+        A connection from the pool, as an async context manager:
+
+            async with async_db.acquire() as conn:
+                async with conn.cursor(DictCursor) as cursor:
+                    await cursor.execute(...)
+        """
+        if self._pool is None:
+            raise RuntimeError("The async database pool hasn't been started")
+        return self._pool.acquire()
+
+    def stats(self):
+        if self._pool is None:
+            return {'started': False, 'pool_size': self.pool_size}
+        return {
+            'started': True,
+            'pool_size': self.pool_size,
+            'open': self._pool.size,
+            'idle': self._pool.freesize
+        }
+
+
+async_db = AsyncDatabase()
+
+
+async def get_async_db() -> AsyncGenerator:
+    """
+    Provides a connection from the async pool, like get_db does from the
+    mysql.connector one. A transaction the handler began but didn't commit is
+    rolled back.
+    """
+    async with async_db.acquire() as connection:
+        try:
+            yield connection
+        finally:
+            try:
+                await connection.rollback()
+            except Exception as e:
+                logger.error(f"Error resetting an async database connection: {e}")
@@ -0,0 +1,99 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Bulk inserts for the tables that get one row per slide, and bulk updates.
+#
+# mysql.connector rewrites executemany() on a plain INSERT ... VALUES statement into
+# a single multi-row INSERT, so each chunk below is one round-trip no matter how many
+# slides it holds. It can't do that for UPDATEs, so update_by_id builds one
+# UPDATE ... CASE statement per chunk instead. Nothing here commits - callers write
+# a whole presentation or set and commit once.
+#
+# insert_set_images runs on the async pool (database_op/async_database.py).
+# aiomysql rewrites executemany() into a multi-row INSERT the same way.
+
+# Rows per INSERT statement, keeps each statement well under max_allowed_packet
+BULK_INSERT_CHUNK_SIZE = 500
+
+
+def _insert_chunked(cursor, query, rows):
+    for start in range(0, len(rows), BULK_INSERT_CHUNK_SIZE):
+        cursor.executemany(query, rows[start:start + BULK_INSERT_CHUNK_SIZE])
+
+
+def insert_slides(cursor, pdf_id, slides):
+    """
+    Records the slide PDFs and thumbnails of a presentation.
+
+    slides is a list of dicts with slide_number, slide_url, slide_sas_token,
+    slide_sas_token_expiry, thumbnail_url, thumbnail_sas_token and
+    thumbnail_sas_token_expiry. Thumbnails point at their slide_file row, whose ids
+    are looked up with one SELECT rather than read back one insert at a time.
+
+    Takes three round-trips for any deck that fits in one chunk.
+    """
+    if not slides:
+        return
+
+    _insert_chunked(
+        cursor,
+        "INSERT INTO slide_file (pdf_id, url, sas_token, sas_token_expiry, file_type, slide_number) VALUES (%s, %s, %s, %s, 'pdf', %s)",
+        [(pdf_id, slide['slide_url'], slide['slide_sas_token'], slide['slide_sas_token_expiry'], slide['slide_number'])
+         for slide in slides]
+    )
+
+    cursor.execute(
+        "SELECT image_id, slide_number FROM slide_file WHERE pdf_id = %s AND file_type = 'pdf'",
+        (pdf_id,)
+    )
+    slide_file_ids = {}
+    for row in cursor.fetchall():
+        if isinstance(row, dict):
+            slide_file_ids[row['slide_number']] = row['image_id']
+        else:
+            slide_file_ids[row[1]] = row[0]
+
+    _insert_chunked(
+        cursor,
+        "INSERT INTO thumbnail (image_id, pdf_id, url, sas_token, sas_token_expiry) VALUES (%s, %s, %s, %s, %s)",
+        [(slide_file_ids[slide['slide_number']], pdf_id, slide['thumbnail_url'], slide['thumbnail_sas_token'], slide['thumbnail_sas_token_expiry'])
+         for slide in slides]
+    )
+    logger.info(f"Recorded {len(slides)} slides for PDF {pdf_id}")
+
+
+async def insert_set_images(cursor, set_id, slide_file_ids):
+    """
+    Links the slide PDFs in slide_file_ids to a set, in that display order. cursor
+    is an async cursor.
+    """
+    rows = [(set_id, slide_file_id, display_idx) for display_idx, slide_file_id in enumerate(slide_file_ids)]
+    for start in range(0, len(rows), BULK_INSERT_CHUNK_SIZE):
+        await cursor.executemany(
+            "INSERT INTO set_image (set_id, image_id, display_order) VALUES (%s, %s, %s)",
+            rows[start:start + BULK_INSERT_CHUNK_SIZE]
+        )
+
+
+def update_by_id(cursor, table, id_column, columns, rows):
+    """
+    Sets different values on many rows of one table.
+
+    rows is a list of (row_id, value for each of columns). Rows are written in id
+    order, so concurrent bulk updates of the same table can't deadlock each other.
+    """
+    rows = sorted(rows)
+    for start in range(0, len(rows), BULK_INSERT_CHUNK_SIZE):
+        chunk = rows[start:start + BULK_INSERT_CHUNK_SIZE]
+        cases = " ".join(["WHEN %s THEN %s"] * len(chunk))
+        assignments = ", ".join(f"{column} = CASE {id_column} {cases} END" for column in columns)
+        params = []
+        for column_idx in range(len(columns)):
+            for row in chunk:
+                params += [row[0], row[column_idx + 1]]
+        params += [row[0] for row in chunk]
+        cursor.execute(
+            f"UPDATE {table} SET {assignments} WHERE {id_column} IN ({', '.join(['%s'] * len(chunk))})",
+            params
+        )
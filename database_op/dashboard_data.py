@@ -0,0 +1,68 @@
+import os
+
+# Dashboard data
+#
+# The dashboard used to fetch every presentation joined with every set in one wide
+# result and build the nested lists in Python, row by row. It now counts the user's
+# presentations and loads one page of them with a summary of their sets (how many),
+# both by the pdf(user_id) index. The sets themselves are only fetched when the
+# user opens them, through a JSON endpoint (load_presentation_sets).
+#
+# Only sets that have their QR code yet are shown, as before.
+DASHBOARD_PAGE_SIZE = int(os.getenv("DASHBOARD_PAGE_SIZE", "6"))
+
+
+async def load_presentation_page(cursor, user_id, page=1, page_size=DASHBOARD_PAGE_SIZE):
+    """
+    Returns (presentations, total_presentations, page) for one page of a user's
+    presentations, oldest first. cursor is an async dictionary cursor
+    (database_op/async_database.py).
+
+    page is clamped to the pages there are, and the one actually loaded is
+    returned. Each presentation has pdf_id, original_filename, num_slides,
+    file_size_kb, download_count and set_count.
+    """
+    await cursor.execute("SELECT COUNT(*) AS total FROM pdf WHERE user_id = %s", (user_id,))
+    total_presentations = (await cursor.fetchone())['total']
+    last_page = max(1, -(-total_presentations // page_size))
+    page = min(max(page, 1), last_page)
+    if not total_presentations:
+        return [], 0, page
+
+    await cursor.execute("""
+        SELECT pdf.pdf_id, pdf.original_filename, pdf.num_slides, pdf.file_size_kb, pdf.download_count,
+               COUNT(s.set_id) AS set_count
+        FROM pdf
+        LEFT JOIN `set` s ON s.pdf_id = pdf.pdf_id AND s.qrcode_url IS NOT NULL
+        WHERE pdf.user_id = %s
+        GROUP BY pdf.pdf_id
+        ORDER BY pdf.pdf_id
+        LIMIT %s OFFSET %s
+    """, (user_id, page_size, (page - 1) * page_size))
+    presentations = await cursor.fetchall()
+    return presentations, total_presentations, page
+
+
+async def load_presentation_sets(cursor, user_id, pdf_id):
+    """
+    Returns the sets of one of the user's presentations, oldest first, with the
+    slide numbers each one is made of (in set order). cursor is an async
+    dictionary cursor. An empty list if there are none, or the presentation isn't the user's.
+    """
+    await cursor.execute("""
+        SELECT s.set_id, s.name, s.slide_count, s.download_count, s.unique_code,
+               GROUP_CONCAT(sf.slide_number ORDER BY si.display_order SEPARATOR ',') AS slide_numbers
+        FROM `set` s
+        LEFT JOIN set_image si ON si.set_id = s.set_id
+        LEFT JOIN slide_file sf ON sf.image_id = si.image_id
+        WHERE s.pdf_id = %s AND s.user_id = %s AND s.qrcode_url IS NOT NULL
+        GROUP BY s.set_id
+        ORDER BY s.set_id
+    """, (pdf_id, user_id))
+    sets = await cursor.fetchall()
+    for set_data in sets:
+        slide_numbers = set_data['slide_numbers']
+        set_data['slide_numbers'] = [int(number) for number in slide_numbers.split(',')] if slide_numbers else []
+        set_data['slide_count'] = set_data['slide_count'] or 0
+        set_data['download_count'] = set_data['download_count'] or 0
+    return sets
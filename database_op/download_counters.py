@@ -0,0 +1,184 @@
+import os
+import asyncio
+import logging
+import threading
+
+from database_op.database import get_connection
+from database_op.user_usage import add_downloads
+
+logger = logging.getLogger(__name__)
+
+# Buffered download counters
+#
+# Every scan of a QR code used to run its own UPDATE ... download_count + 1 and
+# commit, so a class scanning one set queued dozens of transactions on the same row.
+# Downloads are now added up in memory and written every DOWNLOAD_COUNT_FLUSH_SECONDS
+# in one UPDATE per table, and once more when the app shuts down. The same
+# transaction adds them to the owners' usage summaries (database_op/user_usage.py).
+#
+# Reading counts: the pending deltas of this process are added to what the database
+# says (see pending_downloads), so a user sees their own download counted straight
+# away. Other web processes' downloads show up within one flush interval.
+#
+# What a crash can lose: only what hasn't been flushed yet, so at most
+# DOWNLOAD_COUNT_FLUSH_SECONDS worth of downloads per process. A flush is also
+# started as soon as DOWNLOAD_COUNT_MAX_PENDING downloads are waiting, which keeps
+# a burst's exposure to about that many (plus whatever arrives while that flush
+# runs). A flush that fails keeps its deltas for the next try, so a database outage
+# delays counts rather than dropping them - unless the process dies during it.
+DOWNLOAD_COUNT_FLUSH_SECONDS = float(os.getenv("DOWNLOAD_COUNT_FLUSH_SECONDS", "5"))
+DOWNLOAD_COUNT_MAX_PENDING = int(os.getenv("DOWNLOAD_COUNT_MAX_PENDING", "500"))
+
+# Counted things: kind -> (table, id column)
+_COUNTED_TABLES = {
+    'pdf': ("pdf", "pdf_id"),
+    'set': ("`set`", "set_id")
+}
+
+# Rows per UPDATE statement
+FLUSH_CHUNK_SIZE = 500
+
+
+class DownloadCounters:
+    """Download count increments, added up in memory and written in batches."""
+
+    def __init__(self, flush_seconds=DOWNLOAD_COUNT_FLUSH_SECONDS, max_pending=DOWNLOAD_COUNT_MAX_PENDING):
+        self.flush_seconds = flush_seconds
+        self.max_pending = max_pending
+        self._pending = {kind: {} for kind in _COUNTED_TABLES}
+        self._pending_total = 0
+        self._lock = threading.Lock()
+        # Only one flush at a time, so deltas are never written twice
+        self._flush_lock = threading.Lock()
+        self._flush_task = None
+        self._flush_now = None
+        self._stats = {'increments': 0, 'flushes': 0, 'rows_updated': 0, 'failed_flushes': 0}
+
+    def add(self, kind, item_id, count=1):
+        """Counts a download of a presentation ('pdf') or set ('set')."""
+        with self._lock:
+            self._pending[kind][item_id] = self._pending[kind].get(item_id, 0) + count
+            self._pending_total += count
+            self._stats['increments'] += count
+            flush_early = self._pending_total >= self.max_pending
+        if flush_early and self._flush_now:
+            self._flush_now.set()
+
+    def pending_downloads(self, kind, item_ids):
+        """
+        Downloads of these items counted here but not written yet, as {item_id: count}.
+        Add them to the database's download_count to show the up-to-date figure.
+        """
+        with self._lock:
+            pending = self._pending[kind]
+            return {item_id: pending[item_id] for item_id in item_ids if item_id in pending}
+
+    def _take_pending(self):
+        with self._lock:
+            taken = self._pending
+            self._pending = {kind: {} for kind in _COUNTED_TABLES}
+            self._pending_total = 0
+        return taken
+
+    def _put_back(self, deltas):
+        with self._lock:
+            for kind, counts in deltas.items():
+                for item_id, count in counts.items():
+                    self._pending[kind][item_id] = self._pending[kind].get(item_id, 0) + count
+                    self._pending_total += count
+
+    def flush(self):
+        """
+        Writes every pending delta: one UPDATE per table (per FLUSH_CHUNK_SIZE rows),
+        and the owners' usage summaries, in one transaction. Blocks, so call it from
+        a thread. Returns rows updated.
+        """
+        with self._flush_lock:
+            deltas = self._take_pending()
+            if not any(deltas.values()):
+                return 0
+
+            db = None
+            cursor = None
+            rows_updated = 0
+            try:
+                db = get_connection()
+                cursor = db.cursor(dictionary=True)
+                for kind, counts in deltas.items():
+                    table, id_column = _COUNTED_TABLES[kind]
+                    # Same row order in every flush, so concurrent flushes from
+                    # other processes can't deadlock on each other
+                    items = sorted(counts.items())
+                    for start in range(0, len(items), FLUSH_CHUNK_SIZE):
+                        chunk = items[start:start + FLUSH_CHUNK_SIZE]
+                        cases = " ".join(["WHEN %s THEN %s"] * len(chunk))
+                        placeholders = ", ".join(["%s"] * len(chunk))
+                        cursor.execute(
+                            f"UPDATE {table} SET download_count = download_count + CASE {id_column} {cases} END "
+                            f"WHERE {id_column} IN ({placeholders})",
+                            [value for item in chunk for value in item] + [item_id for item_id, _ in chunk]
+                        )
+                        rows_updated += len(chunk)
+                for kind, counts in deltas.items():
+                    if counts:
+                        add_downloads(cursor, kind, counts)
+                db.commit()
+                with self._lock:
+                    self._stats['flushes'] += 1
+                    self._stats['rows_updated'] += rows_updated
+                return rows_updated
+            except Exception as e:
+                logger.error(f"Error writing download counts, keeping them for the next flush: {e}")
+                if db:
+                    try:
+                        db.rollback()
+                    except Exception:
+                        pass
+                self._put_back(deltas)
+                with self._lock:
+                    self._stats['failed_flushes'] += 1
+                return 0
+            finally:
+                if cursor:
+                    cursor.close()
+                if db:
+                    db.close()
+
+    async def _flush_periodically(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), timeout=self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            await loop.run_in_executor(None, self.flush)
+
+    def start(self):
+        """Starts flushing in the background. Call from the event loop at startup."""
+        self._flush_now = asyncio.Event()
+        self._flush_task = asyncio.create_task(self._flush_periodically())
+        logger.info(f"Download counts are written every {self.flush_seconds} seconds")
+
+    async def stop(self):
+        """Stops the background flushing and writes whatever is still pending."""
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await asyncio.get_event_loop().run_in_executor(None, self.flush)
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._stats,
+                'pending': self._pending_total,
+                'flush_seconds': self.flush_seconds,
+                'max_pending': self.max_pending
+            }
+
+
+download_counters = DownloadCounters()
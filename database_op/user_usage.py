@@ -0,0 +1,180 @@
+# Per-user usage summary
+#
+# The account page, the upload and set limits and the downgrade check all need to
+# know how much a user has: presentations, sets, the most sets on any one
+# presentation, downloads and storage. Rather than counting rows every time, these
+# are kept in user_usage (one row per user, see get_usage), and each presentation
+# keeps its own number of sets in pdf.set_count.
+#
+# They are updated with the same transaction as the rows they count, by whoever
+# creates or deletes them:
+# - add_presentation when a conversion job inserts a pdf row
+# - remove_presentation before a pdf row (and its sets) is deleted
+# - add_set when a set is inserted (on the async pool, see database_op/async_database.py),
+#   after lock_presentation has locked its pdf row ahead of the INSERT
+# - add_downloads when download_counters writes its batch
+#
+# Locks are always taken in the order pdf, `set`, user_usage, so these can't
+# deadlock on each other. Storage is the size of the uploaded presentations, in KB
+# like pdf.file_size_kb (set PDFs can be shared between sets, see core/set_cache.py).
+
+# Rows per statement when adding downloads
+DOWNLOAD_CHUNK_SIZE = 500
+
+# Counted downloads: kind -> (table, id column, user_usage column)
+_DOWNLOAD_COLUMNS = {
+    'pdf': ("pdf", "pdf_id", "pdf_download_count"),
+    'set': ("`set`", "set_id", "set_download_count")
+}
+
+_EMPTY_USAGE = {
+    'presentation_count': 0,
+    'set_count': 0,
+    'max_sets_per_presentation': 0,
+    'pdf_download_count': 0,
+    'set_download_count': 0,
+    'storage_kb': 0
+}
+
+
+_USAGE_QUERY = """
+    SELECT presentation_count, set_count, max_sets_per_presentation,
+           pdf_download_count, set_download_count, storage_kb
+    FROM user_usage WHERE user_id = %s
+"""
+
+
+def _usage_from_row(usage):
+    if not usage:
+        return dict(_EMPTY_USAGE)
+    return {column: int(value or 0) for column, value in usage.items()}
+
+
+def get_usage(cursor, user_id):
+    """
+    Returns a user's usage summary as a dict with presentation_count, set_count,
+    max_sets_per_presentation, pdf_download_count, set_download_count and
+    storage_kb (all 0 for a user who hasn't uploaded anything yet). cursor must be
+    a dictionary cursor.
+    """
+    cursor.execute(_USAGE_QUERY, (user_id,))
+    return _usage_from_row(cursor.fetchone())
+
+
+async def get_usage_async(cursor, user_id):
+    """get_usage, on an async dictionary cursor (database_op/async_database.py)."""
+    await cursor.execute(_USAGE_QUERY, (user_id,))
+    return _usage_from_row(await cursor.fetchone())
+
+
+def add_presentation(cursor, user_id, file_size_kb):
+    """Counts a new presentation. Call with the INSERT INTO pdf, before committing."""
+    cursor.execute(
+        """
+        INSERT INTO user_usage (user_id, presentation_count, storage_kb) VALUES (%s, 1, %s)
+        ON DUPLICATE KEY UPDATE presentation_count = presentation_count + 1, storage_kb = storage_kb + VALUES(storage_kb)
+        """,
+        (user_id, file_size_kb or 0)
+    )
+
+
+def remove_presentation(cursor, pdf_id):
+    """
+    Takes a presentation, its sets and their downloads off its owner's usage. Call
+    before deleting the pdf row, in the same transaction. cursor must be a
+    dictionary cursor. Does nothing if the presentation doesn't exist.
+    """
+    cursor.execute(
+        "SELECT user_id, file_size_kb, set_count, download_count FROM pdf WHERE pdf_id = %s FOR UPDATE",
+        (pdf_id,)
+    )
+    presentation = cursor.fetchone()
+    if not presentation:
+        return
+    cursor.execute(
+        "SELECT COALESCE(SUM(download_count), 0) AS set_downloads FROM `set` WHERE pdf_id = %s FOR UPDATE",
+        (pdf_id,)
+    )
+    set_downloads = cursor.fetchone()['set_downloads']
+
+    cursor.execute(
+        """
+        UPDATE user_usage SET
+            presentation_count = GREATEST(presentation_count - 1, 0),
+            set_count = GREATEST(set_count - %s, 0),
+            pdf_download_count = GREATEST(pdf_download_count - %s, 0),
+            set_download_count = GREATEST(set_download_count - %s, 0),
+            storage_kb = GREATEST(storage_kb - %s, 0),
+            max_sets_per_presentation = (
+                SELECT COALESCE(MAX(other.set_count), 0) FROM pdf AS other
+                WHERE other.user_id = %s AND other.pdf_id != %s
+            )
+        WHERE user_id = %s
+        """,
+        (presentation['set_count'] or 0, presentation['download_count'] or 0, set_downloads,
+         presentation['file_size_kb'] or 0, presentation['user_id'], pdf_id, presentation['user_id'])
+    )
+
+
+async def lock_presentation(cursor, pdf_id):
+    """
+    Locks a presentation's pdf row before a set of it is inserted. The INSERT INTO
+    `set` would otherwise lock the `set` side first, the other way round from
+    remove_presentation. cursor is an async cursor, inside the set's transaction.
+    """
+    await cursor.execute("SELECT pdf_id FROM pdf WHERE pdf_id = %s FOR UPDATE", (pdf_id,))
+    await cursor.fetchone()
+
+
+async def add_set(cursor, user_id, pdf_id):
+    """
+    Counts a new set of a presentation. Call after lock_presentation and the INSERT
+    INTO `set`, before committing. cursor is an async cursor.
+    """
+    await cursor.execute("UPDATE pdf SET set_count = set_count + 1 WHERE pdf_id = %s", (pdf_id,))
+    await cursor.execute(
+        """
+        UPDATE user_usage SET
+            set_count = set_count + 1,
+            max_sets_per_presentation = GREATEST(
+                max_sets_per_presentation, (SELECT set_count FROM pdf WHERE pdf_id = %s)
+            )
+        WHERE user_id = %s
+        """,
+        (pdf_id, user_id)
+    )
+
+
+def add_downloads(cursor, kind, counts):
+    """
+    Adds downloads of presentations ('pdf') or sets ('set') to their owners' usage.
+    counts is {item_id: downloads}. Items that have been deleted meanwhile are left
+    out. cursor must be a dictionary cursor.
+    """
+    table, id_column, usage_column = _DOWNLOAD_COLUMNS[kind]
+    items = sorted(counts.items())
+    user_downloads = {}
+    for start in range(0, len(items), DOWNLOAD_CHUNK_SIZE):
+        chunk = items[start:start + DOWNLOAD_CHUNK_SIZE]
+        cases = " ".join(["WHEN %s THEN %s"] * len(chunk))
+        placeholders = ", ".join(["%s"] * len(chunk))
+        cursor.execute(
+            f"SELECT user_id, SUM(CASE {id_column} {cases} END) AS downloads FROM {table} "
+            f"WHERE {id_column} IN ({placeholders}) GROUP BY user_id",
+            [value for item in chunk for value in item] + [item_id for item_id, _ in chunk]
+        )
+        for row in cursor.fetchall():
+            user_downloads[row['user_id']] = user_downloads.get(row['user_id'], 0) + int(row['downloads'])
+
+    # By user_id, the same order in every process
+    users = sorted(user_downloads.items())
+    for start in range(0, len(users), DOWNLOAD_CHUNK_SIZE):
+        chunk = users[start:start + DOWNLOAD_CHUNK_SIZE]
+        cases = " ".join(["WHEN %s THEN %s"] * len(chunk))
+        placeholders = ", ".join(["%s"] * len(chunk))
+        cursor.execute(
+            f"UPDATE user_usage SET {usage_column} = {usage_column} + CASE user_id {cases} END "
+            f"WHERE user_id IN ({placeholders})",
+            [value for user in chunk for value in user] + [user_id for user_id, _ in chunk]
+        )
+
@@ -0,0 +1,104 @@
+# Async versions of the helpers in blob_op.py
+#
+# Same operations, same arguments and return values, but awaitable, so they can be
+# used from request handlers without holding up every other request while a file
+# goes up or down. On Azure they use the async Azure SDK. Use these in anything that
+# runs on the event loop; blob_op.py is for code that already runs in a thread.
+
+import logging
+
+from helpers.blob_cache import blob_cache
+from helpers.storage_backend import storage_backend
+
+
+async def upload_to_blob(blob_name, file_content, content_type, user_alias, content_disposition=None):
+    """
+    Uploads bytes or an open file to storage and returns (url, sas_token, expiry),
+    just like blob_op.upload_to_blob. Large files go up as blocks in parallel.
+    """
+    try:
+        logging.info(f"Uploading blob: {blob_name}, content type: {content_type}, user: {user_alias}")
+
+        blob_url = storage_backend.url_for(blob_name)
+
+        await storage_backend.put(blob_name, file_content, content_type, content_disposition)
+        blob_cache.invalidate(blob_name)
+
+        logging.info(f"Successfully uploaded blob to {blob_url}")
+        return blob_url, None, None
+    except Exception as e:
+        logging.error(f"Error uploading blob {blob_name} for user {user_alias}: {e}")
+        raise Exception(f"Couldn't upload file to storage: {e}")
+
+
+async def copy_blob(source_blob_name, source_alias, dest_blob_name, dest_alias):
+    """Storage-side copy, see blob_op.copy_blob. Returns (url, sas_token, expiry)."""
+    try:
+        logging.info(f"Copying blob {source_blob_name} to {dest_blob_name}")
+
+        await storage_backend.copy(source_blob_name, dest_blob_name)
+        blob_cache.invalidate(dest_blob_name)
+
+        return storage_backend.url_for(dest_blob_name), None, None
+    except Exception as e:
+        logging.error(f"Error copying blob {source_blob_name} to {dest_blob_name}: {e}")
+        raise Exception(f"Couldn't copy file in storage: {e}")
+
+
+async def list_blob_sizes(prefix):
+    """Returns {blob_name: size_in_bytes} for every blob whose name starts with prefix."""
+    return await storage_backend.list(prefix)
+
+
+async def delete_blobs_with_prefix(prefix):
+    """Deletes every blob whose name starts with prefix. Returns how many were deleted."""
+    deleted = 0
+    blob_cache.invalidate_prefix(prefix)
+    for blob_name in await list_blob_sizes(prefix):
+        try:
+            if await storage_backend.delete(blob_name):
+                deleted += 1
+        except Exception as e:
+            logging.warning(f"Couldn't delete blob {blob_name}: {e}")
+    return deleted
+
+
+async def download_blob_bytes(blob_name, user_alias):
+    """Downloads a whole blob into memory and returns its bytes."""
+    try:
+        return await storage_backend.get(blob_name)
+    except Exception as e:
+        logging.error(f"Error downloading blob {blob_name} for user {user_alias}: {e}")
+        raise Exception(f"Couldn't download file from storage: {e}")
+
+
+async def download_blob_to_file(blob_name, user_alias, file_path):
+    """Downloads a blob straight into a local file, a chunk at a time. Returns the number of bytes written."""
+    try:
+        return await storage_backend.get_to_file(blob_name, file_path)
+    except Exception as e:
+        logging.error(f"Error downloading blob {blob_name} for user {user_alias}: {e}")
+        raise Exception(f"Couldn't download file from storage: {e}")
+
+
+async def delete_blob(blob_name, user_alias):
+    """Deletes a single blob. Missing blobs are not an error."""
+    blob_cache.invalidate(blob_name)
+    if not await storage_backend.delete(blob_name):
+        logging.info(f"Blob already deleted: {blob_name}")
+
+
+async def download_blob_url(blob_url):
+    """
+    Downloads a blob by the URL stored in the database (SAS not needed) and returns
+    its bytes. Raises BlobNotFound if it's gone.
+    """
+    return await storage_backend.get(storage_backend.name_from_url(blob_url))
+
+
+async def delete_blob_url(blob_url):
+    """Deletes a blob by the URL stored in the database. Returns False if it was already gone."""
+    blob_name = storage_backend.name_from_url(blob_url)
+    blob_cache.invalidate(blob_name)
+    return await storage_backend.delete(blob_name)
+
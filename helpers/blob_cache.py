@@ -0,0 +1,399 @@
+# Read cache for stored files
+#
+# When a class scans the same QR code, dozens of students download the same set PDF
+# within seconds. Rather than fetching it from storage for each of them, files served
+# through the app are kept close at hand:
+# - Small files (QR codes, thumbnails) in memory, up to BLOB_CACHE_MEMORY_MB
+# - Everything else on local disk, up to BLOB_CACHE_DISK_MB:
+#   <BLOB_CACHE_DIR>/<process id>/<sha256 of the blob name>
+#
+# Both tiers drop the least recently used files first. A file that isn't cached yet
+# is downloaded into the cache once, in the background, however many people asked
+# for it at the same time. Each of them is sent the file as it arrives (see
+# BlobFill.stream) rather than waiting for all of it.
+#
+# Entries remember the storage ETag they were read with. Files that can be rewritten
+# in place (master PDFs) are checked against storage before a cached copy is used.
+# Files that never change can be served without asking storage at all. Deleting a
+# file through blob_op/async_blob_op drops it from the cache, and so does deleting
+# the presentation or set it belongs to.
+#
+# The index lives in memory, so each process has its own folder and clears it when
+# it starts.
+
+import os
+import asyncio
+import hashlib
+import logging
+import shutil
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+
+from helpers.storage_backend import storage_backend, STREAM_CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+BLOB_CACHE_ENABLED = os.getenv("BLOB_CACHE_ENABLED", "true").lower() == "true"
+BLOB_CACHE_MEMORY_MB = int(os.getenv("BLOB_CACHE_MEMORY_MB", "64"))
+BLOB_CACHE_MEMORY_MAX_OBJECT_KB = int(os.getenv("BLOB_CACHE_MEMORY_MAX_OBJECT_KB", "512"))
+BLOB_CACHE_DISK_MB = int(os.getenv("BLOB_CACHE_DISK_MB", "2048"))
+BLOB_CACHE_DIR = os.getenv("BLOB_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "slidepull_blob_cache")
+
+
+class CachedBlob:
+    """A cached file: its storage details (size, etag, last_modified) and either its bytes or its local path."""
+
+    def __init__(self, info, data=None, path=None):
+        self.info = info
+        self.data = data
+        self.path = path
+
+    @property
+    def size(self):
+        return self.info['size']
+
+    async def stream(self, chunk_size=STREAM_CHUNK_SIZE, offset=0, length=None):
+        """Same as storage_backend.stream, but from the cached copy."""
+        end = self.size if length is None else min(offset + length, self.size)
+        if self.data is not None:
+            view = memoryview(self.data)
+            for chunk_start in range(offset, end, chunk_size):
+                yield bytes(view[chunk_start:min(chunk_start + chunk_size, end)])
+            return
+
+        loop = asyncio.get_event_loop()
+        # The file can be evicted while we read it; an open file stays readable on Linux
+        with open(self.path, "rb") as cached_file:
+            cached_file.seek(offset)
+            remaining = end - offset
+            while remaining > 0:
+                chunk = await loop.run_in_executor(None, cached_file.read, min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+
+class BlobFill:
+    """
+    Collects a file as it is downloaded and adds it to the cache when it has all
+    arrived. Requests for the file read it from here in the meantime. Returned by
+    BlobReadCache.begin_fill.
+    """
+
+    def __init__(self, cache, blob_name, info, in_memory):
+        self.cache = cache
+        self.blob_name = blob_name
+        self.info = info
+        self.in_memory = in_memory
+        self.received = 0
+        self.done = False
+        self.entry = None
+        self.task = None
+        self._buffer = bytearray() if in_memory else None
+        self._file = None
+        self._partial_path = None
+        self._arrived = asyncio.Event()
+
+    def _write_to_disk(self, chunk):
+        self._file.write(chunk)
+        self._file.flush()
+
+    async def write(self, chunk):
+        if self.in_memory:
+            self._buffer += chunk
+        else:
+            if self._file is None:
+                os.makedirs(self.cache.disk_dir, exist_ok=True)
+                self._partial_path = os.path.join(self.cache.disk_dir, f"{uuid.uuid4().hex}.part")
+                self._file = open(self._partial_path, "wb")
+            await asyncio.get_event_loop().run_in_executor(None, self._write_to_disk, chunk)
+        # Only counted once it can be read back
+        self.received += len(chunk)
+        self._wake()
+
+    def _wake(self):
+        arrived, self._arrived = self._arrived, asyncio.Event()
+        arrived.set()
+
+    def _read_partial(self, path, offset, length):
+        try:
+            with open(path, "rb") as partial_file:
+                partial_file.seek(offset)
+                return partial_file.read(length)
+        except FileNotFoundError:
+            return None  # Finished meanwhile
+
+    async def stream(self, chunk_size=STREAM_CHUNK_SIZE, offset=0, length=None):
+        """
+        Same as CachedBlob.stream, for a file that is still arriving: each chunk is
+        sent once it has been downloaded. If the download fails, the rest is read
+        from storage.
+        """
+        end = self.info['size'] if length is None else min(offset + length, self.info['size'])
+        position = offset
+        while position < end:
+            if self.done:
+                rest = (self.entry.stream(chunk_size, position, end - position) if self.entry
+                        else storage_backend.stream(self.blob_name, chunk_size, position, end - position))
+                async for chunk in rest:
+                    yield chunk
+                return
+            if self.received <= position:
+                await self._arrived.wait()
+                continue
+
+            stop = min(end, self.received, position + chunk_size)
+            if self.in_memory:
+                chunk = bytes(self._buffer[position:stop])
+            else:
+                chunk = await asyncio.get_event_loop().run_in_executor(
+                    None, self._read_partial, self._partial_path, position, stop - position
+                )
+                if not chunk:
+                    continue
+            position += len(chunk)
+            yield chunk
+
+    def finish(self, completed):
+        """
+        Adds the file to the cache if all of it arrived and returns the new entry,
+        otherwise throws it away and returns None.
+        """
+        if self._file is not None:
+            self._file.close()
+        completed = completed and self.received == self.info['size']
+        try:
+            if not completed:
+                return None
+            if self.in_memory:
+                self.entry = self.cache._add_memory(self.blob_name, CachedBlob(self.info, data=bytes(self._buffer)))
+            else:
+                self.entry = self.cache._add_disk(self.blob_name, self.info, self._partial_path)
+                self._partial_path = None
+            return self.entry
+        finally:
+            if self._partial_path and os.path.exists(self._partial_path):
+                os.remove(self._partial_path)
+            self.done = True
+            self._wake()
+
+
+class BlobReadCache:
+    """Size-capped LRU caches of stored files, in memory for small files and on disk for the rest."""
+
+    def __init__(self, root=BLOB_CACHE_DIR, memory_mb=BLOB_CACHE_MEMORY_MB, disk_mb=BLOB_CACHE_DISK_MB,
+                 memory_max_object_kb=BLOB_CACHE_MEMORY_MAX_OBJECT_KB, enabled=BLOB_CACHE_ENABLED):
+        self.enabled = enabled
+        self.root = root
+        self.memory_limit = memory_mb * 1024 * 1024
+        self.disk_limit = disk_mb * 1024 * 1024
+        self.memory_max_object = memory_max_object_kb * 1024
+        self._memory = OrderedDict()
+        self._disk = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        # blob name -> BlobFill being downloaded, so requests for it share the download
+        self._fills = {}
+        self._stats = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'stale': 0,
+            'invalidations': 0,
+            'evictions': 0,
+            'fetches': 0,
+            'shared_fetches': 0,
+            'bytes_served': 0,
+            'bytes_from_storage': 0
+        }
+
+    @property
+    def disk_dir(self):
+        # Worked out when used, so processes forked after import get their own folder
+        return os.path.join(self.root, str(os.getpid()))
+
+    def start(self):
+        """Clears whatever an earlier process with the same id left in its folder."""
+        if not self.enabled:
+            return
+        shutil.rmtree(self.disk_dir, ignore_errors=True)
+        os.makedirs(self.disk_dir, exist_ok=True)
+        logger.info(f"Blob read cache ready: {self.memory_limit // (1024 * 1024)} MB in memory, "
+                    f"{self.disk_limit // (1024 * 1024)} MB on disk in {self.disk_dir}")
+
+    def close(self):
+        with self._lock:
+            self._memory.clear()
+            self._disk.clear()
+            self._memory_bytes = self._disk_bytes = 0
+        shutil.rmtree(self.disk_dir, ignore_errors=True)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def get(self, blob_name, etag=None):
+        """
+        Returns the cached copy of a file, or None. If etag is given (the file's
+        current ETag in storage) a copy read with a different ETag is dropped.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            tier = self._memory if blob_name in self._memory else self._disk
+            entry = tier.get(blob_name)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            if not (etag and entry.info.get('etag') and entry.info['etag'] != etag):
+                tier.move_to_end(blob_name)
+                self._stats['memory_hits' if tier is self._memory else 'disk_hits'] += 1
+                return entry
+            self._stats['stale'] += 1
+        self.invalidate(blob_name, counted=False)
+        return None
+
+    def begin_fill(self, blob_name, info):
+        """
+        Starts caching a file that is about to be streamed from storage. Returns a
+        BlobFill, or None if the file shouldn't be cached (cache off, file too big).
+        """
+        if not self.enabled:
+            return None
+        if info['size'] <= self.memory_max_object:
+            return BlobFill(self, blob_name, info, in_memory=True)
+        if info['size'] <= self.disk_limit // 4:
+            return BlobFill(self, blob_name, info, in_memory=False)
+        return None
+
+    def fetch(self, blob_name, info):
+        """
+        Starts downloading a file into the cache in the background, unless that same
+        version of it is already on its way, and returns its BlobFill to stream it
+        from as it arrives. None if it can't be cached (cache off, too big).
+        """
+        fill = self._fills.get(blob_name)
+        if fill and fill.info.get('etag') == info.get('etag'):
+            self._count('shared_fetches')
+            return fill
+
+        fill = self.begin_fill(blob_name, info)
+        if not fill:
+            return None
+        self._fills[blob_name] = fill
+        self._count('fetches')
+        fill.task = asyncio.ensure_future(self._fetch(fill))
+        return fill
+
+    async def _fetch(self, fill):
+        completed = False
+        try:
+            async for chunk in storage_backend.stream(fill.blob_name):
+                self.record_fetched(len(chunk))
+                await fill.write(chunk)
+            completed = True
+        except Exception as e:
+            logger.warning(f"Couldn't fetch {fill.blob_name} into the read cache: {e}")
+        finally:
+            fill.finish(completed)
+            if self._fills.get(fill.blob_name) is fill:
+                del self._fills[fill.blob_name]
+
+    def record_served(self, byte_count):
+        """Counts bytes sent to clients, whichever way they were read."""
+        self._count('bytes_served', byte_count)
+
+    def record_fetched(self, byte_count):
+        """Counts bytes read from storage to serve clients."""
+        self._count('bytes_from_storage', byte_count)
+
+    def _add_memory(self, blob_name, entry):
+        self.invalidate(blob_name, counted=False)
+        with self._lock:
+            self._memory[blob_name] = entry
+            self._memory_bytes += entry.size
+            while self._memory_bytes > self.memory_limit and self._memory:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted.size
+                self._stats['evictions'] += 1
+        return entry
+
+    def _add_disk(self, blob_name, info, partial_path):
+        self.invalidate(blob_name, counted=False)
+        path = os.path.join(self.disk_dir, hashlib.sha256(blob_name.encode()).hexdigest())
+        os.replace(partial_path, path)
+        evicted_paths = []
+        entry = CachedBlob(info, path=path)
+        with self._lock:
+            self._disk[blob_name] = entry
+            self._disk_bytes += info['size']
+            while self._disk_bytes > self.disk_limit and self._disk:
+                _, evicted = self._disk.popitem(last=False)
+                self._disk_bytes -= evicted.size
+                evicted_paths.append(evicted.path)
+                self._stats['evictions'] += 1
+        for evicted_path in evicted_paths:
+            self._remove_file(evicted_path)
+        return entry
+
+    def _remove_file(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Couldn't remove cached file {path}: {e}")
+
+    def invalidate(self, blob_name, counted=True):
+        """Drops a file from the cache. Call whenever it is deleted or rewritten."""
+        with self._lock:
+            memory_entry = self._memory.pop(blob_name, None)
+            if memory_entry:
+                self._memory_bytes -= memory_entry.size
+            disk_entry = self._disk.pop(blob_name, None)
+            if disk_entry:
+                self._disk_bytes -= disk_entry.size
+            if counted and (memory_entry or disk_entry):
+                self._stats['invalidations'] += 1
+        if disk_entry:
+            self._remove_file(disk_entry.path)
+
+    def invalidate_url(self, blob_url):
+        """invalidate() for a URL stored in the database."""
+        self.invalidate(storage_backend.name_from_url(blob_url))
+
+    def invalidate_prefix(self, prefix):
+        """Drops every cached file whose name starts with prefix."""
+        with self._lock:
+            blob_names = [name for name in (*self._memory, *self._disk) if name.startswith(prefix)]
+        for blob_name in blob_names:
+            self.invalidate(blob_name)
+
+    def stats(self):
+        """Hit ratio, bytes served and read from storage and how full each tier is, for admins."""
+        with self._lock:
+            stats = dict(self._stats)
+            memory_entries, disk_entries = len(self._memory), len(self._disk)
+            memory_bytes, disk_bytes = self._memory_bytes, self._disk_bytes
+
+        hits = stats['memory_hits'] + stats['disk_hits']
+        lookups = hits + stats['misses'] + stats['stale']
+        return {
+            'enabled': self.enabled,
+            'hit_ratio': round(hits / lookups, 3) if lookups else 0,
+            # Share of the bytes sent to clients that didn't have to come from storage
+            'byte_hit_ratio': round(max(0, 1 - stats['bytes_from_storage'] / stats['bytes_served']), 3)
+                              if stats['bytes_served'] else 0,
+            'memory': {'entries': memory_entries, 'size_mb': round(memory_bytes / (1024 * 1024), 2),
+                       'limit_mb': round(self.memory_limit / (1024 * 1024), 2)},
+            'disk': {'entries': disk_entries, 'size_mb': round(disk_bytes / (1024 * 1024), 2),
+                     'limit_mb': round(self.disk_limit / (1024 * 1024), 2)},
+            **stats
+        }
+
+
+blob_cache = BlobReadCache()
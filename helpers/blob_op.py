@@ -8,60 +8,25 @@
 #
 # This organization keeps everything neat and makes it easy to find and
 # manage files for each user.
+#
+# The same layout is used whichever storage backend is configured (see
+# storage_backend.py), so everything below works with Azure or with local disk.
+#
+# Uploads used to sign every file and the token was stored with its row. Links are
+# now signed when a page needs them (helpers/signed_urls.py), so nothing is signed
+# here. The functions below still return (url, sas_token, expiry), with None for
+# both, because every caller writes them to the sas_token columns. Those are kept
+# (nullable) so existing databases don't need a migration, and new rows leave them
+# empty.
 
-import os
-from azure.storage.blob import generate_blob_sas, BlobSasPermissions, ContentSettings, BlobClient
-from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 from fastapi import Request
+from helpers.blob_cache import blob_cache
+from helpers.storage_backend import storage_backend
 
 # Load our environment variables from .env file
 load_dotenv()
 
-# Get Azure Storage account details from environment variables
-AZURE_STORAGE_ACCOUNT_NAME = os.getenv("AZURE_STORAGE_ACCOUNT_NAME")
-AZURE_STORAGE_ACCOUNT_KEY = os.getenv("AZURE_STORAGE_ACCOUNT_KEY")
-AZURE_BLOB_CONTAINER_NAME = os.getenv("AZURE_BLOB_CONTAINER_NAME")
-
-def generate_sas_token_for_file(alias, file_path, current_sas_token=None, sas_token_expiry=None, content_disposition=None):
-    """
-    Creates or reuses a Shared Access Signature (SAS) token for accessing a file in Azure Blob Storage.
-    
-    SAS tokens are like temporary passwords that grant limited access to a specific file.
-    They're perfect for giving users secure access to their files without exposing our storage account keys.
-    
-    We set these to expire after 7 days for security reasons.
-    """
-    # If we already have a valid token, just reuse it
-    if current_sas_token and sas_token_expiry and datetime.utcnow().replace(tzinfo=timezone.utc) < sas_token_expiry:
-        print(f"Reusing existing SAS token for '{file_path}' - still valid")
-        return current_sas_token, sas_token_expiry
-
-    # Make sure the blob name includes the user's alias for organization
-    if file_path.startswith(f"{alias}/"):
-        blob_name = file_path  # Path already includes alias
-    else:
-        blob_name = f"{alias}/{file_path}"  # Add alias to path
-
-    # Set token to expire in 7 days
-    expiry_time = datetime.utcnow().replace(tzinfo=timezone.utc) + timedelta(days=7)
-
-    # Generate the SAS token with the permissions we need
-    sas_token = generate_blob_sas(
-        account_name=AZURE_STORAGE_ACCOUNT_NAME,
-        container_name=AZURE_BLOB_CONTAINER_NAME,
-        blob_name=blob_name,
-        account_key=AZURE_STORAGE_ACCOUNT_KEY,
-        # Allow reading, writing, and deleting this specific blob
-        permission=BlobSasPermissions(read=True, write=True, delete=True),
-        expiry=expiry_time,
-        content_disposition=content_disposition  # Controls how browsers handle the file when downloaded
-    )
-
-    print(f"Created new SAS token for '{blob_name}' (expires in 7 days)")
-    return sas_token, expiry_time
-
-
 # These are placeholder functions for future implementation
 # We'll build these out as needed for specific file types
 def upload_presentation():
@@ -79,85 +44,109 @@ def upload_thumbnails():
 def upload_zip():
     pass 
 
-def refresh_sas_token_if_needed(alias, file_path, current_sas_token=None, sas_token_expiry=None, content_disposition=None):
-    """
-    Checks if a SAS token is expired and regenerates it if needed.
-    
-    This function is a wrapper around generate_sas_token_for_file that makes it easier
-    to use in the context of refreshing tokens. It's particularly useful when retrieving
-    files from the database and checking if their tokens need to be refreshed.
-    
-    Returns:
-        tuple: (sas_token, sas_token_expiry) - Either the original token if still valid,
-               or a newly generated token and its expiry date.
-    """
-    # Use the existing function which already has expiry checking logic
-    return generate_sas_token_for_file(
-        alias=alias,
-        file_path=file_path,
-        current_sas_token=current_sas_token,
-        sas_token_expiry=sas_token_expiry,
-        content_disposition=content_disposition
-    )
-
 import logging
 
 def upload_to_blob(blob_name, file_content, content_type, user_alias, content_disposition=None):
     """
-    Uploads any file to Azure Blob Storage and returns access information.
+    Uploads any file to storage and returns access information.
     
     This is our main upload function that handles all file types. It:
-    1. Generates a secure access token for the file
-    2. Uploads the file to Azure with the right content type
-    3. Returns the URL and token needed to access the file
+    1. Uploads the file with the right content type
+    2. Returns the URL to store in the database (and no token, see above)
     
     We use this for everything - PDFs, images, thumbnails, QR codes, etc.
+    file_content can be bytes or an open file, which is streamed up in blocks.
     """
     try:
         logging.info(f"Uploading blob: {blob_name}, content type: {content_type}, user: {user_alias}")
         
-        # First, get a SAS token that will allow access to this file
-        sas_token, sas_token_expiry = generate_sas_token_for_file(
-            alias=user_alias,
-            file_path=blob_name,
-            content_disposition=content_disposition
-        )
-
         # Build the base URL for this file (without the SAS token)
         # This is what we'll store in the database
-        blob_url = f"https://{AZURE_STORAGE_ACCOUNT_NAME}.blob.core.windows.net/{AZURE_BLOB_CONTAINER_NAME}/{blob_name}"
-
-        # Add the SAS token to create a full access URL
-        blob_url_with_sas = f"{blob_url}?{sas_token}"
+        blob_url = storage_backend.url_for(blob_name)
 
-        # Create a client for uploading to this specific blob
-        blob_client = BlobClient.from_blob_url(blob_url_with_sas)
-
-        # Create content settings with the proper content type and content disposition
-        content_settings = ContentSettings(
-            content_type=content_type
-        )
-        
-        # Add content disposition if provided
         if content_disposition:
-            content_settings.content_disposition = content_disposition
             logging.info(f"Setting Content-Disposition: {content_disposition}")
 
-        # Upload the file with the right content type and content disposition
-        # We use BlockBlob for all our files since they're relatively small
-        blob_client.upload_blob(
-            file_content,
-            blob_type="BlockBlob",
-            overwrite=True,  # Replace if a file with this name already exists
-            content_settings=content_settings
-        )
+        # Upload the file with the right content type and content disposition,
+        # replacing it if a file with this name already exists
+        storage_backend.put_sync(blob_name, file_content, content_type, content_disposition)
+        blob_cache.invalidate(blob_name)
 
         logging.info(f"Successfully uploaded blob to {blob_url}")
         
         # Return everything the app needs to access this file later
-        return blob_url, sas_token, sas_token_expiry
+        return blob_url, None, None
     except Exception as e:
         # Log the error with detailed information
         logging.error(f"Error uploading blob {blob_name} for user {user_alias}: {e}")
         # If anything goes wrong, provide a helpful error message
-        raise Exception(f"Couldn't upload file to Azure: {e}")
+        raise Exception(f"Couldn't upload file to storage: {e}")
+
+def reserve_blob(blob_name, user_alias):
+    """
+    Returns the (url, sas_token, expiry) a file will have once it is uploaded,
+    without uploading anything. Used for slide PDFs that are only made when first
+    needed (LAZY_SLIDE_PDFS), so their database rows can be written up front.
+    """
+    return storage_backend.url_for(blob_name), None, None
+
+def copy_blob(source_blob_name, source_alias, dest_blob_name, dest_alias):
+    """
+    Copies a blob to a new name without the bytes ever passing through our server.
+    
+    Azure does the copy on its side (Put Blob From URL), which is much cheaper than
+    downloading and re-uploading. The content type and other properties come along
+    with the copy. The local backend simply copies the file. Returns the same
+    (url, sas_token, expiry) tuple as upload_to_blob.
+    """
+    try:
+        logging.info(f"Copying blob {source_blob_name} to {dest_blob_name}")
+
+        storage_backend.copy_sync(source_blob_name, dest_blob_name)
+        blob_cache.invalidate(dest_blob_name)
+
+        return storage_backend.url_for(dest_blob_name), None, None
+    except Exception as e:
+        logging.error(f"Error copying blob {source_blob_name} to {dest_blob_name}: {e}")
+        raise Exception(f"Couldn't copy file in storage: {e}")
+
+def list_blob_sizes(prefix):
+    """Returns {blob_name: size_in_bytes} for every blob whose name starts with prefix."""
+    return storage_backend.list_sync(prefix)
+
+def delete_blobs_with_prefix(prefix):
+    """Deletes every blob whose name starts with prefix. Returns how many were deleted."""
+    deleted = 0
+    blob_cache.invalidate_prefix(prefix)
+    for blob_name in list_blob_sizes(prefix):
+        try:
+            if storage_backend.delete_sync(blob_name):
+                deleted += 1
+        except Exception as e:
+            logging.warning(f"Couldn't delete blob {blob_name}: {e}")
+    return deleted
+
+def download_blob_bytes(blob_name, user_alias):
+    """Downloads a whole blob into memory and returns its bytes."""
+    try:
+        return storage_backend.get_sync(blob_name)
+    except Exception as e:
+        logging.error(f"Error downloading blob {blob_name} for user {user_alias}: {e}")
+        raise Exception(f"Couldn't download file from storage: {e}")
+
+def download_blob_to_file(blob_name, user_alias, file_path):
+    """
+    Downloads a blob straight into a local file, a few MB at a time, so large files
+    never have to fit in memory. Returns the number of bytes written.
+    """
+    try:
+        return storage_backend.get_to_file_sync(blob_name, file_path)
+    except Exception as e:
+        logging.error(f"Error downloading blob {blob_name} for user {user_alias}: {e}")
+        raise Exception(f"Couldn't download file from storage: {e}")
+
+def delete_blob(blob_name, user_alias):
+    """Deletes a single blob. Missing blobs are not an error."""
+    blob_cache.invalidate(blob_name)
+    if not storage_backend.delete_sync(blob_name):
+        logging.info(f"Blob already deleted: {blob_name}")
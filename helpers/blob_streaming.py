@@ -0,0 +1,190 @@
+# Streaming stored files to the browser
+#
+# Downloads are passed through to the client a chunk at a time rather than read
+# into memory first, so a 30 MB set costs a few MB of buffer per download however
+# many people are scanning it at once.
+#
+# Range requests are supported (a single range, which is what browsers' PDF viewers
+# and download managers ask for): the viewer can fetch just the pages it is showing
+# and an interrupted download resumes where it stopped. Multi-range requests get the
+# whole file, which the HTTP spec allows.
+#
+# Responses carry an ETag and Last-Modified, and a browser that already has the file
+# gets a bodyless 304 instead. Files that are never rewritten under the same name
+# (set PDFs, QR codes) use an ETag made from their URL, so that check doesn't need
+# to ask storage about the file at all.
+#
+# Bodies come from the read cache (helpers/blob_cache.py). A whole file it doesn't
+# have yet is fetched into it in the background, once however many requests for it
+# arrive together, and sent to each of them as it arrives. Ranges of a file that
+# isn't cached are read straight from storage, so a viewer asking for the last
+# pages doesn't wait for the rest.
+
+import hashlib
+import logging
+from email.utils import format_datetime, parsedate_to_datetime
+from functools import partial
+
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+
+from helpers.blob_cache import blob_cache
+from helpers.storage_backend import storage_backend
+
+
+def parse_range_header(range_header, size):
+    """
+    Works out which bytes a Range header asks for.
+
+    Returns (start, end) with end inclusive, or None to send the whole file
+    (no header, a header we don't handle, or several ranges). Raises ValueError if
+    the range can't be satisfied for a file of this size.
+    """
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+
+    first, separator, last = range_header[len("bytes="):].strip().partition("-")
+    if not separator or not (first or last) or not (first.isdigit() or first == "") or not (last.isdigit() or last == ""):
+        return None  # Malformed - ignore it, as the spec says
+
+    if first == "":
+        # Suffix range - the last N bytes
+        suffix_length = int(last)
+        if suffix_length == 0 or size == 0:
+            raise ValueError(f"Range {range_header} not satisfiable for {size} bytes")
+        return max(size - suffix_length, 0), size - 1
+
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError(f"Range {range_header} not satisfiable for {size} bytes")
+    end = int(last) if last else size - 1
+    return start, min(end, size - 1)
+
+
+def url_etag(blob_url):
+    """A strong ETag for a file that is written once and never changed under its URL."""
+    return '"' + hashlib.sha256(blob_url.encode()).hexdigest()[:32] + '"'
+
+
+def is_not_modified(request: Request, etag, last_modified=None):
+    """
+    True if the client's cached copy is still good, going by If-None-Match, or
+    by If-Modified-Since when there is no If-None-Match (as the HTTP spec says).
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        if not etag:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        # Weak comparison - W/"x" matches "x"
+        client_etags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return etag.removeprefix("W/") in client_etags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified:
+        try:
+            return last_modified.replace(microsecond=0) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _not_modified_response(headers):
+    # A 304 repeats the validators and caching headers, but has no body
+    kept = {name: value for name, value in headers.items()
+            if name in ("ETag", "Last-Modified", "Cache-Control", "Expires", "Vary")}
+    return Response(status_code=304, headers=kept)
+
+
+def is_download_start(response):
+    """
+    True if a response from stream_blob_response starts a download: the whole file,
+    or its first range. 304s, errors and follow-up ranges (a viewer fetching more
+    pages, a resumed download) are not. Used to count each download only once.
+    """
+    if response.status_code == 200:
+        return True
+    return response.status_code == 206 and response.headers.get("content-range", "").startswith("bytes 0-")
+
+
+async def _count_served(chunks, from_storage=False):
+    async for chunk in chunks:
+        blob_cache.record_served(len(chunk))
+        if from_storage:
+            blob_cache.record_fetched(len(chunk))
+        yield chunk
+
+
+async def stream_blob_response(request: Request, blob_url, media_type, headers=None, immutable=False):
+    """
+    Builds the response for a stored file: 304 if the client's copy is current,
+    otherwise 200 with the whole file or 206 with the range the client asked for.
+    headers are added to all of them (Content-Disposition, Cache-Control...).
+
+    Pass immutable=True for files that are never rewritten under the same name;
+    their ETag comes from the URL and a matching If-None-Match is answered without
+    touching storage. Otherwise the storage's own ETag is used.
+
+    Raises BlobNotFound if the file is gone.
+    """
+    response_headers = {"Accept-Ranges": "bytes"}
+    if immutable:
+        response_headers["ETag"] = url_etag(blob_url)
+    response_headers.update(headers or {})
+
+    if immutable and request.headers.get("if-none-match"):
+        if is_not_modified(request, response_headers["ETag"]):
+            return _not_modified_response(response_headers)
+
+    blob_name = storage_backend.name_from_url(blob_url)
+    # Files that never change are used straight from the cache; others only if
+    # the cached copy still matches what is in storage
+    cached = blob_cache.get(blob_name) if immutable else None
+    if cached:
+        info = cached.info
+    else:
+        info = await storage_backend.stat(blob_name)
+        if not immutable:
+            cached = blob_cache.get(blob_name, etag=info.get('etag'))
+    size = info['size']
+
+    if info.get('etag') and not immutable:
+        response_headers["ETag"] = info['etag']
+    if info.get('last_modified'):
+        response_headers["Last-Modified"] = format_datetime(info['last_modified'], usegmt=True)
+
+    if is_not_modified(request, response_headers.get("ETag"), info.get('last_modified')):
+        return _not_modified_response(response_headers)
+
+    # If-Range: only send part of the file if it hasn't changed since the client got the rest
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and if_range and if_range not in (response_headers.get("ETag"), response_headers.get("Last-Modified")):
+        range_header = None
+
+    try:
+        byte_range = parse_range_header(range_header, size)
+    except ValueError:
+        response_headers["Content-Range"] = f"bytes */{size}"
+        return Response(status_code=416, headers=response_headers)
+
+    # Whole files come from the cache, or from its download of them. Ranges of files
+    # that aren't cached yet, and files the cache can't hold, come straight from storage
+    if not cached and byte_range is None:
+        cached = blob_cache.fetch(blob_name, info)
+    source = cached.stream if cached else partial(storage_backend.stream, blob_name)
+
+    if byte_range is None:
+        response_headers["Content-Length"] = str(size)
+        body = _count_served(source(), from_storage=not cached)
+        return StreamingResponse(body, status_code=200, media_type=media_type, headers=response_headers)
+
+    start, end = byte_range
+    logging.info(f"Serving bytes {start}-{end}/{size} of {blob_name}")
+    response_headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    response_headers["Content-Length"] = str(end - start + 1)
+    body = _count_served(source(offset=start, length=end - start + 1), from_storage=not cached)
+    return StreamingResponse(body, status_code=206, media_type=media_type, headers=response_headers)
@@ -0,0 +1,68 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Event loop lag
+#
+# Anything that blocks the event loop (a synchronous query, a big JSON dump...)
+# delays every other request in the process. This measures by how much: a task
+# sleeps EVENT_LOOP_LAG_SAMPLE_SECONDS at a time and records how late it wakes up.
+# The last EVENT_LOOP_LAG_WINDOW samples are shown on /api/system/event-loop, so
+# the effect of a change can be compared under the same load (see load_tests/).
+EVENT_LOOP_LAG_SAMPLE_SECONDS = float(os.getenv("EVENT_LOOP_LAG_SAMPLE_SECONDS", "0.1"))
+EVENT_LOOP_LAG_WINDOW = 600
+
+
+class LoopLagMonitor:
+    """Samples how late the event loop runs a sleeping task."""
+
+    def __init__(self, interval=EVENT_LOOP_LAG_SAMPLE_SECONDS, window=EVENT_LOOP_LAG_WINDOW):
+        self.interval = interval
+        self._lags = deque(maxlen=window)
+        self._max_lag = 0.0
+        self._samples = 0
+        self._task = None
+
+    async def _sample(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - started - self.interval)
+            self._lags.append(lag)
+            self._max_lag = max(self._max_lag, lag)
+            self._samples += 1
+
+    def start(self):
+        """Starts sampling in the background. Call from the event loop at startup."""
+        self._task = asyncio.create_task(self._sample())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def reset(self):
+        """Forgets the samples so far, e.g. right before a load test."""
+        self._lags.clear()
+        self._max_lag = 0.0
+
+    def stats(self):
+        lags = sorted(self._lags)
+        if not lags:
+            return {'samples': self._samples, 'interval_ms': self.interval * 1000}
+        return {
+            'samples': self._samples,
+            'interval_ms': self.interval * 1000,
+            'window': len(lags),
+            'mean_ms': round(sum(lags) / len(lags) * 1000, 2),
+            'p95_ms': round(lags[min(len(lags) - 1, int(0.95 * len(lags)))] * 1000, 2),
+            'max_ms': round(lags[-1] * 1000, 2),
+            'max_since_reset_ms': round(self._max_lag * 1000, 2)
+        }
+
+
+loop_monitor = LoopLagMonitor()
@@ -0,0 +1,78 @@
+# Signed URLs on demand
+#
+# Browsers get at stored files through signed URLs (a SAS token on Azure). Rather
+# than reading a token stored with every row - which then has to be rewritten
+# whenever it rolls over - pages sign the file's path when they need a link.
+#
+# Expiry times are rounded up to the end of a SIGNED_URL_BUCKET_MINUTES bucket, so
+# the same file gets the same URL for the whole bucket (browsers can cache
+# thumbnails, and each URL is only signed once per bucket, see _memo). A URL is
+# valid for at least SIGNED_URL_LIFETIME_HOURS after it was handed out.
+#
+# The tokens stored in the database are no longer read by the app.
+
+import os
+import threading
+from datetime import datetime, timezone
+
+from helpers.storage_backend import storage_backend
+
+SIGNED_URL_LIFETIME_HOURS = float(os.getenv("SIGNED_URL_LIFETIME_HOURS", "24"))
+SIGNED_URL_BUCKET_MINUTES = float(os.getenv("SIGNED_URL_BUCKET_MINUTES", "60"))
+SIGNED_URL_MEMO_MAX_ENTRIES = int(os.getenv("SIGNED_URL_MEMO_MAX_ENTRIES", "50000"))
+
+# (blob name, content disposition) -> token, for the current expiry bucket only
+_memo = {}
+_memo_bucket = None
+_memo_lock = threading.Lock()
+signed_url_stats = {'signed': 0, 'memo_hits': 0}
+
+
+def _current_bucket():
+    bucket_seconds = SIGNED_URL_BUCKET_MINUTES * 60
+    bucket = int(datetime.now(timezone.utc).timestamp() // bucket_seconds)
+    expiry = datetime.fromtimestamp((bucket + 1) * bucket_seconds + SIGNED_URL_LIFETIME_HOURS * 3600, timezone.utc)
+    return bucket, expiry
+
+
+def sign_blob(blob_name, content_disposition=None):
+    """Returns (token, expiry) for a stored file, signing it at most once per bucket."""
+    global _memo_bucket
+    bucket, expiry = _current_bucket()
+    key = (blob_name, content_disposition)
+    with _memo_lock:
+        if bucket != _memo_bucket or len(_memo) >= SIGNED_URL_MEMO_MAX_ENTRIES:
+            _memo.clear()
+            _memo_bucket = bucket
+        token = _memo.get(key)
+        if token is not None:
+            signed_url_stats['memo_hits'] += 1
+            return token, expiry
+
+    token = storage_backend.sign(blob_name, expiry, content_disposition)
+    with _memo_lock:
+        if _memo_bucket == bucket:
+            _memo[key] = token
+        signed_url_stats['signed'] += 1
+    return token, expiry
+
+
+def signed_url(blob_url, content_disposition=None):
+    """
+    Returns a short-lived URL for a file, given the URL stored in the database
+    (None for None). content_disposition makes browsers download it under that name.
+    """
+    if not blob_url:
+        return None
+    token, _ = sign_blob(storage_backend.name_from_url(blob_url), content_disposition)
+    return f"{blob_url}?{token}"
+
+
+def get_signed_url_stats():
+    with _memo_lock:
+        return {
+            'lifetime_hours': SIGNED_URL_LIFETIME_HOURS,
+            'bucket_minutes': SIGNED_URL_BUCKET_MINUTES,
+            'memo_entries': len(_memo),
+            **signed_url_stats
+        }
@@ -0,0 +1,67 @@
+# Request coalescing
+#
+# When a class scans a QR code, dozens of requests for the same set arrive at once.
+# A SingleFlight makes them share the work: the first request for a key does it, and
+# every request for the same key that arrives while it is running waits for that
+# result instead of doing it again. Once it finishes the next request starts afresh,
+# so nothing is cached here - that is what the caches are for.
+
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Every SingleFlight, by name, for the admin stats
+_registry = {}
+
+
+class SingleFlight:
+    """Runs one call per key at a time, sharing its result with everyone who asks meanwhile."""
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._stats = {'calls': 0, 'shared': 0, 'errors': 0, 'max_waiters': 0}
+        _registry[name] = self
+
+    async def do(self, key, func, *args):
+        """
+        Returns await func(*args), or the result of the call for the same key that
+        is already running. Exceptions are shared the same way.
+
+        A caller that goes away (e.g. the client disconnects) doesn't cancel the call
+        for the others.
+        """
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = {'task': asyncio.ensure_future(self._run(key, func, args)), 'waiters': 1}
+            self._stats['calls'] += 1
+        else:
+            call['waiters'] += 1
+            self._stats['shared'] += 1
+            self._stats['max_waiters'] = max(self._stats['max_waiters'], call['waiters'])
+        return await asyncio.shield(call['task'])
+
+    async def _run(self, key, func, args):
+        try:
+            return await func(*args)
+        except Exception:
+            self._stats['errors'] += 1
+            raise
+        finally:
+            # Released in the same event loop step func returns in, so nobody can
+            # join a call after it has produced its result
+            call = self._calls.pop(key, None)
+            if call and call['waiters'] > 1:
+                logger.info(f"{self.name}: {call['waiters']} requests shared one call for {key}")
+
+    def in_flight(self):
+        return len(self._calls)
+
+    def stats(self):
+        return {**self._stats, 'in_flight': self.in_flight()}
+
+
+def get_single_flight_stats():
+    """How much work each SingleFlight has saved since the server started, for admins."""
+    return {name: single_flight.stats() for name, single_flight in _registry.items()}
@@ -0,0 +1,482 @@
+# Storage backends
+#
+# Everything the app stores (uploads, PDFs, slide PDFs, thumbnails, QR codes, sets)
+# goes through one StorageBackend, picked with STORAGE_BACKEND:
+#
+# - azure (default) - Azure Blob Storage, through the shared clients in storage_clients.py.
+#   Signed URLs are SAS URLs served by Azure.
+# - local - plain files under LOCAL_STORAGE_DIR. Signed URLs point back at this app
+#   (/storage/..., see api/storage_files.py), which checks the signature and serves
+#   the file. Lets the whole upload-to-set pipeline, and benchmarks, run offline.
+#
+# Files are always addressed by blob name (user_alias/pdf/..., see blob_op.py).
+# url_for() gives the plain URL we store in the database, and a signed token is
+# appended to it as a query string, so "{url}?{token}" works for either backend.
+#
+# Every operation has an async form for the event loop and a _sync form for code
+# that already runs in a thread. The base class runs the _sync form in the default
+# thread pool, so a backend only has to provide the async form where it can do better.
+
+import os
+import hmac
+import time
+import shutil
+import asyncio
+import hashlib
+import logging
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse, unquote, quote, parse_qs, urlencode
+
+from dotenv import load_dotenv
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import generate_blob_sas, BlobSasPermissions, ContentSettings
+
+from helpers.storage_clients import (
+    storage_clients, blob_name_from_url, STORAGE_UPLOAD_CONCURRENCY,
+    AZURE_STORAGE_ACCOUNT_NAME, AZURE_STORAGE_ACCOUNT_KEY, AZURE_BLOB_CONTAINER_NAME
+)
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# STORAGE_BACKEND - azure or local
+# LOCAL_STORAGE_DIR - where the local backend keeps its files
+# LOCAL_STORAGE_BASE_URL - public address of this app, used in local file URLs
+# LOCAL_STORAGE_SECRET - key for signing local URLs (defaults to SECRET_KEY)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "azure").lower()
+LOCAL_STORAGE_DIR = os.getenv("LOCAL_STORAGE_DIR", "local_storage")
+LOCAL_STORAGE_BASE_URL = os.getenv("LOCAL_STORAGE_BASE_URL", os.getenv("BASE_URL", "http://localhost:8000")).rstrip('/')
+LOCAL_STORAGE_SECRET = os.getenv("LOCAL_STORAGE_SECRET") or os.getenv("SECRET_KEY") or ""
+
+# Route prefix the local backend's files are served under
+LOCAL_STORAGE_ROUTE = "/storage"
+
+# Chunk size for stream()
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+class BlobNotFound(Exception):
+    """Raised by get/stream when a file doesn't exist, whichever backend is in use."""
+
+
+class StorageBackend:
+    """The operations the app needs from a storage service."""
+
+    name = None
+
+    async def start(self):
+        """Opens connections or creates folders. Called on app and worker startup."""
+
+    async def close(self):
+        """Releases whatever start() opened."""
+
+    # --- Addressing ---
+
+    def url_for(self, blob_name):
+        """The plain URL of a file, as stored in the database."""
+        raise NotImplementedError
+
+    def name_from_url(self, blob_url):
+        """Turns a URL from url_for() (with or without a token) back into a blob name."""
+        raise NotImplementedError
+
+    def sign(self, blob_name, expiry, content_disposition=None):
+        """A read-only token for blob_name until expiry, to append to its URL as a query string."""
+        raise NotImplementedError
+
+    def signed_url(self, blob_name, expiry, content_disposition=None):
+        """url_for() with a token from sign() attached."""
+        return f"{self.url_for(blob_name)}?{self.sign(blob_name, expiry, content_disposition)}"
+
+    # --- Sync operations ---
+
+    def put_sync(self, blob_name, data, content_type, content_disposition=None):
+        """Stores bytes or the contents of an open file under blob_name, replacing any existing file."""
+        raise NotImplementedError
+
+    def get_sync(self, blob_name):
+        """Returns the whole file as bytes."""
+        raise NotImplementedError
+
+    def get_to_file_sync(self, blob_name, file_path):
+        """Writes the file to file_path a chunk at a time. Returns the number of bytes written."""
+        raise NotImplementedError
+
+    def delete_sync(self, blob_name):
+        """Deletes a file. Returns False if it didn't exist."""
+        raise NotImplementedError
+
+    def list_sync(self, prefix):
+        """Returns {blob_name: size_in_bytes} for every file whose name starts with prefix."""
+        raise NotImplementedError
+
+    def stat_sync(self, blob_name):
+        """Returns {'size', 'etag', 'last_modified'} for a file, without reading it."""
+        raise NotImplementedError
+
+    def copy_sync(self, source_blob_name, dest_blob_name):
+        """Copies a file to a new name, on the storage side where possible."""
+        raise NotImplementedError
+
+    # --- Async operations ---
+
+    async def _in_thread(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    async def put(self, blob_name, data, content_type, content_disposition=None):
+        return await self._in_thread(self.put_sync, blob_name, data, content_type, content_disposition)
+
+    async def get(self, blob_name):
+        return await self._in_thread(self.get_sync, blob_name)
+
+    async def get_to_file(self, blob_name, file_path):
+        return await self._in_thread(self.get_to_file_sync, blob_name, file_path)
+
+    async def delete(self, blob_name):
+        return await self._in_thread(self.delete_sync, blob_name)
+
+    async def list(self, prefix):
+        return await self._in_thread(self.list_sync, prefix)
+
+    async def stat(self, blob_name):
+        return await self._in_thread(self.stat_sync, blob_name)
+
+    async def copy(self, source_blob_name, dest_blob_name):
+        return await self._in_thread(self.copy_sync, source_blob_name, dest_blob_name)
+
+    async def stream(self, blob_name, chunk_size=STREAM_CHUNK_SIZE, offset=0, length=None):
+        """
+        Yields the file's bytes a chunk at a time, without holding the whole file.
+        offset and length select a byte range (length None means to the end).
+        """
+        raise NotImplementedError
+        yield  # Makes this an async generator, like the real implementations
+
+
+class AzureStorageBackend(StorageBackend):
+    """Azure Blob Storage, using the pooled clients in storage_clients.py."""
+
+    name = "azure"
+
+    async def start(self):
+        await storage_clients.start_async()
+
+    async def close(self):
+        await storage_clients.close()
+
+    def url_for(self, blob_name):
+        return f"https://{AZURE_STORAGE_ACCOUNT_NAME}.blob.core.windows.net/{AZURE_BLOB_CONTAINER_NAME}/{blob_name}"
+
+    def name_from_url(self, blob_url):
+        return blob_name_from_url(blob_url)[1]
+
+    def sign(self, blob_name, expiry, content_disposition=None):
+        return generate_blob_sas(
+            account_name=AZURE_STORAGE_ACCOUNT_NAME,
+            container_name=AZURE_BLOB_CONTAINER_NAME,
+            blob_name=blob_name,
+            account_key=AZURE_STORAGE_ACCOUNT_KEY,
+            # Read only. These tokens end up in browsers, and the copy source only needs reading too
+            permission=BlobSasPermissions(read=True),
+            expiry=expiry,
+            content_disposition=content_disposition  # Controls how browsers handle the file when downloaded
+        )
+
+    def _content_settings(self, content_type, content_disposition):
+        content_settings = ContentSettings(content_type=content_type)
+        if content_disposition:
+            content_settings.content_disposition = content_disposition
+        return content_settings
+
+    def _copy_source_url(self, source_blob_name):
+        # The source needs a token so Azure can read it on our behalf
+        return self.signed_url(source_blob_name, datetime.now(timezone.utc) + timedelta(hours=1))
+
+    def put_sync(self, blob_name, data, content_type, content_disposition=None):
+        with storage_clients.track("upload"):
+            storage_clients.blob_client(blob_name).upload_blob(
+                data,
+                blob_type="BlockBlob",
+                overwrite=True,
+                content_settings=self._content_settings(content_type, content_disposition)
+            )
+
+    def get_sync(self, blob_name):
+        try:
+            with storage_clients.track("download"):
+                return storage_clients.blob_client(blob_name).download_blob().readall()
+        except ResourceNotFoundError:
+            raise BlobNotFound(blob_name)
+
+    def get_to_file_sync(self, blob_name, file_path):
+        try:
+            with open(file_path, "wb") as local_file, storage_clients.track("download"):
+                return storage_clients.blob_client(blob_name).download_blob().readinto(local_file)
+        except ResourceNotFoundError:
+            raise BlobNotFound(blob_name)
+
+    def delete_sync(self, blob_name):
+        try:
+            with storage_clients.track("delete"):
+                storage_clients.blob_client(blob_name).delete_blob()
+            return True
+        except ResourceNotFoundError:
+            return False
+
+    def list_sync(self, prefix):
+        with storage_clients.track("list"):
+            return {blob.name: blob.size for blob in storage_clients.container_client.list_blobs(name_starts_with=prefix)}
+
+    def stat_sync(self, blob_name):
+        try:
+            with storage_clients.track("stat"):
+                properties = storage_clients.blob_client(blob_name).get_blob_properties()
+        except ResourceNotFoundError:
+            raise BlobNotFound(blob_name)
+        return {'size': properties.size, 'etag': properties.etag, 'last_modified': properties.last_modified}
+
+    def copy_sync(self, source_blob_name, dest_blob_name):
+        # Put Blob From URL - Azure copies on its side, the bytes never pass through us
+        with storage_clients.track("copy"):
+            storage_clients.blob_client(dest_blob_name).upload_blob_from_url(self._copy_source_url(source_blob_name), overwrite=True)
+
+    async def put(self, blob_name, data, content_type, content_disposition=None):
+        blob_client = await storage_clients.async_blob_client(blob_name)
+        with storage_clients.track("async_upload"):
+            await blob_client.upload_blob(
+                data,
+                blob_type="BlockBlob",
+                overwrite=True,
+                content_settings=self._content_settings(content_type, content_disposition),
+                max_concurrency=STORAGE_UPLOAD_CONCURRENCY
+            )
+
+    async def get(self, blob_name):
+        blob_client = await storage_clients.async_blob_client(blob_name)
+        try:
+            with storage_clients.track("async_download"):
+                downloader = await blob_client.download_blob()
+                return await downloader.readall()
+        except ResourceNotFoundError:
+            raise BlobNotFound(blob_name)
+
+    async def get_to_file(self, blob_name, file_path):
+        blob_client = await storage_clients.async_blob_client(blob_name)
+        try:
+            with open(file_path, "wb") as local_file, storage_clients.track("async_download"):
+                downloader = await blob_client.download_blob()
+                return await downloader.readinto(local_file)
+        except ResourceNotFoundError:
+            raise BlobNotFound(blob_name)
+
+    async def delete(self, blob_name):
+        blob_client = await storage_clients.async_blob_client(blob_name)
+        try:
+            with storage_clients.track("async_delete"):
+                await blob_client.delete_blob()
+            return True
+        except ResourceNotFoundError:
+            return False
+
+    async def list(self, prefix):
+        container_client = await storage_clients.async_container_client()
+        with storage_clients.track("async_list"):
+            return {blob.name: blob.size async for blob in container_client.list_blobs(name_starts_with=prefix)}
+
+    async def stat(self, blob_name):
+        blob_client = await storage_clients.async_blob_client(blob_name)
+        try:
+            with storage_clients.track("async_stat"):
+                properties = await blob_client.get_blob_properties()
+        except ResourceNotFoundError:
+            raise BlobNotFound(blob_name)
+        return {'size': properties.size, 'etag': properties.etag, 'last_modified': properties.last_modified}
+
+    async def copy(self, source_blob_name, dest_blob_name):
+        blob_client = await storage_clients.async_blob_client(dest_blob_name)
+        with storage_clients.track("async_copy"):
+            await blob_client.upload_blob_from_url(self._copy_source_url(source_blob_name), overwrite=True)
+
+    async def stream(self, blob_name, chunk_size=STREAM_CHUNK_SIZE, offset=0, length=None):
+        # Azure sends the range in pieces of the client's max_chunk_get_size (4 MB),
+        # one piece at a time, so chunk_size isn't used here
+        blob_client = await storage_clients.async_blob_client(blob_name)
+        try:
+            with storage_clients.track("async_stream"):
+                downloader = await blob_client.download_blob(
+                    offset=offset if offset or length is not None else None, length=length, max_concurrency=1
+                )
+                async for chunk in downloader.chunks():
+                    yield chunk
+        except ResourceNotFoundError:
+            raise BlobNotFound(blob_name)
+
+
+class LocalStorageBackend(StorageBackend):
+    """
+    Files on local disk, one file per blob name under root.
+
+    Signed URLs are HMAC-signed links to this app's /storage route. Content types
+    are worked out from the file extension when a file is served, and the content
+    disposition comes from the signed URL, as with Azure SAS tokens.
+    """
+
+    name = "local"
+
+    def __init__(self, root=LOCAL_STORAGE_DIR, base_url=LOCAL_STORAGE_BASE_URL, secret=LOCAL_STORAGE_SECRET):
+        self.root = os.path.abspath(root)
+        self.base_url = base_url
+        self._secret = secret.encode()
+
+    async def start(self):
+        os.makedirs(self.root, exist_ok=True)
+        logger.info(f"Local storage backend serving files from {self.root}")
+
+    def path_for(self, blob_name):
+        """Where blob_name lives on disk. Refuses names that would escape the storage folder."""
+        path = os.path.abspath(os.path.join(self.root, blob_name))
+        if os.path.commonpath([self.root, path]) != self.root or path == self.root:
+            raise ValueError(f"Invalid blob name: {blob_name}")
+        return path
+
+    def url_for(self, blob_name):
+        return f"{self.base_url}{LOCAL_STORAGE_ROUTE}/{quote(blob_name)}"
+
+    def name_from_url(self, blob_url):
+        path = unquote(urlparse(blob_url).path)
+        if not path.startswith(f"{LOCAL_STORAGE_ROUTE}/"):
+            raise ValueError(f"Not a local storage URL: {blob_url}")
+        return path[len(LOCAL_STORAGE_ROUTE) + 1:]
+
+    def _signature(self, blob_name, expires, content_disposition):
+        message = f"{blob_name}\n{expires}\n{content_disposition or ''}".encode()
+        return hmac.new(self._secret, message, hashlib.sha256).hexdigest()
+
+    def sign(self, blob_name, expiry, content_disposition=None):
+        expires = int(expiry.timestamp())
+        params = {'se': expires}
+        if content_disposition:
+            params['rscd'] = content_disposition
+        params['sig'] = self._signature(blob_name, expires, content_disposition)
+        return urlencode(params)
+
+    def verify(self, blob_name, token):
+        """
+        Checks a token from sign() against blob_name. Returns the content disposition
+        it was signed with ('' for none), or None if the token is invalid or expired.
+        """
+        params = {key: values[0] for key, values in parse_qs(token).items()}
+        try:
+            expires = int(params.get('se', ''))
+        except ValueError:
+            return None
+        if expires < time.time():
+            return None
+        content_disposition = params.get('rscd', '')
+        expected = self._signature(blob_name, expires, content_disposition)
+        if not hmac.compare_digest(expected, params.get('sig', '')):
+            return None
+        return content_disposition
+
+    def put_sync(self, blob_name, data, content_type, content_disposition=None):
+        path = self.path_for(blob_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to the side and swap in, so readers never see half a file
+        partial_path = f"{path}.{os.getpid()}.{id(data)}.part"
+        with storage_clients.track("local_put"):
+            try:
+                with open(partial_path, "wb") as local_file:
+                    if isinstance(data, (bytes, bytearray, memoryview)):
+                        local_file.write(data)
+                    else:
+                        shutil.copyfileobj(data, local_file, STREAM_CHUNK_SIZE)
+                os.replace(partial_path, path)
+            finally:
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+
+    def get_sync(self, blob_name):
+        try:
+            with open(self.path_for(blob_name), "rb") as local_file, storage_clients.track("local_get"):
+                return local_file.read()
+        except FileNotFoundError:
+            raise BlobNotFound(blob_name)
+
+    def get_to_file_sync(self, blob_name, file_path):
+        try:
+            with storage_clients.track("local_get"):
+                shutil.copyfile(self.path_for(blob_name), file_path)
+        except FileNotFoundError:
+            raise BlobNotFound(blob_name)
+        return os.path.getsize(file_path)
+
+    def delete_sync(self, blob_name):
+        try:
+            with storage_clients.track("local_delete"):
+                os.remove(self.path_for(blob_name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def list_sync(self, prefix):
+        # Only walk the folder the prefix points into
+        start_dir = os.path.join(self.root, os.path.dirname(prefix))
+        sizes = {}
+        with storage_clients.track("local_list"):
+            for dir_path, _, file_names in os.walk(start_dir):
+                for file_name in file_names:
+                    if file_name.endswith(".part"):
+                        continue
+                    path = os.path.join(dir_path, file_name)
+                    blob_name = os.path.relpath(path, self.root).replace(os.sep, '/')
+                    if blob_name.startswith(prefix):
+                        sizes[blob_name] = os.path.getsize(path)
+        return sizes
+
+    def stat_sync(self, blob_name):
+        try:
+            stat = os.stat(self.path_for(blob_name))
+        except FileNotFoundError:
+            raise BlobNotFound(blob_name)
+        return {
+            'size': stat.st_size,
+            'etag': f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"',
+            'last_modified': datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+        }
+
+    def copy_sync(self, source_blob_name, dest_blob_name):
+        with open(self.path_for(source_blob_name), "rb") as source_file:
+            self.put_sync(dest_blob_name, source_file, None)
+
+    async def stream(self, blob_name, chunk_size=STREAM_CHUNK_SIZE, offset=0, length=None):
+        try:
+            local_file = open(self.path_for(blob_name), "rb")
+        except FileNotFoundError:
+            raise BlobNotFound(blob_name)
+        try:
+            with storage_clients.track("local_stream"):
+                local_file.seek(offset)
+                remaining = length
+                while remaining is None or remaining > 0:
+                    read_size = chunk_size if remaining is None else min(chunk_size, remaining)
+                    chunk = await self._in_thread(local_file.read, read_size)
+                    if not chunk:
+                        break
+                    if remaining is not None:
+                        remaining -= len(chunk)
+                    yield chunk
+        finally:
+            local_file.close()
+
+
+def _create_backend():
+    if STORAGE_BACKEND == "local":
+        return LocalStorageBackend()
+    if STORAGE_BACKEND != "azure":
+        raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+    return AzureStorageBackend()
+
+
+# One backend per process
+storage_backend = _create_backend()
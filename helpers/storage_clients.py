@@ -0,0 +1,221 @@
+# Shared storage clients
+#
+# Every blob operation in the app goes through the clients kept here, instead of
+# building a fresh BlobClient or aiohttp session per call. That way connections to
+# Azure stay open between requests and we only pay for DNS, TCP and TLS setup once
+# per pooled connection.
+#
+# - blob_client(name) - sync Azure SDK clients sharing one keep-alive requests
+#   connection pool, authenticated with the account key
+# - async_blob_client(name) - the same, from the async Azure SDK
+#   (azure.storage.blob.aio), for use in request handlers
+#
+# The async clients share one aiohttp session.
+#
+# Both are created when the app (or worker) starts, and lazily on first use
+# otherwise. status() reports pool utilisation for the admin system page.
+
+import os
+import time
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse, unquote
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from azure.core.pipeline.transport import RequestsTransport, AioHttpTransport
+from azure.storage.blob import BlobServiceClient
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+
+logger = logging.getLogger(__name__)
+
+AZURE_STORAGE_ACCOUNT_NAME = os.getenv("AZURE_STORAGE_ACCOUNT_NAME")
+AZURE_STORAGE_ACCOUNT_KEY = os.getenv("AZURE_STORAGE_ACCOUNT_KEY")
+AZURE_BLOB_CONTAINER_NAME = os.getenv("AZURE_BLOB_CONTAINER_NAME")
+
+# STORAGE_HTTP_POOL_SIZE - keep-alive connections to Azure per client (sync and async)
+# STORAGE_HTTP_CONNECT_TIMEOUT / STORAGE_HTTP_READ_TIMEOUT - seconds
+STORAGE_HTTP_POOL_SIZE = int(os.getenv("STORAGE_HTTP_POOL_SIZE", "64"))
+STORAGE_HTTP_CONNECT_TIMEOUT = int(os.getenv("STORAGE_HTTP_CONNECT_TIMEOUT", "20"))
+STORAGE_HTTP_READ_TIMEOUT = int(os.getenv("STORAGE_HTTP_READ_TIMEOUT", "120"))
+
+# Large uploads are split into blocks of STORAGE_BLOCK_SIZE_MB, and up to
+# STORAGE_UPLOAD_CONCURRENCY blocks of one upload are sent at the same time.
+# Anything up to STORAGE_SINGLE_PUT_MB goes up in a single request.
+STORAGE_BLOCK_SIZE_MB = int(os.getenv("STORAGE_BLOCK_SIZE_MB", "4"))
+STORAGE_SINGLE_PUT_MB = int(os.getenv("STORAGE_SINGLE_PUT_MB", "8"))
+STORAGE_UPLOAD_CONCURRENCY = int(os.getenv("STORAGE_UPLOAD_CONCURRENCY", "4"))
+
+
+def blob_name_from_url(blob_url):
+    """Splits https://<account>.blob.core.windows.net/<container>/<blob> into (container, blob)."""
+    container, blob_name = urlparse(blob_url).path.lstrip('/').split('/', 1)
+    return unquote(container), unquote(blob_name)
+
+
+class StorageClients:
+    """Owns the shared Azure and HTTP clients, and counts what goes through them."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._http_adapter = None
+        self._service_client = None
+        self._container_client = None
+        self._http_session = None
+        self._http_session_loop = None
+        self._async_service_client = None
+        self._async_container_client = None
+        self._operations = {}
+
+    def start(self):
+        """Creates the sync Azure clients. Safe to call more than once."""
+        with self._lock:
+            if self._service_client is not None:
+                return
+
+            session = requests.Session()
+            self._http_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=STORAGE_HTTP_POOL_SIZE)
+            session.mount("https://", self._http_adapter)
+            session.mount("http://", self._http_adapter)
+
+            self._service_client = BlobServiceClient(
+                account_url=f"https://{AZURE_STORAGE_ACCOUNT_NAME}.blob.core.windows.net",
+                credential=AZURE_STORAGE_ACCOUNT_KEY,
+                transport=RequestsTransport(session=session, session_owner=False),
+                connection_timeout=STORAGE_HTTP_CONNECT_TIMEOUT,
+                read_timeout=STORAGE_HTTP_READ_TIMEOUT,
+                max_block_size=STORAGE_BLOCK_SIZE_MB * 1024 * 1024,
+                max_single_put_size=STORAGE_SINGLE_PUT_MB * 1024 * 1024
+            )
+            self._container_client = self._service_client.get_container_client(AZURE_BLOB_CONTAINER_NAME)
+            logger.info(f"Storage clients ready (pool size {STORAGE_HTTP_POOL_SIZE})")
+
+    async def start_async(self):
+        """Creates the sync clients, and the async clients for the running event loop."""
+        await asyncio.get_event_loop().run_in_executor(None, self.start)
+        await self.async_container_client()
+
+    async def close(self):
+        """Closes the async clients and their aiohttp session. The sync pool closes with the process."""
+        if self._async_service_client is not None:
+            await self._async_service_client.close()
+        self._async_service_client = None
+        self._async_container_client = None
+        if self._http_session is not None and not self._http_session.closed:
+            await self._http_session.close()
+        self._http_session = None
+
+    @property
+    def container_client(self):
+        if self._container_client is None:
+            self.start()
+        return self._container_client
+
+    def blob_client(self, blob_name):
+        """Returns a client for a blob in our container, sharing the pooled connections."""
+        return self.container_client.get_blob_client(blob_name)
+
+    async def http_session(self):
+        """Returns the shared aiohttp session, creating it for the running loop if needed."""
+        loop = asyncio.get_event_loop()
+        if self._http_session is None or self._http_session.closed or self._http_session_loop is not loop:
+            connector = aiohttp.TCPConnector(limit=STORAGE_HTTP_POOL_SIZE, keepalive_timeout=60)
+            self._http_session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(sock_connect=STORAGE_HTTP_CONNECT_TIMEOUT, sock_read=STORAGE_HTTP_READ_TIMEOUT)
+            )
+            self._http_session_loop = loop
+            # Async Azure clients are bound to the old session, so they go too
+            self._async_service_client = None
+            self._async_container_client = None
+        return self._http_session
+
+    async def _async_service(self):
+        session = await self.http_session()
+        if self._async_service_client is None:
+            self._async_service_client = AsyncBlobServiceClient(
+                account_url=f"https://{AZURE_STORAGE_ACCOUNT_NAME}.blob.core.windows.net",
+                credential=AZURE_STORAGE_ACCOUNT_KEY,
+                transport=AioHttpTransport(session=session, session_owner=False),
+                connection_timeout=STORAGE_HTTP_CONNECT_TIMEOUT,
+                read_timeout=STORAGE_HTTP_READ_TIMEOUT,
+                max_block_size=STORAGE_BLOCK_SIZE_MB * 1024 * 1024,
+                max_single_put_size=STORAGE_SINGLE_PUT_MB * 1024 * 1024
+            )
+            self._async_container_client = self._async_service_client.get_container_client(AZURE_BLOB_CONTAINER_NAME)
+        return self._async_service_client
+
+    async def async_container_client(self):
+        """Async version of container_client."""
+        await self._async_service()
+        return self._async_container_client
+
+    async def async_blob_client(self, blob_name):
+        """Async version of blob_client."""
+        return (await self.async_container_client()).get_blob_client(blob_name)
+
+    @contextmanager
+    def track(self, operation):
+        """Counts a storage operation, its failures and its time, for status()."""
+        with self._lock:
+            stats = self._operations.setdefault(operation, {'count': 0, 'errors': 0, 'in_flight': 0, 'total_seconds': 0.0})
+            stats['count'] += 1
+            stats['in_flight'] += 1
+        started = time.time()
+        try:
+            yield
+        except Exception:
+            with self._lock:
+                stats['errors'] += 1
+            raise
+        finally:
+            with self._lock:
+                stats['in_flight'] -= 1
+                stats['total_seconds'] += time.time() - started
+
+    def status(self):
+        """Pool sizes, connections in use and per-operation counters."""
+        sync_pools = []
+        if self._http_adapter is not None:
+            pools = self._http_adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None or pool.pool is None:
+                    continue
+                # The pool queue holds idle connections and free slots, the rest are in use
+                sync_pools.append({
+                    'host': pool.host,
+                    'max_size': pool.pool.maxsize,
+                    'in_use': pool.pool.maxsize - pool.pool.qsize(),
+                    'connections_opened': pool.num_connections,
+                    'requests': pool.num_requests
+                })
+
+        async_pool = None
+        if self._http_session is not None and not self._http_session.closed:
+            connector = self._http_session.connector
+            async_pool = {
+                'limit': connector.limit,
+                'in_flight': sum(stats['in_flight'] for name, stats in self._operations.items() if name.startswith('async_'))
+            }
+
+        with self._lock:
+            operations = {}
+            for name, stats in self._operations.items():
+                operations[name] = dict(stats)
+                operations[name]['avg_ms'] = round(stats['total_seconds'] * 1000 / stats['count'], 1) if stats['count'] else 0
+                del operations[name]['total_seconds']
+
+        return {
+            'pool_size': STORAGE_HTTP_POOL_SIZE,
+            'sync_pools': sync_pools,
+            'async_pool': async_pool,
+            'operations': operations
+        }
+
+
+# One set of clients per process
+storage_clients = StorageClients()
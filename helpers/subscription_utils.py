@@ -1,6 +1,8 @@
 """
 Utility functions for subscription management.
 """
+from database_op.user_usage import get_usage
+
 
 def check_downgrade_eligibility(user_id: int, target_tier: int, db):
     """
@@ -17,22 +19,10 @@ def check_downgrade_eligibility(user_id: int, target_tier: int, db):
     cursor = db.cursor(dictionary=True)
     
     try:
-        # Get the number of presentations
-        cursor.execute("SELECT COUNT(*) as count FROM pdf WHERE user_id = %s", (user_id,))
-        presentation_count = cursor.fetchone()['count']
-        
-        # Get the maximum number of sets per presentation
-        cursor.execute("""
-            SELECT p.pdf_id, COUNT(s.set_id) as set_count
-            FROM pdf p
-            LEFT JOIN `set` s ON p.pdf_id = s.pdf_id
-            WHERE p.user_id = %s
-            GROUP BY p.pdf_id
-            ORDER BY set_count DESC
-            LIMIT 1
-        """, (user_id,))
-        max_sets_result = cursor.fetchone()
-        max_sets = max_sets_result['set_count'] if max_sets_result else 0
+        # Both come from the user's usage summary (database_op/user_usage.py)
+        usage = get_usage(cursor, user_id)
+        presentation_count = usage['presentation_count']
+        max_sets = usage['max_sets_per_presentation']
         
         # Check limits based on target tier
         if target_tier == 0:  # Free tier
@@ -3,10 +3,13 @@ import mysql.connector
 from typing import Dict, Optional
 from passlib.context import CryptContext
 
-# Helper function to extract session data and fetch user details from the database
+from database_op.async_database import DictCursor
+
+# Helper function to extract session data and fetch user details from the database.
+# db is a connection from the async pool (database_op/async_database.py)
 async def get_user_data_from_session(
     request: Request,
-    db: mysql.connector.connection.MySQLConnection
+    db
 ) -> Dict[str, Optional[str]]:
     try:
         # Extract the user_id from session
@@ -16,16 +19,13 @@ async def get_user_data_from_session(
             raise HTTPException(status_code=401, detail="User not authenticated")
 
         # Query the database to get the user details
-        cursor = db.cursor(dictionary=True, buffered=True)
-        cursor.execute("SELECT user_id, email, premium_status, member_since, account_activated, login_method, alias FROM user WHERE user_id = %s", (user_id,))
-        user_data = cursor.fetchone()
+        async with db.cursor(DictCursor) as cursor:
+            await cursor.execute("SELECT user_id, email, premium_status, member_since, account_activated, login_method, alias FROM user WHERE user_id = %s", (user_id,))
+            user_data = await cursor.fetchone()
 
         if not user_data:
             raise HTTPException(status_code=404, detail="User not found")
 
-        # Ensure to close the cursor after the operation
-        cursor.close()
-
         return {
             "user_id": user_data['user_id'],
             "email": user_data['email'],
@@ -37,11 +37,6 @@ async def get_user_data_from_session(
         }
 
     except Exception as e:
-        # Ensure the cursor is closed in case of exception
-        try:
-            cursor.close()
-        except:
-            pass
         raise HTTPException(status_code=500, detail=f"Error retrieving session data: {str(e)}")
     
 # Password hashing context (assuming it's being used in your app)
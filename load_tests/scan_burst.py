@@ -0,0 +1,118 @@
+# Classroom scan burst
+#
+# Simulates a class scanning the same QR code: many clients request the same secure
+# link within a short window, each downloading the whole file. Reports latencies,
+# status codes and throughput, checks every client got the same bytes and, given an
+# admin session cookie, shows how much work the server shared between requests
+# (/api/system/single-flight), resolved from memory (/api/system/link-cache) and
+# served from its read cache (/api/system/blob-cache), and how late its event loop
+# ran during the burst (/api/system/event-loop).
+#
+# Arrival times come from --seed, so a run can be repeated exactly. For numbers that
+# don't depend on Azure, run the app with STORAGE_BACKEND=local, e.g.:
+#
+#   STORAGE_BACKEND=local uvicorn app.main:app
+#   python load_tests/scan_burst.py http://localhost:8000/s/set/<unique code> --clients 60
+#
+# Use --rounds 2 to see a cold burst (nothing cached yet) followed by a warm one.
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import statistics
+import sys
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+
+async def scan(client, url, delay, results):
+    await asyncio.sleep(delay)
+    started = time.perf_counter()
+    try:
+        response = await client.get(url)
+        results.append({
+            'status': response.status_code,
+            'seconds': time.perf_counter() - started,
+            'bytes': len(response.content),
+            'sha256': hashlib.sha256(response.content).hexdigest()
+        })
+    except httpx.HTTPError as e:
+        results.append({'status': type(e).__name__, 'seconds': time.perf_counter() - started, 'bytes': 0, 'sha256': None})
+
+
+async def admin_stats(client, base_url, cookie):
+    if not cookie:
+        return None
+    stats = {}
+    for name in ("single-flight", "link-cache", "blob-cache", "event-loop"):
+        response = await client.get(f"{base_url}/api/system/{name}", cookies={"session": cookie})
+        stats[name] = response.json() if response.status_code == 200 else f"HTTP {response.status_code}"
+    return stats
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def report(round_number, results, elapsed):
+    latencies = [result['seconds'] for result in results]
+    statuses = {}
+    for result in results:
+        statuses[str(result['status'])] = statuses.get(str(result['status']), 0) + 1
+    bodies = {result['sha256'] for result in results if result['status'] == 200}
+    total_bytes = sum(result['bytes'] for result in results)
+
+    print(f"Round {round_number}: {len(results)} scans in {elapsed:.2f}s")
+    print(f"  statuses: {statuses}")
+    print(f"  latency: p50 {statistics.median(latencies) * 1000:.0f} ms, "
+          f"p95 {percentile(latencies, 0.95) * 1000:.0f} ms, max {max(latencies) * 1000:.0f} ms")
+    print(f"  received {total_bytes / (1024 * 1024):.1f} MB, {total_bytes / (1024 * 1024) / elapsed:.1f} MB/s")
+    print(f"  distinct bodies: {len(bodies)}")
+    return statuses.get("200", 0) == len(results) and len(bodies) == 1
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Many clients downloading the same secure link at once")
+    parser.add_argument("url", help="Secure link to scan, e.g. http://localhost:8000/s/set/<unique code>")
+    parser.add_argument("--clients", type=int, default=60, help="Scans per round (default 60)")
+    parser.add_argument("--window", type=float, default=2.0, help="Seconds over which the scans arrive (default 2)")
+    parser.add_argument("--rounds", type=int, default=1, help="Bursts to run one after another (default 1)")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the arrival times (default 1)")
+    parser.add_argument("--admin-cookie", help="Session cookie of an admin, to show server-side stats")
+    args = parser.parse_args()
+
+    url_parts = urlsplit(args.url)
+    base_url = f"{url_parts.scheme}://{url_parts.netloc}"
+    arrivals = random.Random(args.seed)
+    all_ok = True
+
+    limits = httpx.Limits(max_connections=args.clients, max_keepalive_connections=args.clients)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        before = await admin_stats(client, base_url, args.admin_cookie)
+        for round_number in range(1, args.rounds + 1):
+            results = []
+            started = time.perf_counter()
+            await asyncio.gather(*(
+                scan(client, args.url, arrivals.uniform(0, args.window), results) for _ in range(args.clients)
+            ))
+            all_ok = report(round_number, results, time.perf_counter() - started) and all_ok
+
+        after = await admin_stats(client, base_url, args.admin_cookie)
+        if after:
+            print("Server stats before:")
+            print(json.dumps(before, indent=2, default=str))
+            print("Server stats after:")
+            print(json.dumps(after, indent=2, default=str))
+
+    if not all_ok:
+        print("Some scans failed or got different files")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
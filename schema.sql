@@ -23,15 +23,17 @@ CREATE TABLE IF NOT EXISTS pdf (
     user_id INT NOT NULL,
     url VARCHAR(512) NOT NULL,
     original_filename VARCHAR(255),
-    sas_token VARCHAR(2048) NOT NULL,
+    sas_token VARCHAR(2048),
     sas_token_expiry DATETIME,
     num_slides INT DEFAULT 0,
     file_size_kb INT DEFAULT 0,
     download_count INT DEFAULT 0,
+    set_count INT NOT NULL DEFAULT 0, -- Sets made from this presentation, kept up to date with them (database_op/user_usage.py)
     pdf_qrcode_url VARCHAR(512),
     pdf_qrcode_sas_token VARCHAR(2048),
     pdf_qrcode_sas_token_expiry DATETIME,
     unique_code VARCHAR(36) UNIQUE NOT NULL,
+    content_hash CHAR(64) DEFAULT NULL, -- Conversion cache key of the uploaded .pptx, identifies the content for the set PDF cache
     FOREIGN KEY (user_id) REFERENCES user(user_id) ON DELETE CASCADE
 );
 
@@ -41,7 +43,7 @@ CREATE TABLE IF NOT EXISTS slide_file (
     pdf_id INT NOT NULL,
     url VARCHAR(512) NOT NULL,
     uploaded_on DATETIME DEFAULT CURRENT_TIMESTAMP,
-    sas_token VARCHAR(2048) NOT NULL,
+    sas_token VARCHAR(2048),
     sas_token_expiry DATETIME,
     file_type ENUM('image', 'pdf') NOT NULL, -- 'image' for thumbnail, 'pdf' for 1-page slide PDF
     slide_number INT NOT NULL, -- The original slide number this file corresponds to
@@ -54,8 +56,8 @@ CREATE TABLE IF NOT EXISTS thumbnail (
     image_id INT NOT NULL, -- This is the slide_file_id from the slide_file table (where file_type='pdf')
     pdf_id INT NOT NULL,
     url VARCHAR(512) NOT NULL,
-    sas_token VARCHAR(2048) NOT NULL,
-    sas_token_expiry DATETIME NOT NULL,
+    sas_token VARCHAR(2048),
+    sas_token_expiry DATETIME,
     FOREIGN KEY (pdf_id) REFERENCES pdf(pdf_id) ON DELETE CASCADE,
     FOREIGN KEY (image_id) REFERENCES slide_file(image_id) ON DELETE CASCADE 
 );
@@ -67,14 +69,15 @@ CREATE TABLE IF NOT EXISTS `set` (
     name VARCHAR(255),
     user_id INT NOT NULL,
     url VARCHAR(512),
-    sas_token VARCHAR(2048) NOT NULL,
-    sas_token_expiry DATETIME NOT NULL,
+    sas_token VARCHAR(2048),
+    sas_token_expiry DATETIME,
     qrcode_url VARCHAR(512),
     qrcode_sas_token VARCHAR(2048),
     qrcode_sas_token_expiry DATETIME,
     download_count INT DEFAULT 0,
     slide_count INT DEFAULT 0,
     unique_code VARCHAR(36) UNIQUE NOT NULL,
+    pdf_cache_key CHAR(64) DEFAULT NULL, -- set_pdf_cache entry this set's PDF comes from, if any
     FOREIGN KEY (user_id) REFERENCES user(user_id) ON DELETE CASCADE,
     FOREIGN KEY (pdf_id) REFERENCES pdf(pdf_id) ON DELETE CASCADE
 );
@@ -89,6 +92,20 @@ CREATE TABLE IF NOT EXISTS set_image (
     FOREIGN KEY (image_id) REFERENCES slide_file(image_id) ON DELETE CASCADE
 );
 
+-- User Usage Table - What each user has, kept up to date in the same transaction as
+-- the rows it counts (database_op/user_usage.py), so limits and the account page
+-- read one row instead of counting
+CREATE TABLE IF NOT EXISTS user_usage (
+    user_id INT NOT NULL PRIMARY KEY,
+    presentation_count INT NOT NULL DEFAULT 0,
+    set_count INT NOT NULL DEFAULT 0,
+    max_sets_per_presentation INT NOT NULL DEFAULT 0,
+    pdf_download_count BIGINT NOT NULL DEFAULT 0,
+    set_download_count BIGINT NOT NULL DEFAULT 0,
+    storage_kb BIGINT NOT NULL DEFAULT 0, -- Uploaded presentations, like pdf.file_size_kb
+    FOREIGN KEY (user_id) REFERENCES user(user_id) ON DELETE CASCADE
+);
+
 -- Bug Reports Table - Stores user-submitted bug reports
 CREATE TABLE IF NOT EXISTS bug_reports (
     report_id INT AUTO_INCREMENT PRIMARY KEY,
@@ -123,6 +140,61 @@ CREATE TABLE IF NOT EXISTS set_stats (
     -- No foreign key for full persistence
 );
 
+-- Conversion Cache Table - Maps the hash of an uploaded .pptx to its already converted files
+CREATE TABLE IF NOT EXISTS conversion_cache (
+    content_hash CHAR(64) NOT NULL PRIMARY KEY, -- SHA-256 of the uploaded .pptx bytes
+    blob_prefix VARCHAR(512) NOT NULL, -- Folder holding master.pdf, slide_<n>.pdf and thumb_<n>.png
+    num_slides INT DEFAULT 0, -- 0 means only the master PDF is cached
+    size_kb INT DEFAULT 0,
+    hit_count INT DEFAULT 0,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    last_used_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Set PDF Cache Table - One shared PDF per (presentation content, ordered slides, output profile)
+CREATE TABLE IF NOT EXISTS set_pdf_cache (
+    cache_key CHAR(64) NOT NULL PRIMARY KEY, -- SHA-256 of content hash, slide numbers and profile
+    blob_name VARCHAR(512) NOT NULL,
+    size_kb INT DEFAULT 0,
+    hit_count INT DEFAULT 0,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    last_used_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Conversion Job Table - Queue of uploads waiting for (or going through) conversion by the worker processes
+CREATE TABLE IF NOT EXISTS conversion_job (
+    job_id INT AUTO_INCREMENT PRIMARY KEY,
+    user_id INT NOT NULL,
+    status ENUM('queued', 'running', 'complete', 'error') NOT NULL DEFAULT 'queued',
+    stage VARCHAR(64) DEFAULT NULL, -- What a running job is doing right now (converting_to_pdf, processing_slides...)
+    upload_blob_name VARCHAR(512) NOT NULL, -- Where the uploaded .pptx is staged
+    original_filename VARCHAR(255),
+    file_size_kb INT DEFAULT 0,
+    pdf_id INT DEFAULT NULL, -- Set once the job is complete, not a strict FK so the job history survives deletes
+    attempts INT NOT NULL DEFAULT 0,
+    worker_id VARCHAR(255) DEFAULT NULL,
+    error_message TEXT,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    claimed_at DATETIME DEFAULT NULL,
+    heartbeat_at DATETIME DEFAULT NULL,
+    finished_at DATETIME DEFAULT NULL,
+    FOREIGN KEY (user_id) REFERENCES user(user_id) ON DELETE CASCADE
+);
+
+-- Conversion Worker Table - What each running conversion worker process reports about itself, for the admin page
+CREATE TABLE IF NOT EXISTS conversion_worker (
+    worker_id VARCHAR(255) NOT NULL PRIMARY KEY, -- hostname:pid of the worker process
+    office_pool_status TEXT, -- JSON, the status of its warm LibreOffice pool
+    cache_hits INT NOT NULL DEFAULT 0, -- Conversion cache counters since the process started
+    cache_misses INT NOT NULL DEFAULT 0,
+    cache_stores INT NOT NULL DEFAULT 0,
+    cache_evictions INT NOT NULL DEFAULT 0,
+    cache_errors INT NOT NULL DEFAULT 0,
+    kill_libreoffice_requested BOOLEAN NOT NULL DEFAULT FALSE, -- Set by admins, handled on the next report
+    started_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    heartbeat_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
 -- Create indexes for performance optimization
 CREATE INDEX idx_user_id_pdf ON pdf(user_id); -- Renamed for clarity
 CREATE INDEX idx_slide_file_pdf_id ON slide_file(pdf_id);
@@ -138,3 +210,7 @@ CREATE INDEX idx_user_id_set ON `set`(user_id);
 -- CREATE INDEX idx_conversion_stats_pdf_id ON conversion_stats(pdf_id); -- Removed
 -- CREATE INDEX idx_conversion_stats_user_id ON conversion_stats(user_id); -- Removed
 CREATE INDEX idx_set_stats_set_id ON set_stats(set_id); -- Kept for set_stats
+CREATE INDEX idx_conversion_cache_last_used ON conversion_cache(last_used_at); -- LRU eviction order
+CREATE INDEX idx_conversion_job_status ON conversion_job(status, created_at); -- Workers claiming the oldest queued job
+CREATE INDEX idx_conversion_job_user_status ON conversion_job(user_id, status);
+CREATE INDEX idx_set_pdf_cache_key ON `set`(pdf_cache_key); -- Finding unused set_pdf_cache entries
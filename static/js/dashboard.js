@@ -137,6 +137,36 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
+    // Conversion job tracking
+    // Uploads are converted in the background, so poll each pending job and
+    // reload the dashboard once they have all finished
+    const pendingJobs = document.querySelectorAll('.pending-job');
+    if (pendingJobs.length > 0) {
+        const jobPollInterval = setInterval(async function() {
+            let stillRunning = 0;
+            for (const jobElement of pendingJobs) {
+                try {
+                    const response = await fetch(`/conversion-job/${jobElement.dataset.jobId}`);
+                    if (!response.ok) {
+                        continue;
+                    }
+                    const job = await response.json();
+                    jobElement.querySelector('.pending-job-stage').textContent = (job.stage || job.status).replace(/_/g, ' ');
+                    if (job.status === 'queued' || job.status === 'running') {
+                        stillRunning++;
+                    }
+                } catch (error) {
+                    console.error('Error checking conversion job:', error);
+                    stillRunning++;
+                }
+            }
+            if (stillRunning === 0) {
+                clearInterval(jobPollInterval);
+                window.location.reload();
+            }
+        }, 3000);
+    }
+
     // Function to handle QR code download via JavaScript
     async function downloadQrCode(button, url, filename) {
         try {
@@ -243,44 +273,105 @@ document.addEventListener('DOMContentLoaded', function() {
     }
     
     // Set download functionality and tracking
-    const setDownloadButtons = document.querySelectorAll('.set-download-btn');
-    if (setDownloadButtons.length > 0) {
-        setDownloadButtons.forEach(button => {
-            button.addEventListener('click', async function(e) {
-                e.preventDefault(); // Prevent default link behavior
+    // Sets are loaded when the user opens them, so the set buttons are handled
+    // through the document rather than bound one by one
+    document.addEventListener('click', async function(e) {
+        const button = e.target.closest('.set-download-btn');
+        if (!button) {
+            return;
+        }
+        e.preventDefault(); // Prevent default link behavior
+
+        const setId = button.dataset.setId;
+        const qrCodeUrl = button.href; // Get the QR code URL from the href
+        const filenameElement = button.closest('.list-group-item').querySelector('div h6'); // Set name is in h6
+        let setFilename = 'set'; // Default filename
+        if (filenameElement) {
+            setFilename = filenameElement.textContent.trim().replace(/\s+/g, '_').toLowerCase(); // Get set name and format for filename
+        }
+        const filename = `${setFilename}_qr.png`; // Set desired filename
+
+        if (setId) {
+            // Increment the download count
+            try {
+                fetch(`/increment-set-download/${setId}`, {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json',
+                    }
+                });
+            } catch (error) {
+                console.error('Error incrementing set download count:', error);
+                // Continue with download even if tracking fails
+            }
+        }
 
-                const setId = this.dataset.setId;
-                const qrCodeUrl = this.href; // Get the QR code URL from the href
-                 const filenameElement = this.closest('.list-group-item').querySelector('div h6'); // Assuming set name is in h6
-                 let setFilename = 'set'; // Default filename
-                 if (filenameElement) {
-                     setFilename = filenameElement.textContent.trim().replace(/\s+/g, '_').toLowerCase(); // Get set name and format for filename
-                 }
-                 const filename = `${setFilename}_qr.png`; // Set desired filename
+        // Use the generic download function
+        if (qrCodeUrl && qrCodeUrl !== '#') {
+            await downloadQrCode(button, qrCodeUrl, filename);
+        } else {
+            alert('QR code URL not available.');
+        }
+    });
 
+    // Builds the list item of one set, as returned by /dashboard/presentations/<id>/sets
+    function renderSet(set) {
+        const item = document.createElement('li');
+        item.className = 'list-group-item d-flex justify-content-between align-items-center py-2 px-0';
 
-                if (setId) {
-                    // Increment the download count
-                    try {
-                        fetch(`/increment-set-download/${setId}`, {
-                            method: 'POST',
-                            headers: {
-                                'Content-Type': 'application/json',
-                            }
-                        });
-                    } catch (error) {
-                        console.error('Error incrementing set download count:', error);
-                        // Continue with download even if tracking fails
+        const details = document.createElement('div');
+        const name = document.createElement('h6');
+        name.className = 'mb-0 fw-normal';
+        name.textContent = set.name;
+        const stats = document.createElement('div');
+        stats.innerHTML = '<small class="text-muted"><strong>Slides:</strong> <span class="set-slides"></span> | <strong>Downloaded:</strong> <span class="set-downloads"></span> times</small>';
+        stats.querySelector('.set-slides').textContent = set.slide_count;
+        stats.querySelector('.set-downloads').textContent = set.download_count;
+        details.append(name, stats);
+
+        const download = document.createElement('a');
+        download.href = set.qrcode_download_url;
+        download.className = 'btn btn-outline-primary btn-sm set-download-btn';
+        download.dataset.setId = set.set_id;
+        download.setAttribute('download', '');
+        download.innerHTML = '<i class="fas fa-qrcode"></i>';
+
+        item.append(details, download);
+        return item;
+    }
+
+    // Show / hide a presentation's sets, loading them the first time
+    document.querySelectorAll('.show-sets-btn').forEach(button => {
+        const label = button.innerHTML;
+        button.addEventListener('click', async function() {
+            const list = document.querySelector(`.presentation-sets[data-pdf-id="${button.dataset.pdfId}"]`);
+            if (!list.classList.contains('d-none')) {
+                list.classList.add('d-none');
+                button.innerHTML = label;
+                return;
+            }
+
+            if (!list.dataset.loaded) {
+                button.disabled = true;
+                try {
+                    const response = await fetch(`/dashboard/presentations/${button.dataset.pdfId}/sets`);
+                    if (!response.ok) {
+                        throw new Error(`HTTP error! status: ${response.status}`);
                     }
+                    const data = await response.json();
+                    list.replaceChildren(...data.sets.map(renderSet));
+                    list.dataset.loaded = 'true';
+                } catch (error) {
+                    console.error('Error loading sets:', error);
+                    alert('Failed to load the sets. Please try again.');
+                    return;
+                } finally {
+                    button.disabled = false;
                 }
+            }
 
-                // Use the generic download function
-                if (qrCodeUrl && qrCodeUrl !== '#') {
-                    await downloadQrCode(button, qrCodeUrl, filename);
-                } else {
-                    alert('QR code URL not available.');
-                }
-            });
+            list.classList.remove('d-none');
+            button.innerHTML = '<i class="fas fa-chevron-up me-1"></i> Hide sets';
         });
-    }
+    });
 });